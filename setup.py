@@ -14,5 +14,7 @@ setup(
     package_data={'llm_open_ie.logger': ['*.ini']},
     include_package_data=True,
     python_requires='>=3.10',
-    install_requires=['openai', 'tiktoken']
+    install_requires=['openai', 'tiktoken'],
+    extras_require={'evaluation': ['numpy']},
+    entry_points={'console_scripts': ['llm-open-ie=llm_open_ie.cli:main']}
 )
@@ -0,0 +1,230 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from pathlib import Path
+from typing import Callable, Iterator
+import threading
+import time
+
+from llm_open_ie.corpus import iter_documents
+from llm_open_ie.llm import LLMOpenIE
+from llm_open_ie.logger import LOGGER
+from llm_open_ie.pipeline import oie_pipeline
+
+# Datasets of the paper, with their path relative to the `dataset` folder of this repository
+BENCHMARK_DATASETS = {
+    'ST': 'ST/ST.json',
+    'REBEL': 'REBEL/REBEL.json',
+    'REBEL_20': 'REBEL_20/REBEL_20.json'
+}
+STAGES = [
+    'entity_extraction', 'phrase_selection', 'mention_recognition', 'mention_recognition_batch',
+    'relation_extraction', 'predicate_description', 'fused_relation_extraction'
+]
+
+# Stage running in the current context, to which the requests are accounted, and the thread where it started
+_current_stage: ContextVar[tuple[str, int] | None] = ContextVar('current_stage', default=None)
+
+
+def run_benchmark(llm_oie: LLMOpenIE, dataset_dir: str | Path = 'dataset', datasets: list[str] = None,
+                  output_language: str = 'English', **pipeline_kwargs) -> dict:
+    # Run `oie_pipeline` on every document of the benchmark datasets (one document at a time) and report, for each
+    #  dataset and for each stage, the calls, the requests, the prompt and completion tokens and the CPU time spent in
+    #  the stage besides the requests (i.e. to build the prompts and parse the answers). Together with an offline LLM
+    #  such as `ReplayOpenIE`, the report only depends on the code, and can be compared between releases.
+    # The tokens are counted with `llm_oie.get_num_tokens`, so that also the cached answers are counted.
+    datasets = datasets if datasets is not None else list(BENCHMARK_DATASETS)
+    for dataset in datasets:
+        if dataset not in BENCHMARK_DATASETS:
+            options_str = ', '.join([f'`{v}`' for v in BENCHMARK_DATASETS])
+            raise ValueError(f'`{dataset}` is not a valid option: choose one between {options_str}')
+
+    report = {
+        'settings': {'output_language': output_language, **pipeline_kwargs},
+        'datasets': dict()
+    }
+    for dataset in datasets:
+        stats = _BenchmarkStats()
+        documents, failed_documents, n_entities, n_triplets = 0, 0, 0, 0
+        with _instrumented(llm_oie, stats):
+            start = time.perf_counter()
+            for doc in iter_documents(Path(dataset_dir) / BENCHMARK_DATASETS[dataset]):
+                documents += 1
+                try:
+                    entities, triplets = oie_pipeline(doc['text'], llm_oie, output_language, **pipeline_kwargs)
+                except Exception as e:
+                    failed_documents += 1
+                    LOGGER.warning(f'Benchmark document {doc["id"]} of {dataset} failed: {type(e).__name__}: {e}')
+                    continue
+                n_entities += len(entities)
+                n_triplets += len(triplets)
+            wall_seconds = time.perf_counter() - start
+
+        report['datasets'][dataset] = {
+            'documents': documents,
+            'failed_documents': failed_documents,
+            'entities': n_entities,
+            'triplets': n_triplets,
+            'wall_seconds': wall_seconds,
+            **stats.totals(),
+            'stages': stats.stages()
+        }
+        LOGGER.info(f'Benchmark of {dataset}: {documents} documents in {wall_seconds:.2f} seconds.')
+
+    return report
+
+
+# Counters of the calls of each stage, shared by the threads of a pipeline run
+class _BenchmarkStats:
+    __stages: dict[str, dict]
+    __lock: threading.Lock
+
+    def __init__(self):
+        self.__stages = {
+            stage: {
+                'calls': 0,
+                'requests': 0,
+                'prompt_tokens': 0,
+                'completion_tokens': 0,
+                'cpu_seconds': 0.0,
+                'request_cpu_seconds': 0.0
+            }
+            for stage in STAGES + [None]
+        }
+        self.__lock = threading.Lock()
+
+    def add(self, stage: str | None, **counts: float):
+        with self.__lock:
+            for k, v in counts.items():
+                self.__stages[stage][k] += v
+
+    def stages(self) -> dict:
+        # Requests sent outside of any stage are reported as `other`
+        with self.__lock:
+            return {
+                stage if stage is not None else 'other': {
+                    'calls': counters['calls'],
+                    'requests': counters['requests'],
+                    'prompt_tokens': counters['prompt_tokens'],
+                    'completion_tokens': counters['completion_tokens'],
+                    'local_cpu_seconds': max(0.0, counters['cpu_seconds'] - counters['request_cpu_seconds'])
+                }
+                for stage, counters in self.__stages.items() if counters['calls'] or counters['requests']
+            }
+
+    def totals(self) -> dict:
+        stages = self.stages()
+        return {
+            k: sum([counters[k] for counters in stages.values()])
+            for k in ['requests', 'prompt_tokens', 'completion_tokens', 'local_cpu_seconds']
+        }
+
+
+@contextmanager
+def _instrumented(llm_oie: LLMOpenIE, stats: _BenchmarkStats):
+    # Wrap the stages and the chat completions of the LLM instance to count them in the stats, restoring it on exit
+    for stage in STAGES:
+        setattr(llm_oie, stage, _stage_wrapper(stage, getattr(llm_oie, stage), stats))
+    llm_oie.iter_entity_extraction = _iter_stage_wrapper(
+        'entity_extraction', llm_oie.iter_entity_extraction, stats)
+    llm_oie.chat_completion = _chat_completion_wrapper(llm_oie.chat_completion, llm_oie, stats)
+    llm_oie.stream_chat_completion = _stream_chat_completion_wrapper(llm_oie.stream_chat_completion, llm_oie, stats)
+    try:
+        yield llm_oie
+    finally:
+        for name in STAGES + ['iter_entity_extraction', 'chat_completion', 'stream_chat_completion']:
+            delattr(llm_oie, name)
+
+
+def _stage_wrapper(stage: str, stage_method: Callable, stats: _BenchmarkStats) -> Callable:
+    @wraps(stage_method)
+    def wrapper(*args, **kwargs):
+        # Stages called by other stages are accounted to the outer one
+        if _current_stage.get() is not None:
+            return stage_method(*args, **kwargs)
+        token = _current_stage.set((stage, threading.get_ident()))
+        start = time.thread_time()
+        try:
+            return stage_method(*args, **kwargs)
+        finally:
+            stats.add(stage, calls=1, cpu_seconds=time.thread_time() - start)
+            _current_stage.reset(token)
+
+    return wrapper
+
+
+def _iter_stage_wrapper(stage: str, iter_stage_method: Callable, stats: _BenchmarkStats) -> Callable:
+    @wraps(iter_stage_method)
+    def wrapper(*args, **kwargs) -> Iterator:
+        # The stage is only set while getting the next item, since the caller runs in the same context in between
+        items = iter_stage_method(*args, **kwargs)
+        stats.add(stage, calls=1)
+        while True:
+            token = _current_stage.set((stage, threading.get_ident()))
+            start = time.thread_time()
+            try:
+                item = next(items, None)
+            finally:
+                stats.add(stage, cpu_seconds=time.thread_time() - start)
+                _current_stage.reset(token)
+            if item is None:
+                break
+            yield item
+
+    return wrapper
+
+
+def _chat_completion_wrapper(chat_completion: Callable, llm_oie: LLMOpenIE, stats: _BenchmarkStats) -> Callable:
+    @wraps(chat_completion)
+    def wrapper(user: str, system: str = None, **kwargs):
+        start = time.thread_time()
+        answer = chat_completion(user, system=system, **kwargs)
+        _add_request(llm_oie, stats, user, system, answer, time.thread_time() - start)
+        return answer
+
+    return wrapper
+
+
+def _stream_chat_completion_wrapper(stream_chat_completion: Callable, llm_oie: LLMOpenIE,
+                                    stats: _BenchmarkStats) -> Callable:
+    @wraps(stream_chat_completion)
+    def wrapper(user: str, system: str = None, **kwargs) -> Iterator[str]:
+        # Only the time spent to get the next line is accounted to the request, not the one spent by the caller to
+        #  parse it
+        request_cpu_seconds = 0.0
+        answer_lines = []
+        lines = stream_chat_completion(user, system=system, **kwargs)
+        while True:
+            start = time.thread_time()
+            line = next(lines, None)
+            request_cpu_seconds += time.thread_time() - start
+            if line is None:
+                break
+            answer_lines.append(line)
+            yield line
+        _add_request(llm_oie, stats, user, system, '\n'.join(answer_lines), request_cpu_seconds)
+
+    return wrapper
+
+
+def _add_request(llm_oie: LLMOpenIE, stats: _BenchmarkStats, user: str, system: str | None, answer: str,
+                 request_cpu_seconds: float):
+    start = time.thread_time()
+    prompt_tokens = llm_oie.get_num_tokens(user) + (llm_oie.get_num_tokens(system) if system is not None else 0)
+    completion_tokens = llm_oie.get_num_tokens(answer)
+    # The counting of the tokens is part of the benchmark, not of the stage
+    request_cpu_seconds += time.thread_time() - start
+
+    stage, stage_thread_id = _current_stage.get() or (None, None)
+    if stage_thread_id != threading.get_ident():
+        # The CPU time of the stage is only measured in the thread where it started
+        request_cpu_seconds = 0.0
+    stats.add(
+        stage,
+        requests=1,
+        prompt_tokens=prompt_tokens,
+        completion_tokens=completion_tokens,
+        request_cpu_seconds=request_cpu_seconds
+    )
@@ -0,0 +1,74 @@
+from __future__ import annotations
+
+from typing import Callable
+import re
+
+# Paragraphs are separated by empty lines, sentences by a final punctuation mark followed by a space
+PARAGRAPH_PATTERN = re.compile(r'\S(?:.*?\S)?(?=\s*\n\s*\n|\s*$)', flags=re.DOTALL)
+SENTENCE_PATTERN = re.compile(r'\S.*?(?:[.!?](?=\s)|$)', flags=re.DOTALL)
+WORD_PATTERN = re.compile(r'\S+')
+
+
+def split_text(text: str, get_num_tokens: Callable[[str], int],
+               max_tokens: int, overlap_tokens: int = 0) -> list[str]:
+    # Split a text in chunks of at most `max_tokens` tokens, cutting only between sentences (or between words, for
+    #  the sentences that are longer than a whole chunk). Consecutive chunks share their last/first sentences, up to
+    #  `overlap_tokens` tokens, so that the context around each cut is seen in both chunks
+    if max_tokens < 1:
+        raise ValueError(f'`max_tokens` must be a positive integer, got {max_tokens}.')
+    if not 0 <= overlap_tokens < max_tokens:
+        raise ValueError(f'`overlap_tokens` must be between 0 and `max_tokens`, got {overlap_tokens}.')
+
+    units = [
+        (span, get_num_tokens(text[span[0]:span[1]]))
+        for span in _unit_spans(text, get_num_tokens, max_tokens)
+    ]
+
+    chunks = []
+    chunk_units = []
+    chunk_tokens = 0
+    for unit in units:
+        if chunk_units and chunk_tokens + unit[1] > max_tokens:
+            chunks.append(text[chunk_units[0][0][0]:chunk_units[-1][0][1]])
+            # Carry the last units of the closed chunk in the new one, as long as they fit the overlap budget
+            overlap_units = []
+            overlap_units_tokens = 0
+            for prev_unit in reversed(chunk_units):
+                if overlap_units_tokens + prev_unit[1] > overlap_tokens \
+                        or overlap_units_tokens + prev_unit[1] + unit[1] > max_tokens:
+                    break
+                overlap_units.insert(0, prev_unit)
+                overlap_units_tokens += prev_unit[1]
+            chunk_units, chunk_tokens = overlap_units, overlap_units_tokens
+        chunk_units.append(unit)
+        chunk_tokens += unit[1]
+    if chunk_units:
+        chunks.append(text[chunk_units[0][0][0]:chunk_units[-1][0][1]])
+
+    return chunks
+
+
+def _unit_spans(text: str, get_num_tokens: Callable[[str], int], max_tokens: int) -> list[tuple[int, int]]:
+    # Get the spans of the sentences of each paragraph, splitting the too long ones in groups of words
+    spans = []
+    for paragraph_match in PARAGRAPH_PATTERN.finditer(text):
+        paragraph_start = paragraph_match.start()
+        for sentence_match in SENTENCE_PATTERN.finditer(paragraph_match.group()):
+            start, end = paragraph_start + sentence_match.start(), paragraph_start + sentence_match.end()
+            if get_num_tokens(text[start:end]) <= max_tokens:
+                spans.append((start, end))
+                continue
+            # Count the tokens word by word, which may slightly overestimate them but keeps this linear
+            words_start, words_end, words_tokens = None, None, 0
+            for word_match in WORD_PATTERN.finditer(text, start, end):
+                word_tokens = get_num_tokens(' ' + word_match.group())
+                if words_start is not None and words_tokens + word_tokens > max_tokens:
+                    spans.append((words_start, words_end))
+                    words_start, words_tokens = None, 0
+                if words_start is None:
+                    words_start = word_match.start()
+                words_end = word_match.end()
+                words_tokens += word_tokens
+            if words_start is not None:
+                spans.append((words_start, words_end))
+    return spans
@@ -0,0 +1,417 @@
+from __future__ import annotations
+
+from functools import partial
+from pathlib import Path
+import argparse
+import json
+
+
+def main(argv: list[str] = None):
+    parser = argparse.ArgumentParser(
+        prog='llm-open-ie', description='Knowledge Graph Engineering through Iterative Zero-shot LLM Prompting')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    run_parser = subparsers.add_parser(
+        'run', help='run the pipeline on a corpus of documents, resuming from the last checkpoint')
+    run_parser.add_argument('documents', help='dataset JSON file or JSONL file with the documents to process')
+    run_parser.add_argument('output', help='JSONL file where the results are appended')
+    run_parser.add_argument('--checkpoint', default=None,
+                            help='file with the IDs of the completed documents (default: OUTPUT with `.ckpt` suffix)')
+    run_parser.add_argument('--workers', type=int, default=4, help='number of documents processed in parallel')
+    run_parser.add_argument('--executor', choices=['thread', 'process'], default='thread',
+                            help='run the workers on a thread pool or on a process pool')
+    run_parser.add_argument('--language', default='English', help='language of the extracted entities and triples')
+    run_parser.add_argument('--max-failures', type=int, default=10,
+                            help='stop the run after this number of failed documents')
+    run_parser.add_argument('--metrics', default=None,
+                            help='file where the metrics of the LLM calls are written (Prometheus text if `.prom`, JSON'
+                                 ' otherwise)')
+    _add_pipeline_arguments(run_parser)
+    _add_llm_arguments(run_parser)
+    _add_stage_memo_argument(run_parser)
+
+    batch_parser = subparsers.add_parser(
+        'batch', help='run the pipeline on a corpus breadth-first, sending the requests of each stage for all the'
+                      ' documents as jobs of the OpenAI Batch API')
+    batch_parser.add_argument('documents', help='dataset JSON file or JSONL file with the documents to process')
+    batch_parser.add_argument('output', help='JSONL file where the results are appended once the job is over')
+    batch_parser.add_argument('--work-dir', default=None,
+                              help='folder with the state of the job and its batch files, from which an interrupted'
+                                   ' job is resumed (default: OUTPUT with `.batch` suffix)')
+    batch_parser.add_argument('--language', default='English', help='language of the extracted entities and triples')
+    batch_parser.add_argument('--poll-interval', type=float, default=60.0,
+                              help='seconds waited between two checks of the batches in progress')
+    batch_parser.add_argument('--max-rounds', type=int, default=3,
+                              help='batches sent for each stage, each one with the failed requests of the previous')
+    batch_parser.add_argument('--fuse-relations', action='store_true',
+                              help='extract the relations of each sentence together with the descriptions of their'
+                                   ' predicates, with a single request')
+    batch_parser.add_argument('--replay', default=None, metavar='RECORDING',
+                              help='answer the batches offline with the answers of a recording, instead of OpenAI')
+    _add_llm_arguments(batch_parser)
+    # The results of the stages are kept in the state of the job instead
+    batch_parser.set_defaults(stage_memo=None)
+
+    benchmark_parser = subparsers.add_parser(
+        'benchmark', help='run the pipeline on the datasets of the paper, replaying (or recording) the LLM answers')
+    benchmark_parser.add_argument('recording', help='JSONL file with the recorded LLM answers')
+    benchmark_parser.add_argument('--record', action='store_true',
+                                  help='send the requests to OpenAI and record the answers, instead of replaying them')
+    benchmark_parser.add_argument('--datasets', nargs='+', choices=['ST', 'REBEL', 'REBEL_20'],
+                                  default=['ST', 'REBEL', 'REBEL_20'], help='datasets to run the pipeline on')
+    benchmark_parser.add_argument('--dataset-dir', default='dataset', help='folder with the datasets of the paper')
+    benchmark_parser.add_argument('--output', default=None,
+                                  help='JSON file where the report is written (default: stdout)')
+    benchmark_parser.add_argument('--language', default='English',
+                                  help='language of the extracted entities and triples')
+    benchmark_parser.add_argument('--latency', type=float, default=0.0,
+                                  help='seconds waited by each replayed request, to simulate the network')
+    benchmark_parser.add_argument('--latency-jitter', type=float, default=0.0,
+                                  help='maximum random deviation (in seconds) from the replayed requests latency')
+    benchmark_parser.add_argument('--error-rate', type=float, default=0.0,
+                                  help='share of the replayed requests failing with a connection error')
+    benchmark_parser.add_argument('--slow-rate', type=float, default=0.0,
+                                  help='share of the replayed requests delayed by `--slow-latency`, to simulate the'
+                                       ' tail latency')
+    benchmark_parser.add_argument('--slow-latency', type=float, default=0.0,
+                                  help='seconds added to the latency of the slow replayed requests')
+    benchmark_parser.add_argument('--seed', type=int, default=0, help='seed of the replayed latencies and errors')
+    _add_pipeline_arguments(benchmark_parser)
+    _add_llm_arguments(benchmark_parser)
+
+    kg_parser = subparsers.add_parser(
+        'kg', help='add the results of a run to a knowledge graph store, merging the entities of all the documents')
+    kg_parser.add_argument('results', help='dataset JSON file or JSONL file with the results of the pipeline')
+    kg_parser.add_argument('store', help='binary file of the knowledge graph store, extended if it already exists')
+
+    evaluate_parser = subparsers.add_parser(
+        'evaluate', help='compute the metrics of the paper on annotated dataset records, or on the results of a run'
+                         ' against the gold entities and triples of the same documents')
+    evaluate_parser.add_argument('results', help='dataset JSON file or JSONL file with the records to evaluate')
+    evaluate_parser.add_argument('--gold', default=None,
+                                 help='original REBEL JSONL file (or dataset JSON file) with the gold entities and'
+                                      ' triples of the evaluated documents')
+    evaluate_parser.add_argument('--output', default=None,
+                                 help='JSON file where the metrics are written (default: stdout)')
+
+    serve_parser = subparsers.add_parser(
+        'serve', help='keep the pipeline warm and run it on the documents received as JSONL on the standard input (by'
+                      ' default), on a Unix socket or over HTTP')
+    serve_endpoint_group = serve_parser.add_mutually_exclusive_group()
+    serve_endpoint_group.add_argument('--unix', default=None, metavar='PATH',
+                                      help='Unix socket where JSONL requests are received')
+    serve_endpoint_group.add_argument('--http', default=None, metavar='HOST:PORT',
+                                      help='address where `POST /extract` requests are received')
+    serve_parser.add_argument('--workers', type=int, default=4, help='number of documents processed in parallel')
+    serve_parser.add_argument('--language', default='English',
+                              help='language of the extracted entities and triples, unless set by the request')
+    _add_pipeline_arguments(serve_parser)
+    _add_llm_arguments(serve_parser)
+    _add_stage_memo_argument(serve_parser)
+
+    replay_server_parser = subparsers.add_parser(
+        'replay-server', help='serve the recorded LLM answers as a local OpenAI-compatible server, e.g. to be an'
+                              ' endpoint of `--endpoints`')
+    replay_server_parser.add_argument('recording', help='JSONL file with the recorded LLM answers')
+    replay_server_parser.add_argument('--host', default='127.0.0.1', help='address of the server')
+    replay_server_parser.add_argument('--port', type=int, default=8001, help='port of the server')
+    replay_server_parser.add_argument('--latency', type=float, default=0.0,
+                                      help='seconds waited by each request, to simulate the network')
+    replay_server_parser.add_argument('--latency-jitter', type=float, default=0.0,
+                                      help='maximum random deviation (in seconds) from the requests latency')
+    replay_server_parser.add_argument('--error-rate', type=float, default=0.0,
+                                      help='share of the requests failing with a 503 error')
+    replay_server_parser.add_argument('--slow-rate', type=float, default=0.0,
+                                      help='share of the requests delayed by `--slow-latency`, to simulate the tail'
+                                           ' latency')
+    replay_server_parser.add_argument('--slow-latency', type=float, default=0.0,
+                                      help='seconds added to the latency of the slow requests')
+    replay_server_parser.add_argument('--seed', type=int, default=0, help='seed of the latencies and errors')
+
+    args = parser.parse_args(argv)
+    if args.command == 'run':
+        _run(args)
+    elif args.command == 'batch':
+        _batch(args)
+    elif args.command == 'benchmark':
+        _benchmark(args)
+    elif args.command == 'kg':
+        _kg(args)
+    elif args.command == 'evaluate':
+        _evaluate(args)
+    elif args.command == 'serve':
+        _serve(args)
+    elif args.command == 'replay-server':
+        _replay_server(args)
+
+
+def _add_pipeline_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--batch-mentions', action='store_true',
+                        help='recognize the mentions in the sentences of many entities with a single request')
+    parser.add_argument('--stream-entities', action='store_true',
+                        help='start checking each entity as soon as it is extracted, streaming the extraction answer')
+    parser.add_argument('--fuse-relations', action='store_true',
+                        help='extract the relations of each sentence together with the descriptions of their'
+                             ' predicates, with a single request')
+    parser.add_argument('--retry-budget', type=int, default=None,
+                        help='maximum number of times the failed requests of a document are sent again, in total')
+
+
+def _pipeline_kwargs(args: argparse.Namespace) -> dict:
+    return {
+        'batch_mentions': args.batch_mentions,
+        'stream_entities': args.stream_entities,
+        'fuse_relations': args.fuse_relations,
+        'retry_budget': args.retry_budget
+    }
+
+
+def _add_llm_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument('--rpm', type=float, default=3_500, help='requests per minute allowed by your OpenAI quota')
+    parser.add_argument('--tpm', type=float, default=90_000, help='tokens per minute allowed by your OpenAI quota')
+    parser.add_argument('--cache', default=None, help='SQLite file used to cache the completions')
+    parser.add_argument('--model', default='gpt-3.5-turbo-0301', help='model answering the requests')
+    parser.add_argument('--endpoints', default=None,
+                        help='JSON file with the API keys and OpenAI-compatible servers sharing the requests, each one'
+                             ' with its own `rpm` and `tpm` (instead of `--rpm` and `--tpm`)')
+    parser.add_argument('--mention-policy', choices=['off', 'prefilter', 'lexical'], default='off',
+                        help='lexical pre-check of the mentions before (`prefilter`) or instead of (`lexical`) the LLM')
+    parser.add_argument('--predicate-registry', default=None,
+                        help='SQLite file with the predicates already described, shared between documents and runs')
+    parser.add_argument('--predicate-reuse', choices=['record', 'exact', 'normalized'], default='normalized',
+                        help='reuse the registered descriptions for the same (`exact`) or equivalent (`normalized`)'
+                             ' predicate labels, or only record the new ones (`record`)')
+    parser.add_argument('--max-prompt-tokens', type=int, default=None,
+                        help='tokens budget of each prompt: longer lists of entities or triplets are split across more'
+                             ' requests')
+    parser.add_argument('--request-timeout', type=float, default=None,
+                        help='seconds after which a request is abandoned and retried')
+    parser.add_argument('--call-deadline', type=float, default=None,
+                        help='seconds after which a call gives up, over all the retries of its request')
+    parser.add_argument('--hedge-after', type=float, default=None,
+                        help='seconds after which a duplicate of a request still waiting for its answer is sent, the'
+                             ' first answer winning')
+    parser.add_argument('--hedge-quantile', type=float, default=None,
+                        help='hedge a request after this quantile (e.g. 0.95) of the latencies observed for its stage,'
+                             ' instead of after `--hedge-after` once enough latencies are known')
+    parser.add_argument('--routes', default=None,
+                        help='JSON file routing the requests of each stage to a model (and endpoints) with its own'
+                             ' `max_tokens`, by prompt size, and the malformed answers to a stronger model')
+
+
+def _add_stage_memo_argument(parser: argparse.ArgumentParser):
+    parser.add_argument('--stage-memo', default=None,
+                        help='SQLite file with the results of each stage for its inputs, so that processing an edited'
+                             ' document again only calls the LLM for the stages whose inputs changed')
+
+
+def _run(args: argparse.Namespace):
+    from llm_open_ie.corpus import run_corpus
+
+    # Each process has its own rate limiter: split the quota between them
+    n_limiters = args.workers if args.executor == 'process' else 1
+    llm_oie_factory = partial(_make_gpt_open_ie, _llm_settings(args), 1 / n_limiters)
+    run_corpus(args.documents, args.output, llm_oie_factory, checkpoint_path=args.checkpoint, n_workers=args.workers,
+               executor_type=args.executor, output_language=args.language, max_failures=args.max_failures,
+               metrics_path=args.metrics, **_pipeline_kwargs(args))
+
+
+def _batch(args: argparse.Namespace):
+    from llm_open_ie.llm.gpt.batch import BatchScheduler
+    from llm_open_ie.llm.replay import Recording, ReplayBatchClient, ReplayClient, ReplayOpenIE
+    from llm_open_ie.llm.routing import read_model_router
+    from llm_open_ie.predicate_registry import PredicateRegistry
+
+    if args.replay is not None:
+        recording = Recording(args.replay)
+        gpt = ReplayOpenIE(
+            recording, model=args.model, mention_policy=args.mention_policy,
+            predicate_registry=PredicateRegistry(args.predicate_registry, reuse_policy=args.predicate_reuse)
+            if args.predicate_registry is not None else None,
+            max_prompt_tokens=args.max_prompt_tokens,
+            router=read_model_router(args.routes, with_endpoints=False) if args.routes is not None else None)
+        client = ReplayBatchClient(ReplayClient(recording))
+    else:
+        gpt, client = _make_gpt_open_ie(_llm_settings(args)), None
+    work_dir = args.work_dir if args.work_dir is not None else Path(args.output).with_suffix('.batch')
+    scheduler = BatchScheduler(gpt, work_dir, client=client, poll_interval=args.poll_interval,
+                               max_rounds=args.max_rounds, fuse_relations=args.fuse_relations)
+    print(json.dumps(scheduler.run(args.documents, args.output, output_language=args.language)))
+
+
+def _benchmark(args: argparse.Namespace):
+    from llm_open_ie.benchmark import run_benchmark
+    from llm_open_ie.llm.cache import CompletionCache
+    from llm_open_ie.llm.rate_limiter import RateLimiter
+    from llm_open_ie.llm.replay import Recording, RecordingOpenIE, ReplayOpenIE
+    from llm_open_ie.llm.routing import read_model_router
+    from llm_open_ie.predicate_registry import PredicateRegistry
+
+    recording = Recording(args.recording)
+    cache = CompletionCache(args.cache) if args.cache is not None else None
+    predicate_registry = PredicateRegistry(args.predicate_registry, reuse_policy=args.predicate_reuse) \
+        if args.predicate_registry is not None else None
+    # All the routed requests are recorded (or replayed) as well, whatever the endpoints of their routes
+    router = read_model_router(args.routes, with_endpoints=False) if args.routes is not None else None
+    # The benchmark has no stage memo, so the deadlines are read from the arguments rather than from `_llm_settings`
+    deadline_kwargs = _deadline_kwargs(vars(args))
+    if args.record:
+        llm_oie = RecordingOpenIE(
+            recording, rate_limiter=RateLimiter(requests_per_minute=args.rpm, tokens_per_minute=args.tpm), cache=cache,
+            mention_policy=args.mention_policy, predicate_registry=predicate_registry, model=args.model,
+            max_prompt_tokens=args.max_prompt_tokens, router=router, **deadline_kwargs)
+    else:
+        # Replayed requests are not rate limited: `--rpm` and `--tpm` only apply to the recording
+        llm_oie = ReplayOpenIE(
+            recording, latency=args.latency, latency_jitter=args.latency_jitter, error_rate=args.error_rate,
+            seed=args.seed, slow_rate=args.slow_rate, slow_latency=args.slow_latency, cache=cache,
+            mention_policy=args.mention_policy, predicate_registry=predicate_registry, model=args.model,
+            max_prompt_tokens=args.max_prompt_tokens, router=router, **deadline_kwargs)
+
+    report = run_benchmark(llm_oie, dataset_dir=args.dataset_dir, datasets=args.datasets,
+                           output_language=args.language, **_pipeline_kwargs(args))
+    report['settings'].update({
+        'mode': 'record' if args.record else 'replay',
+        'latency': args.latency,
+        'latency_jitter': args.latency_jitter,
+        'error_rate': args.error_rate,
+        'slow_rate': args.slow_rate,
+        'slow_latency': args.slow_latency,
+        'seed': args.seed,
+        'mention_policy': args.mention_policy,
+        'max_prompt_tokens': args.max_prompt_tokens,
+        'routes': args.routes,
+        **deadline_kwargs,
+        'predicate_reuse': args.predicate_reuse if predicate_registry is not None else None
+    })
+    if predicate_registry is not None:
+        # The calls avoided by the registry, over all the datasets
+        report['predicate_registry'] = predicate_registry.stats()
+    if router is not None:
+        # The calls of each model in each stage, over all the datasets
+        report['routing'] = llm_oie.routing_stats
+
+    report_str = json.dumps(report, indent=2)
+    if args.output is None:
+        print(report_str)
+    else:
+        Path(args.output).write_text(report_str + '\n', encoding='utf-8')
+
+
+def _kg(args: argparse.Namespace):
+    from llm_open_ie.corpus import iter_records
+    from llm_open_ie.kg_store import KGStore
+
+    store = KGStore.load(args.store) if Path(args.store).exists() else KGStore()
+    for record in iter_records(args.results):
+        store.add_record(record)
+    store.save(args.store)
+    print(json.dumps({
+        'documents': store.documents,
+        'entities': store.num_entities,
+        'predicates': store.num_predicates,
+        'triples': store.num_triples
+    }))
+
+
+def _evaluate(args: argparse.Namespace):
+    from llm_open_ie.corpus import iter_records
+    from llm_open_ie.evaluation import evaluate, iter_with_gold
+
+    records = iter_with_gold(args.results, args.gold) if args.gold is not None else iter_records(args.results)
+    metrics_str = json.dumps(evaluate(records), indent=2)
+    if args.output is None:
+        print(metrics_str)
+    else:
+        Path(args.output).write_text(metrics_str + '\n', encoding='utf-8')
+
+
+def _serve(args: argparse.Namespace):
+    import sys
+    from llm_open_ie.server import PipelineServer
+
+    llm_oie = _make_gpt_open_ie(_llm_settings(args))
+    with PipelineServer(llm_oie, max_concurrency=args.workers, output_language=args.language,
+                        **_pipeline_kwargs(args)) as server:
+        try:
+            if args.unix is not None:
+                server.serve_unix(args.unix)
+            elif args.http is not None:
+                host, _, port = args.http.rpartition(':')
+                server.serve_http(host or '127.0.0.1', int(port))
+            else:
+                server.serve_jsonl(sys.stdin, sys.stdout)
+        except KeyboardInterrupt:
+            pass
+
+
+def _replay_server(args: argparse.Namespace):
+    from llm_open_ie.llm.replay import Recording, ReplayClient, make_replay_server
+
+    replay_client = ReplayClient(
+        Recording(args.recording), latency=args.latency, latency_jitter=args.latency_jitter,
+        error_rate=args.error_rate, seed=args.seed, slow_rate=args.slow_rate, slow_latency=args.slow_latency)
+    with make_replay_server(replay_client, args.host, args.port) as server:
+        print(f'Serving "{args.recording}" on http://{args.host}:{server.server_address[1]}/v1', flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def _llm_settings(args: argparse.Namespace) -> dict:
+    return {
+        'rpm': args.rpm,
+        'tpm': args.tpm,
+        'cache': args.cache,
+        'model': args.model,
+        'endpoints': args.endpoints,
+        'mention_policy': args.mention_policy,
+        'predicate_registry': args.predicate_registry,
+        'predicate_reuse': args.predicate_reuse,
+        'max_prompt_tokens': args.max_prompt_tokens,
+        'request_timeout': args.request_timeout,
+        'call_deadline': args.call_deadline,
+        'hedge_after': args.hedge_after,
+        'hedge_quantile': args.hedge_quantile,
+        'routes': args.routes,
+        'stage_memo': args.stage_memo
+    }
+
+
+def _deadline_kwargs(settings: dict) -> dict:
+    return {key: settings[key] for key in ['request_timeout', 'call_deadline', 'hedge_after', 'hedge_quantile']}
+
+
+def _make_gpt_open_ie(settings: dict, budget_share: float = 1.0):
+    # Only a `budget_share` of the rate budgets is used, when each process of a pool has its own rate limiters
+    from llm_open_ie.llm.cache import CompletionCache
+    from llm_open_ie.llm.endpoints import read_endpoint_pool
+    from llm_open_ie.llm.gpt import GPTOpenIE
+    from llm_open_ie.llm.rate_limiter import RateLimiter
+    from llm_open_ie.llm.routing import read_model_router
+    from llm_open_ie.llm.stage_memo import MemoizedOpenIE, StageMemo
+    from llm_open_ie.predicate_registry import PredicateRegistry
+
+    if settings['endpoints'] is not None:
+        llm_kwargs = {'endpoints': read_endpoint_pool(settings['endpoints'], budget_share)}
+    else:
+        llm_kwargs = {'rate_limiter': RateLimiter(
+            requests_per_minute=settings['rpm'] * budget_share, tokens_per_minute=settings['tpm'] * budget_share)}
+    llm_oie = GPTOpenIE(
+        cache=CompletionCache(settings['cache']) if settings['cache'] is not None else None,
+        model=settings['model'],
+        mention_policy=settings['mention_policy'],
+        predicate_registry=PredicateRegistry(settings['predicate_registry'], reuse_policy=settings['predicate_reuse'])
+        if settings['predicate_registry'] is not None else None,
+        max_prompt_tokens=settings['max_prompt_tokens'],
+        router=read_model_router(settings['routes'], budget_share) if settings['routes'] is not None else None,
+        **_deadline_kwargs(settings),
+        **llm_kwargs)
+    if settings['stage_memo'] is not None:
+        llm_oie = MemoizedOpenIE(llm_oie, StageMemo(settings['stage_memo']))
+    return llm_oie
+
+
+if __name__ == '__main__':
+    main()
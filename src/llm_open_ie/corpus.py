@@ -0,0 +1,237 @@
+from __future__ import annotations
+
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from pathlib import Path
+from typing import Callable, IO, Iterator
+import json
+import os
+import re
+
+from llm_open_ie.llm import LLMOpenIE
+from llm_open_ie.logger import LOGGER
+from llm_open_ie.metrics import PipelineMetrics
+from llm_open_ie.pipeline import oie_pipeline
+
+EXECUTOR_TYPES = ['thread', 'process']
+# Characters read at a time from a dataset JSON file, whose records are decoded one by one
+JSON_READ_SIZE = 1 << 20
+# Number of documents queued for each worker, beyond the one it is processing
+QUEUED_DOCUMENTS_PER_WORKER = 2
+
+# LLM of the current worker process, when documents are processed on a process pool
+_worker_llm_oie: LLMOpenIE | None = None
+
+
+def iter_records(records_path: str | Path) -> Iterator[dict]:
+    # Records of either a dataset JSON file (a list of records, as described in `dataset/json_schema.txt`) or a JSONL
+    #  file with one record per line, both read lazily: only the current record is kept in memory
+    records_path = Path(records_path)
+    with records_path.open('r', encoding='utf-8') as f:
+        if records_path.suffix == '.jsonl':
+            yield from (json.loads(line) for line in f if line.strip())
+        else:
+            yield from _iter_json_array(f)
+
+
+def iter_documents(documents_path: str | Path) -> Iterator[dict]:
+    # Documents can be given either as a dataset JSON file (a list of records with a `doc` field, as described in
+    #  `dataset/json_schema.txt`) or as a JSONL file with one record, or directly one `doc`, per line
+    for i, record in enumerate(iter_records(documents_path)):
+        doc = record.get('doc', record)
+        if 'text' not in doc:
+            raise ValueError(f'Document {i} in "{documents_path}" has no `text` field.')
+        if 'id' not in doc:
+            doc = {'id': i, **doc}
+        yield doc
+
+
+def to_dataset_record(doc: dict, entities: list[dict], triplets: list[dict]) -> dict:
+    # Format the pipeline output as the records of the datasets in the `dataset` folder
+    return {
+        'doc': doc,
+        'entities': {
+            'gpt': [{'label': e['label'], 'description': e['description'], 'types': e['types']} for e in entities]
+        },
+        'triples': {
+            'gpt': [
+                {
+                    'subject label': t['subj_label'],
+                    'predicate label': t['pred_label'],
+                    'predicate description': t.get('pred_description'),
+                    'object label': t['obj_label']
+                }
+                for t in triplets
+            ]
+        }
+    }
+
+
+def run_corpus(documents_path: str | Path, output_path: str | Path, llm_oie_factory: Callable[[], LLMOpenIE],
+               checkpoint_path: str | Path = None, n_workers: int = 4, executor_type: str = 'thread',
+               output_language: str = 'English', max_failures: int | None = 10, metrics_path: str | Path = None,
+               **pipeline_kwargs) -> dict:
+    # Run the pipeline on every document of a corpus, appending each result to the `output_path` JSONL file as soon as
+    #  it is ready. The IDs of the completed documents are appended to the checkpoint file, so that a new run with the
+    #  same paths skips them and only processes the missing (or previously failed) documents.
+    # With `thread` workers a single LLM is created with `llm_oie_factory` and shared by all of them, while with
+    #  `process` workers each process creates its own (the factory must then be picklable, e.g. a module function).
+    # With `metrics_path`, the metrics of the LLM calls of all the documents processed in this run are written there at
+    #  the end, in the Prometheus text format if its suffix is `.prom` and in JSON otherwise.
+    # Any other keyword argument is passed to `oie_pipeline`.
+    if executor_type not in EXECUTOR_TYPES:
+        options_str = ', '.join([f'`{v}`' for v in EXECUTOR_TYPES])
+        raise ValueError(f'`{executor_type}` is not a valid option: choose one between {options_str}')
+    if n_workers < 1:
+        raise ValueError(f'`n_workers` must be a positive integer, got {n_workers}.')
+
+    output_path = Path(output_path)
+    checkpoint_path = Path(checkpoint_path) if checkpoint_path is not None else output_path.with_suffix('.ckpt')
+    completed_ids = _load_checkpoint(checkpoint_path)
+    if completed_ids:
+        LOGGER.info(f'Resuming from "{checkpoint_path}": skipping {len(completed_ids)} completed documents.')
+
+    stats = {'completed': 0, 'skipped': 0, 'failed': 0}
+    run_metrics = None
+    if metrics_path is not None:
+        run_metrics = PipelineMetrics()
+        pipeline_kwargs = {**pipeline_kwargs, 'return_metrics': True}
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with (_make_executor(executor_type, n_workers, llm_oie_factory) as executor,
+          output_path.open('a', encoding='utf-8') as output_file,
+          checkpoint_path.open('a', encoding='utf-8') as checkpoint_file):
+        llm_oie = llm_oie_factory() if executor_type == 'thread' else None
+        pending: dict[Future, dict] = dict()
+
+        def collect(futures: set[Future]):
+            for future in futures:
+                doc = pending.pop(future)
+                try:
+                    entities, triplets, *doc_metrics = future.result()
+                except Exception as e:
+                    stats['failed'] += 1
+                    LOGGER.error(f'Document "{doc["id"]}" failed with `{type(e).__name__}`: {e}')
+                    continue
+                # Output first and checkpoint then: a crash in between can only repeat a document, never lose it
+                output_file.write(json.dumps(to_dataset_record(doc, entities, triplets), ensure_ascii=False) + '\n')
+                output_file.flush()
+                checkpoint_file.write(_checkpoint_key(doc['id']) + '\n')
+                checkpoint_file.flush()
+                os.fsync(checkpoint_file.fileno())
+                stats['completed'] += 1
+                if run_metrics is not None:
+                    run_metrics.merge(doc_metrics[0])
+                LOGGER.info(f'Document "{doc["id"]}" completed ({stats["completed"]} in this run).')
+
+        for doc in iter_documents(documents_path):
+            if max_failures is not None and stats['failed'] >= max_failures:
+                LOGGER.error(f'Stopping the run after {stats["failed"]} failed documents: run it again to resume.')
+                break
+            if _checkpoint_key(doc['id']) in completed_ids:
+                stats['skipped'] += 1
+                continue
+            # Keep only a bounded number of documents in memory, waiting for some to finish before reading more
+            while len(pending) >= n_workers * (1 + QUEUED_DOCUMENTS_PER_WORKER):
+                done, _ = wait(pending.keys(), return_when=FIRST_COMPLETED)
+                collect(done)
+            if executor_type == 'thread':
+                future = executor.submit(oie_pipeline, doc['text'], llm_oie, output_language, **pipeline_kwargs)
+            else:
+                future = executor.submit(_process_document, doc['text'], output_language, pipeline_kwargs)
+            pending[future] = doc
+
+        while pending:
+            done, _ = wait(pending.keys(), return_when=FIRST_COMPLETED)
+            collect(done)
+
+    if run_metrics is not None:
+        metrics_path = Path(metrics_path)
+        metrics_path.write_text(
+            run_metrics.export('prometheus' if metrics_path.suffix == '.prom' else 'json'), encoding='utf-8')
+        stats['metrics'] = run_metrics.as_dict()
+
+    LOGGER.info(f'Corpus run finished: {stats["completed"]} completed, {stats["skipped"]} skipped,'
+                f' {stats["failed"]} failed documents.')
+    return stats
+
+
+def _make_executor(executor_type: str, n_workers: int, llm_oie_factory: Callable[[], LLMOpenIE]) -> Executor:
+    if executor_type == 'thread':
+        return ThreadPoolExecutor(max_workers=n_workers)
+    return ProcessPoolExecutor(max_workers=n_workers, initializer=_init_worker, initargs=(llm_oie_factory,))
+
+
+def _init_worker(llm_oie_factory: Callable[[], LLMOpenIE]):
+    global _worker_llm_oie
+    _worker_llm_oie = llm_oie_factory()
+
+
+def _process_document(text: str, output_language: str, pipeline_kwargs: dict) -> tuple:
+    return oie_pipeline(text, _worker_llm_oie, output_language, **pipeline_kwargs)
+
+
+_WHITESPACE_PATTERN = re.compile(r'[ \t\n\r]*')
+
+
+def _iter_json_array(f: IO[str]) -> Iterator:
+    # Items of the JSON array in `f`, decoded one at a time while the file is read in chunks
+    decoder = json.JSONDecoder()
+    buffer = ''
+    position = 0
+    is_eof = False
+    expected = '['  # Then an item (or `]`), then `,` (or `]`), and so on
+
+    def read_more():
+        # Drop the decoded part of the buffer; a record longer than the buffer doubles its size, so that it is decoded
+        #  again only a few times
+        nonlocal buffer, position, is_eof
+        chunk = f.read(max(JSON_READ_SIZE, len(buffer) - position))
+        is_eof = not chunk
+        buffer = buffer[position:] + chunk
+        position = 0
+
+    while True:
+        position = _WHITESPACE_PATTERN.match(buffer, position).end()
+        if position == len(buffer):
+            if is_eof:
+                raise ValueError('The JSON array is not terminated.')
+            read_more()
+            continue
+        char = buffer[position]
+        if expected == '[':
+            if char != '[':
+                raise ValueError('A dataset JSON file must contain a list of records.')
+            position += 1
+            expected = 'item or ]'
+        elif char == ']' and expected != 'item':
+            return
+        elif expected == ',':
+            if char != ',':
+                raise ValueError(f'Expected `,` or `]` between the items of the JSON array, found `{char}`.')
+            position += 1
+            expected = 'item'
+        else:
+            try:
+                item, end = decoder.raw_decode(buffer, position)
+            except json.JSONDecodeError:
+                if is_eof:
+                    raise
+                read_more()
+                continue
+            # A number at the end of the buffer may go on in the next chunk
+            if end == len(buffer) and not is_eof:
+                read_more()
+                continue
+            position = end
+            expected = ','
+            yield item
+
+
+def _checkpoint_key(doc_id: str | int) -> str:
+    return json.dumps(doc_id)
+
+
+def _load_checkpoint(checkpoint_path: Path) -> set[str]:
+    if not checkpoint_path.exists():
+        return set()
+    with checkpoint_path.open('r', encoding='utf-8') as f:
+        return {line.strip() for line in f if line.strip()}
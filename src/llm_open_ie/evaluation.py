@@ -0,0 +1,275 @@
+from __future__ import annotations
+
+from itertools import islice
+from pathlib import Path
+from typing import TYPE_CHECKING, Iterable, Iterator
+
+from llm_open_ie.corpus import iter_records
+from llm_open_ie.matching import normalize_label
+
+if TYPE_CHECKING:
+    import numpy as np
+
+# Documents whose entities and triples are matched at once, bounding the memory used by the evaluation
+EVALUATION_BATCH_SIZE = 4_096
+
+ENTITY_COUNTS = ['total', 'gold', 'annotated', 'correct', 'missed', 'from_text', 'rebel_annotated', 'rebel_matches',
+                 'gold_compared', 'gold_matches', 'gold_unique', 'gold_recalled']
+TYPE_COUNTS = ['all_annotated', 'all_correct', 'first_annotated', 'first_correct']
+TRIPLE_COUNTS = ['total', 'gold', 'annotated', 'correct', 'from_text', 'rebel_annotated', 'rebel_matches',
+                 'gold_compared', 'gold_matches', 'gold_unique', 'gold_recalled']
+
+
+def iter_rebel_records(rebel_path: str | Path, limit: int = None) -> Iterator[dict]:
+    # Documents of the original REBEL dataset (e.g., `dataset/REBEL/original/en_train.jsonl`, with one document per
+    #  line), read lazily and formatted as the dataset records, with the REBEL entities and triples as their `gold` ones
+    yield from islice((_from_rebel_record(r) for r in iter_records(rebel_path)), limit)
+
+
+def iter_with_gold(records_path: str | Path, gold_path: str | Path) -> Iterator[dict]:
+    # Records of a run with the `gold` entities and triples of the same documents in `gold_path` (either the original
+    #  REBEL dataset or a dataset JSON file); only the gold annotations of the evaluated documents are kept in memory
+    doc_ids = {str(record['doc']['id']) for record in iter_records(records_path)}
+    gold = dict()
+    for gold_record in iter_records(gold_path):
+        gold_record = _from_rebel_record(gold_record) if 'docid' in gold_record else gold_record
+        doc_id = str(gold_record['doc']['id'])
+        if doc_id in doc_ids:
+            gold[doc_id] = (gold_record['entities'].get('gold', []), gold_record['triples'].get('gold', []))
+    for record in iter_records(records_path):
+        doc_id = str(record['doc']['id'])
+        if doc_id in gold:
+            record['entities']['gold'], record['triples']['gold'] = gold[doc_id]
+        yield record
+
+
+def evaluate(records: Iterable[dict], batch_size: int = EVALUATION_BATCH_SIZE) -> dict:
+    evaluator = Evaluator(batch_size)
+    evaluator.add_records(records)
+    return evaluator.as_dict()
+
+
+# Metrics of the paper (see the notebooks in the `dataset` folder) over dataset records, added one at a time:
+#  - from the human annotations, when available: the micro precision, recall and F1 of the entities, the precision of
+#    their types (all of them, or only the first one) and of the triples, the share of entity descriptions and triples
+#    coming from the GPT knowledge rather than from the text, and the share of new entities and triples (vs REBEL);
+#  - from the `gold` entities and triples, when available: the entities whose normalized label is a gold surface form,
+#    and the triples whose normalized subject and object are the ones of a gold triple (REBEL predicates are Wikidata
+#    properties, hardly ever phrased as the extracted ones), with the share of the gold ones they cover.
+# The records are only summarized when added, and matched in batches of documents with NumPy.
+class Evaluator:
+    __batch_size: int
+    __documents: int
+    __entity_counts: dict[str, int]
+    __type_counts: dict[str, int]
+    __triple_counts: dict[str, int]
+    __batch: list[tuple]
+
+    def __init__(self, batch_size: int = EVALUATION_BATCH_SIZE):
+        if batch_size < 1:
+            raise ValueError(f'`batch_size` must be a positive integer, got {batch_size}.')
+        _import_numpy()
+        self.__batch_size = batch_size
+        self.__documents = 0
+        self.__entity_counts = dict.fromkeys(ENTITY_COUNTS, 0)
+        self.__type_counts = dict.fromkeys(TYPE_COUNTS, 0)
+        self.__triple_counts = dict.fromkeys(TRIPLE_COUNTS, 0)
+        self.__batch = []
+
+    def add_record(self, record: dict):
+        self.__batch.append(_summarize_record(record))
+        self.__documents += 1
+        if len(self.__batch) >= self.__batch_size:
+            self.__flush()
+
+    def add_records(self, records: Iterable[dict]):
+        for record in records:
+            self.add_record(record)
+
+    def merge(self, other: Evaluator):
+        self.__flush()
+        other.__flush()
+        self.__documents += other.__documents
+        for counts, other_counts in [(self.__entity_counts, other.__entity_counts),
+                                     (self.__type_counts, other.__type_counts),
+                                     (self.__triple_counts, other.__triple_counts)]:
+            for key, value in other_counts.items():
+                counts[key] += value
+
+    def as_dict(self) -> dict:
+        self.__flush()
+        e, ty, t = self.__entity_counts, self.__type_counts, self.__triple_counts
+        entity_precision = _ratio(e['correct'], e['annotated'])
+        entity_recall = _ratio(e['correct'], e['correct'] + e['missed'])
+        return {
+            'documents': self.__documents,
+            'entities': {
+                **e,
+                'precision': entity_precision,
+                'recall': entity_recall,
+                'f1': _ratio(2 * entity_precision * entity_recall, entity_precision + entity_recall)
+                if entity_precision is not None and entity_recall is not None else None,
+                'from_gpt_knowledge': _complement(_ratio(e['from_text'], e['correct'])),
+                'new_vs_rebel': _complement(_ratio(e['rebel_matches'], e['rebel_annotated'])),
+                'gold_match_precision': _ratio(e['gold_matches'], e['gold_compared']),
+                'gold_match_recall': _ratio(e['gold_recalled'], e['gold_unique'])
+            },
+            'types': {
+                **ty,
+                'precision_all': _ratio(ty['all_correct'], ty['all_annotated']),
+                'precision_first': _ratio(ty['first_correct'], ty['first_annotated'])
+            },
+            'triples': {
+                **t,
+                'precision': _ratio(t['correct'], t['annotated']),
+                'from_gpt_knowledge': _complement(_ratio(t['from_text'], t['correct'])),
+                'new_vs_rebel': _complement(_ratio(t['rebel_matches'], t['rebel_annotated'])),
+                'gold_match_precision': _ratio(t['gold_matches'], t['gold_compared']),
+                'gold_match_recall': _ratio(t['gold_recalled'], t['gold_unique'])
+            }
+        }
+
+    def __flush(self):
+        if not self.__batch:
+            return
+        np = _import_numpy()
+        batch, self.__batch = self.__batch, []
+
+        # Annotation flags of all the entities, types and triples of the batch, one row each
+        entity_flags = _flags_matrix(np, [flags for doc in batch for flags in doc[1]], 3)
+        type_flags = _flags_matrix(np, [flags for doc in batch for flags in doc[2]], 2)
+        triple_flags = _flags_matrix(np, [flags for doc in batch for flags in doc[5]], 3)
+        self.__add_annotations(self.__entity_counts, entity_flags)
+        self.__add_annotations(self.__triple_counts, triple_flags)
+        self.__entity_counts['total'] += len(entity_flags)
+        self.__entity_counts['missed'] += sum([doc[0][1] for doc in batch])
+        self.__entity_counts['gold'] += sum([doc[0][0] for doc in batch])
+        self.__triple_counts['total'] += len(triple_flags)
+        self.__triple_counts['gold'] += sum([doc[4][0] for doc in batch])
+        # Types flags columns: correctness (`-1` if not annotated), and whether it is the first type of its entity
+        self.__type_counts['all_annotated'] += int((type_flags[:, 0] >= 0).sum())
+        self.__type_counts['all_correct'] += int((type_flags[:, 0] == 1).sum())
+        first_type_flags = type_flags[type_flags[:, 1] == 1, 0]
+        self.__type_counts['first_annotated'] += int((first_type_flags >= 0).sum())
+        self.__type_counts['first_correct'] += int((first_type_flags == 1).sum())
+
+        # Matches against the gold annotations of the same document only: the labels are interned as integers and
+        #  combined with the index of their document, so that a single `isin` on the whole batch gives the rows (and
+        #  the columns) with a match in the documents match matrices, without building them
+        self.__add_gold_matches(np, self.__entity_counts, [(doc[3], doc[0][2]) for doc in batch])
+        self.__add_gold_matches(np, self.__triple_counts, [(doc[6], doc[4][1]) for doc in batch])
+
+    @staticmethod
+    def __add_annotations(counts: dict[str, int], flags: np.ndarray):
+        # Flags columns: correctness, from the text and REBEL match, each one `-1` if not annotated
+        annotated = flags[:, 0] >= 0
+        counts['annotated'] += int(annotated.sum())
+        counts['correct'] += int((flags[:, 0] == 1).sum())
+        counts['from_text'] += int(((flags[:, 0] == 1) & (flags[:, 1] == 1)).sum())
+        counts['rebel_annotated'] += int((flags[:, 2] >= 0).sum())
+        counts['rebel_matches'] += int((flags[:, 2] == 1).sum())
+
+    @staticmethod
+    def __add_gold_matches(np, counts: dict[str, int], docs: list[tuple[list, list | None]]):
+        ids = dict()
+        predicted_keys, gold_keys = [], []
+        for doc_index, (predicted, gold) in enumerate(docs):
+            if gold is None:
+                continue
+            predicted_keys.extend([(doc_index, ids.setdefault(key, len(ids))) for key in predicted])
+            gold_keys.extend([(doc_index, ids.setdefault(key, len(ids))) for key in gold])
+        predicted_keys = _combine_keys(np, predicted_keys, len(ids))
+        gold_keys = np.unique(_combine_keys(np, gold_keys, len(ids)))
+        counts['gold_compared'] += len(predicted_keys)
+        counts['gold_matches'] += int(np.isin(predicted_keys, gold_keys).sum())
+        counts['gold_unique'] += len(gold_keys)
+        counts['gold_recalled'] += int(np.isin(gold_keys, predicted_keys).sum())
+
+
+def _summarize_record(record: dict) -> tuple:
+    # Only the annotation flags and the normalized labels of a record are kept until its batch is evaluated
+    entities, triples = record.get('entities', dict()), record.get('triples', dict())
+    gpt_entities, gpt_triples = entities.get('gpt', []), triples.get('gpt', [])
+    gold_entities, gold_triples = entities.get('gold'), triples.get('gold')
+
+    entity_flags, type_flags = [], []
+    for e in gpt_entities:
+        annotation = e.get('annotation')
+        entity_flags.append(_annotation_flags(annotation, 'entity correctness', 'description from text'))
+        type_correctness = annotation.get('type correctness', []) if annotation is not None else []
+        type_flags.extend([
+            (_flag(type_correctness[i]) if i < len(type_correctness) else -1, int(i == 0))
+            for i in range(len(e.get('types', [])))
+        ])
+    missed = entities.get('annotation', dict()).get('gpt missed', [])
+    entity_labels = [normalize_label(e['label']) for e in gpt_entities]
+    gold_entity_labels = [normalize_label(e['surfaceform']) for e in gold_entities] \
+        if gold_entities is not None else None
+
+    triple_flags = [
+        _annotation_flags(t.get('annotation'), 'triple correctness', 'relation from text') for t in gpt_triples
+    ]
+    triple_labels = [
+        (normalize_label(t['subject label']), normalize_label(t['object label'])) for t in gpt_triples
+    ]
+    gold_triple_labels = [
+        (normalize_label(t['subject']['surfaceform']), normalize_label(t['object']['surfaceform']))
+        for t in gold_triples
+    ] if gold_triples is not None else None
+
+    # As in the notebooks, the gold entities and triples are counted once per distinct surface form
+    n_gold_entities = len({e['surfaceform'] for e in gold_entities}) if gold_entities is not None else 0
+    n_gold_triples = len({
+        '|'.join([t[role]['surfaceform'].strip() for role in ['subject', 'predicate', 'object']]) for t in gold_triples
+    }) if gold_triples is not None else 0
+    return ((n_gold_entities, len(missed), gold_entity_labels), entity_flags, type_flags, entity_labels,
+            (n_gold_triples, gold_triple_labels), triple_flags, triple_labels)
+
+
+def _from_rebel_record(rebel_record: dict) -> dict:
+    return {
+        'doc': {
+            'id': rebel_record['docid'],
+            'uri': rebel_record.get('uri'),
+            'title': rebel_record.get('title'),
+            'text': rebel_record['text']
+        },
+        'entities': {'gpt': [], 'gold': rebel_record.get('entities', [])},
+        'triples': {'gpt': [], 'gold': rebel_record.get('triples', [])}
+    }
+
+
+def _annotation_flags(annotation: dict | None, correctness_key: str, from_text_key: str) -> tuple[int, int, int]:
+    if annotation is None:
+        return -1, -1, -1
+    return (_flag(annotation.get(correctness_key)), _flag(annotation.get(from_text_key)),
+            _flag(annotation.get('rebel match')))
+
+
+def _flag(value: bool | None) -> int:
+    return -1 if value is None else int(bool(value))
+
+
+def _flags_matrix(np, rows: list[tuple], n_columns: int) -> np.ndarray:
+    return np.array(rows, dtype=np.int8).reshape(len(rows), n_columns)
+
+
+def _combine_keys(np, keys: list[tuple[int, int]], n_ids: int) -> np.ndarray:
+    keys = np.array(keys, dtype=np.int64).reshape(-1, 2)
+    return keys[:, 0] * n_ids + keys[:, 1]
+
+
+def _ratio(numerator: float, denominator: float) -> float | None:
+    return numerator / denominator if denominator else None
+
+
+def _complement(ratio: float | None) -> float | None:
+    return 1 - ratio if ratio is not None else None
+
+
+def _import_numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise ImportError('The evaluation needs NumPy: install it with `pip install .[evaluation]`.') from None
+    return numpy
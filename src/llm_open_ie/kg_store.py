@@ -0,0 +1,469 @@
+from __future__ import annotations
+
+from array import array
+from pathlib import Path
+from typing import Iterator, Sequence
+import json
+import mmap
+import os
+import struct
+import sys
+
+from llm_open_ie.matching import normalize_label
+
+KG_STORE_MAGIC = b'LLMOIEKG'
+KG_STORE_VERSION = 1
+# Sections of the binary file are aligned to this number of bytes, so that each one can be cast to its item type
+SECTION_ALIGNMENT = 8
+# Item types of the id columns and of the offsets of the strings and of the posting lists
+ID_TYPECODE = 'I'
+OFFSET_TYPECODE = 'Q'
+# Id of the missing descriptions
+NO_ID = 2**32 - 1
+
+
+# Knowledge graph of a whole corpus, built incrementally from the output of the pipeline on each document. Entity
+#  labels, types, predicates and descriptions are interned into integer ids, while entities and triples are kept in
+#  array columns, with posting lists indexing the triples by subject, predicate and object.
+# The entities of different documents are merged when they have the same normalized label and share at least one type
+#  (or one of them has no types), joining their types; the same triple found again only increases its count.
+# The store can be saved to a compact binary file and loaded back by memory-mapping it: the queries read the mapped
+#  columns directly, and the store is only copied in memory when new documents are added.
+class KGStore:
+    __documents: int
+    __texts: _StringTable
+    __labels: _StringTable
+    __types: _StringTable
+    __predicates: _StringTable
+    __entity_labels: Sequence[int]
+    __entity_keys: Sequence[int]
+    __entity_descriptions: Sequence[int]
+    __entity_types: _PostingIndex
+    __label_index: _PostingIndex
+    __predicate_labels: Sequence[int]
+    __predicate_descriptions: Sequence[int]
+    __triple_subjects: Sequence[int]
+    __triple_predicates: Sequence[int]
+    __triple_objects: Sequence[int]
+    __triple_counts: Sequence[int]
+    __subject_index: _PostingIndex
+    __predicate_index: _PostingIndex
+    __object_index: _PostingIndex
+    __mapped_file: mmap.mmap | None
+
+    def __init__(self):
+        self.__documents = 0
+        # Display labels and descriptions, and the normalized keys of entity labels, types and predicates
+        self.__texts = _StringTable()
+        self.__labels = _StringTable()
+        self.__types = _StringTable()
+        self.__predicates = _StringTable()
+        self.__entity_labels = array(ID_TYPECODE)
+        self.__entity_keys = array(ID_TYPECODE)
+        self.__entity_descriptions = array(ID_TYPECODE)
+        self.__entity_types = _PostingIndex()
+        self.__label_index = _PostingIndex()
+        self.__predicate_labels = array(ID_TYPECODE)
+        self.__predicate_descriptions = array(ID_TYPECODE)
+        self.__triple_subjects = array(ID_TYPECODE)
+        self.__triple_predicates = array(ID_TYPECODE)
+        self.__triple_objects = array(ID_TYPECODE)
+        self.__triple_counts = array(ID_TYPECODE)
+        self.__subject_index = _PostingIndex()
+        self.__predicate_index = _PostingIndex()
+        self.__object_index = _PostingIndex()
+        self.__mapped_file = None
+
+    @property
+    def documents(self) -> int:
+        return self.__documents
+
+    @property
+    def num_entities(self) -> int:
+        return len(self.__entity_keys)
+
+    @property
+    def num_predicates(self) -> int:
+        return len(self.__predicate_labels)
+
+    @property
+    def num_triples(self) -> int:
+        return len(self.__triple_subjects)
+
+    def add_document(self, entities: list[dict], triplets: list[dict]) -> list[int]:
+        # Add the output of `oie_pipeline` on a document, returning the ids of its entities in the store. The subject
+        #  and object of the triplets are the entities of the document with their `subj_id` and `obj_id`; without
+        #  them (as in the records of the datasets), they are found by their label, and are added without types when
+        #  missing.
+        self.__thaw()
+        entity_ids = [self.__add_entity(e['label'], e.get('description'), e.get('types', [])) for e in entities]
+        doc_entity_ids = dict()
+        for e, e_id in zip(entities, entity_ids):
+            doc_entity_ids.setdefault(normalize_label(e['label']), []).append((e['label'].strip(), e_id))
+        for t_dict in triplets:
+            subject_id, object_id = [
+                entity_ids[t_dict[f'{role}_id']] if t_dict.get(f'{role}_id') is not None
+                else self.__document_entity(doc_entity_ids, t_dict[f'{role}_label'])
+                for role in ['subj', 'obj']
+            ]
+            self.__add_triple(subject_id, t_dict['pred_label'], t_dict.get('pred_description'), object_id)
+        self.__documents += 1
+        return entity_ids
+
+    def add_record(self, record: dict) -> list[int]:
+        # Add the `gpt` entities and triples of a record of the datasets, as written by `llm-open-ie run`
+        entities = record['entities']['gpt']
+        triplets = [
+            {
+                'subj_label': t['subject label'],
+                'pred_label': t['predicate label'],
+                'pred_description': t.get('predicate description'),
+                'obj_label': t['object label']
+            }
+            for t in record['triples']['gpt']
+        ]
+        return self.add_document(entities, triplets)
+
+    def find_entities(self, label: str) -> list[int]:
+        # Ids of the entities with the same normalized label (more than one if their types are disjoint)
+        key_id = self.__labels.get(normalize_label(label))
+        return list(self.__label_index.get(key_id)) if key_id is not None else []
+
+    def entity(self, entity_id: int) -> dict:
+        description_id = self.__entity_descriptions[entity_id]
+        return {
+            'id': entity_id,
+            'label': self.__texts[self.__entity_labels[entity_id]],
+            'description': self.__texts[description_id] if description_id != NO_ID else None,
+            'types': [self.__types[type_id] for type_id in self.__entity_types.get(entity_id)]
+        }
+
+    def triples(self, subj: str | int = None, pred: str = None, obj: str | int = None) -> Iterator[dict]:
+        # Triples with the given subject, predicate and object (any of them when not given), where subject and object
+        #  are either entity ids or labels. Only the shortest posting list among the given ones is scanned, while the
+        #  other conditions are checked on the columns; without any condition, all the triples are returned.
+        candidates = []
+        subject_ids = self.__entity_ids(subj)
+        if subject_ids is not None:
+            candidates.append(self.__postings(self.__subject_index, subject_ids))
+        predicate_id = None
+        if pred is not None:
+            predicate_id = self.__predicates.get(normalize_label(pred))
+            predicate_ids = [predicate_id] if predicate_id is not None else []
+            candidates.append(self.__postings(self.__predicate_index, predicate_ids))
+        object_ids = self.__entity_ids(obj)
+        if object_ids is not None:
+            candidates.append(self.__postings(self.__object_index, object_ids))
+
+        triple_ids = min(candidates, key=len) if candidates else range(self.num_triples)
+        for triple_id in triple_ids:
+            if subject_ids is not None and self.__triple_subjects[triple_id] not in subject_ids:
+                continue
+            if pred is not None and self.__triple_predicates[triple_id] != predicate_id:
+                continue
+            if object_ids is not None and self.__triple_objects[triple_id] not in object_ids:
+                continue
+            yield self.__triple(triple_id)
+
+    def save(self, path: str | Path):
+        # Written to a temporary file first, so that a store mapped from the same path keeps reading the old one
+        path = Path(path)
+        sections = dict()
+        for name, table in [('texts', self.__texts), ('labels', self.__labels), ('types', self.__types),
+                            ('predicates', self.__predicates)]:
+            offsets, blob, sorted_ids = table.sections()
+            sections.update({f'{name}_offsets': offsets, f'{name}_blob': blob, f'{name}_sorted_ids': sorted_ids})
+        for name, index, n_keys in [('entity_types', self.__entity_types, self.num_entities),
+                                    ('label_index', self.__label_index, len(self.__labels)),
+                                    ('subject_index', self.__subject_index, self.num_entities),
+                                    ('predicate_index', self.__predicate_index, self.num_predicates),
+                                    ('object_index', self.__object_index, self.num_entities)]:
+            offsets, ids = index.sections(n_keys)
+            sections.update({f'{name}_offsets': offsets, f'{name}_ids': ids})
+        for name in _COLUMNS:
+            sections[name] = _as_array(getattr(self, f'_KGStore__{name}'))
+
+        header = {
+            'version': KG_STORE_VERSION,
+            'byteorder': sys.byteorder,
+            'documents': self.__documents,
+            'sections': dict()
+        }
+        offset = 0
+        for name, section in sections.items():
+            nbytes = len(section) * section.itemsize if isinstance(section, array) else len(section)
+            header['sections'][name] = [offset, nbytes, section.typecode if isinstance(section, array) else 'B']
+            offset = _aligned(offset + nbytes)
+        header_bytes = json.dumps(header).encode('utf-8')
+        data_start = _aligned(len(KG_STORE_MAGIC) + 8 + len(header_bytes))
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(path.name + '.tmp')
+        with tmp_path.open('wb') as f:
+            f.write(KG_STORE_MAGIC + struct.pack('<Q', len(header_bytes)) + header_bytes)
+            for name, section in sections.items():
+                f.write(b'\0' * (data_start + header['sections'][name][0] - f.tell()))
+                f.write(section.tobytes() if isinstance(section, array) else section)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str | Path) -> KGStore:
+        # Memory-map a saved store: nothing is read until it is queried
+        with Path(path).open('rb') as f:
+            mapped_file = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        if mapped_file[:len(KG_STORE_MAGIC)] != KG_STORE_MAGIC:
+            raise ValueError(f'"{path}" is not a knowledge graph store.')
+        header_start = len(KG_STORE_MAGIC) + 8
+        header_length, = struct.unpack('<Q', mapped_file[len(KG_STORE_MAGIC):header_start])
+        header = json.loads(mapped_file[header_start:header_start + header_length].decode('utf-8'))
+        if header['version'] != KG_STORE_VERSION or header['byteorder'] != sys.byteorder:
+            raise ValueError(f'"{path}" was saved with version {header["version"]} on a {header["byteorder"]}-endian'
+                             f' machine: only version {KG_STORE_VERSION} on {sys.byteorder}-endian ones can be loaded.')
+
+        data_start = _aligned(header_start + header_length)
+        view = memoryview(mapped_file)
+        sections = {
+            name: view[data_start + offset:data_start + offset + nbytes].cast(typecode)
+            for name, (offset, nbytes, typecode) in header['sections'].items()
+        }
+
+        store = cls()
+        store.__documents = header['documents']
+        store.__mapped_file = mapped_file
+        for name in ['texts', 'labels', 'types', 'predicates']:
+            setattr(store, f'_KGStore__{name}', _StringTable.mapped(
+                sections[f'{name}_offsets'], sections[f'{name}_blob'], sections[f'{name}_sorted_ids']))
+        for name in ['entity_types', 'label_index', 'subject_index', 'predicate_index', 'object_index']:
+            setattr(store, f'_KGStore__{name}', _PostingIndex.mapped(
+                sections[f'{name}_offsets'], sections[f'{name}_ids']))
+        for name in _COLUMNS:
+            setattr(store, f'_KGStore__{name}', sections[name])
+        return store
+
+    def __thaw(self):
+        # Copy the mapped columns in memory before changing them
+        if self.__mapped_file is None:
+            return
+        for name in _COLUMNS:
+            setattr(self, f'_KGStore__{name}', _as_array(getattr(self, f'_KGStore__{name}')))
+        for table in [self.__texts, self.__labels, self.__types, self.__predicates]:
+            table.thaw()
+        for index in [self.__entity_types, self.__label_index, self.__subject_index, self.__predicate_index,
+                      self.__object_index]:
+            index.thaw()
+        self.__mapped_file = None
+
+    def __add_entity(self, label: str, description: str | None, types: list[str]) -> int:
+        key_id = self.__labels.intern(normalize_label(label))
+        type_ids = list(dict.fromkeys([self.__types.intern(t.strip().lower()) for t in types if t.strip()]))
+        for entity_id in self.__label_index.get(key_id):
+            entity_type_ids = self.__entity_types.get(entity_id)
+            if type_ids and entity_type_ids and not set(type_ids).intersection(entity_type_ids):
+                continue
+            for type_id in type_ids:
+                if type_id not in entity_type_ids:
+                    self.__entity_types.add(entity_id, type_id)
+            if self.__entity_descriptions[entity_id] == NO_ID and description:
+                self.__entity_descriptions[entity_id] = self.__texts.intern(description.strip())
+            return entity_id
+
+        entity_id = self.num_entities
+        self.__entity_labels.append(self.__texts.intern(label.strip()))
+        self.__entity_keys.append(key_id)
+        self.__entity_descriptions.append(self.__texts.intern(description.strip()) if description else NO_ID)
+        for type_id in type_ids:
+            self.__entity_types.add(entity_id, type_id)
+        self.__label_index.add(key_id, entity_id)
+        return entity_id
+
+    def __document_entity(self, doc_entity_ids: dict[str, list[tuple[str, int]]], label: str) -> int:
+        # Entity of the document with the same normalized label, preferring the one with the very same label when
+        #  more of them have it
+        candidates = doc_entity_ids.get(normalize_label(label))
+        if not candidates:
+            return self.__add_entity(label, None, [])
+        return next((e_id for e_label, e_id in candidates if e_label == label.strip()), candidates[0][1])
+
+    def __add_triple(self, subject_id: int, pred_label: str, pred_description: str | None, object_id: int):
+        predicate_id = self.__predicates.intern(normalize_label(pred_label))
+        if predicate_id == self.num_predicates:
+            self.__predicate_labels.append(self.__texts.intern(pred_label.strip()))
+            self.__predicate_descriptions.append(NO_ID)
+        if self.__predicate_descriptions[predicate_id] == NO_ID and pred_description:
+            self.__predicate_descriptions[predicate_id] = self.__texts.intern(pred_description.strip())
+
+        # The shortest posting list is scanned to find the same triple
+        subject_postings, object_postings = self.__subject_index.get(subject_id), self.__object_index.get(object_id)
+        for triple_id in min(subject_postings, object_postings, key=len):
+            if (self.__triple_subjects[triple_id] == subject_id and self.__triple_predicates[triple_id] == predicate_id
+                    and self.__triple_objects[triple_id] == object_id):
+                self.__triple_counts[triple_id] += 1
+                return
+
+        triple_id = self.num_triples
+        self.__triple_subjects.append(subject_id)
+        self.__triple_predicates.append(predicate_id)
+        self.__triple_objects.append(object_id)
+        self.__triple_counts.append(1)
+        self.__subject_index.add(subject_id, triple_id)
+        self.__predicate_index.add(predicate_id, triple_id)
+        self.__object_index.add(object_id, triple_id)
+
+    def __entity_ids(self, entity: str | int | None) -> set[int] | None:
+        if entity is None:
+            return None
+        return {entity} if isinstance(entity, int) else set(self.find_entities(entity))
+
+    @staticmethod
+    def __postings(index: _PostingIndex, keys: Sequence[int]) -> Sequence[int]:
+        if len(keys) == 1:
+            return index.get(next(iter(keys)))
+        return sorted([triple_id for key in keys for triple_id in index.get(key)])
+
+    def __triple(self, triple_id: int) -> dict:
+        subject_id, object_id = self.__triple_subjects[triple_id], self.__triple_objects[triple_id]
+        predicate_id = self.__triple_predicates[triple_id]
+        description_id = self.__predicate_descriptions[predicate_id]
+        return {
+            'subj_id': subject_id,
+            'subj_label': self.__texts[self.__entity_labels[subject_id]],
+            'pred_label': self.__texts[self.__predicate_labels[predicate_id]],
+            'pred_description': self.__texts[description_id] if description_id != NO_ID else None,
+            'obj_id': object_id,
+            'obj_label': self.__texts[self.__entity_labels[object_id]],
+            'count': self.__triple_counts[triple_id]
+        }
+
+
+# Id columns of the store, saved as they are
+_COLUMNS = [
+    'entity_labels', 'entity_keys', 'entity_descriptions', 'predicate_labels', 'predicate_descriptions',
+    'triple_subjects', 'triple_predicates', 'triple_objects', 'triple_counts'
+]
+
+
+# Interned strings, addressed by their id. Once mapped, the strings are decoded only when read, and looked up by a
+#  binary search on their ids sorted by their UTF-8 encoding, until a new string is interned.
+class _StringTable:
+    __ids: dict[str, int] | None
+    __strings: list[str] | None
+    __offsets: memoryview | None
+    __blob: memoryview | None
+    __sorted_ids: memoryview | None
+
+    def __init__(self):
+        self.__ids = dict()
+        self.__strings = []
+        self.__offsets = self.__blob = self.__sorted_ids = None
+
+    @classmethod
+    def mapped(cls, offsets: memoryview, blob: memoryview, sorted_ids: memoryview) -> _StringTable:
+        table = cls()
+        table.__ids = table.__strings = None
+        table.__offsets, table.__blob, table.__sorted_ids = offsets, blob, sorted_ids
+        return table
+
+    def __len__(self) -> int:
+        return len(self.__strings) if self.__strings is not None else len(self.__offsets) - 1
+
+    def __getitem__(self, string_id: int) -> str:
+        if self.__strings is not None:
+            return self.__strings[string_id]
+        return bytes(self.__encoded(string_id)).decode('utf-8')
+
+    def get(self, string: str) -> int | None:
+        if self.__ids is not None:
+            return self.__ids.get(string)
+        encoded = string.encode('utf-8')
+        low, high = 0, len(self.__sorted_ids)
+        while low < high:
+            middle = (low + high) // 2
+            middle_encoded = self.__encoded(self.__sorted_ids[middle])
+            if middle_encoded < encoded:
+                low = middle + 1
+            elif middle_encoded > encoded:
+                high = middle
+            else:
+                return self.__sorted_ids[middle]
+        return None
+
+    def intern(self, string: str) -> int:
+        self.thaw()
+        string_id = self.__ids.get(string)
+        if string_id is None:
+            string_id = self.__ids[string] = len(self.__strings)
+            self.__strings.append(string)
+        return string_id
+
+    def thaw(self):
+        if self.__strings is None:
+            self.__strings = [self[i] for i in range(len(self))]
+            self.__ids = {string: i for i, string in enumerate(self.__strings)}
+            self.__offsets = self.__blob = self.__sorted_ids = None
+
+    def sections(self) -> tuple[array, bytes, array]:
+        strings = self.__strings if self.__strings is not None else [self[i] for i in range(len(self))]
+        encoded_strings = [string.encode('utf-8') for string in strings]
+        offsets = array(OFFSET_TYPECODE, [0])
+        for encoded in encoded_strings:
+            offsets.append(offsets[-1] + len(encoded))
+        sorted_ids = array(ID_TYPECODE, sorted(range(len(strings)), key=encoded_strings.__getitem__))
+        return offsets, b''.join(encoded_strings), sorted_ids
+
+    def __encoded(self, string_id: int) -> bytes:
+        return self.__blob[self.__offsets[string_id]:self.__offsets[string_id + 1]].tobytes()
+
+
+# Lists of ids for each key (e.g. the triples of each subject). Once mapped, they are read from the concatenated lists
+#  and their offsets, until a new id is added.
+class _PostingIndex:
+    __postings: dict[int, array] | None
+    __offsets: memoryview | None
+    __ids: memoryview | None
+
+    def __init__(self):
+        self.__postings = dict()
+        self.__offsets = self.__ids = None
+
+    @classmethod
+    def mapped(cls, offsets: memoryview, ids: memoryview) -> _PostingIndex:
+        index = cls()
+        index.__postings = None
+        index.__offsets, index.__ids = offsets, ids
+        return index
+
+    def get(self, key: int) -> Sequence[int]:
+        if self.__postings is not None:
+            return self.__postings.get(key, ())
+        if key + 1 >= len(self.__offsets):
+            return ()
+        return self.__ids[self.__offsets[key]:self.__offsets[key + 1]]
+
+    def add(self, key: int, value: int):
+        self.thaw()
+        if key not in self.__postings:
+            self.__postings[key] = array(ID_TYPECODE)
+        self.__postings[key].append(value)
+
+    def thaw(self):
+        if self.__postings is None:
+            self.__postings = {
+                key: array(ID_TYPECODE, self.get(key))
+                for key in range(len(self.__offsets) - 1) if self.__offsets[key] < self.__offsets[key + 1]
+            }
+            self.__offsets = self.__ids = None
+
+    def sections(self, n_keys: int) -> tuple[array, array]:
+        offsets, ids = array(OFFSET_TYPECODE, [0]), array(ID_TYPECODE)
+        for key in range(n_keys):
+            ids.extend(self.get(key))
+            offsets.append(len(ids))
+        return offsets, ids
+
+
+def _as_array(column: Sequence[int]) -> array:
+    return column if isinstance(column, array) else array(ID_TYPECODE, column)
+
+
+def _aligned(offset: int) -> int:
+    return -(-offset // SECTION_ALIGNMENT) * SECTION_ALIGNMENT
@@ -1,6 +1,8 @@
 from __future__ import annotations
 
 from abc import ABC, abstractmethod
+from typing import AsyncIterator, Iterator
+import asyncio
 
 
 class LLM(ABC):
@@ -9,6 +11,24 @@ class LLM(ABC):
                         temperature: float = 0, top_p: float = 0, **kwargs):
         raise NotImplementedError
 
+    async def async_chat_completion(self, user: str | list[str], system: str = None,
+                                    temperature: float = 0, top_p: float = 0, **kwargs):
+        # Fallback for implementations without a native asynchronous client: run the blocking call in a worker thread
+        return await asyncio.to_thread(
+            self.chat_completion, user, system=system, temperature=temperature, top_p=top_p, **kwargs)
+
+    def stream_chat_completion(self, user: str | list[str], system: str = None,
+                               temperature: float = 0, top_p: float = 0, **kwargs) -> Iterator[str]:
+        # Fallback for implementations without streaming: yield the lines of the answer once it is complete
+        answer = self.chat_completion(user, system=system, temperature=temperature, top_p=top_p, **kwargs)
+        yield from answer.split('\n')
+
+    async def async_stream_chat_completion(self, user: str | list[str], system: str = None,
+                                           temperature: float = 0, top_p: float = 0, **kwargs) -> AsyncIterator[str]:
+        answer = await self.async_chat_completion(user, system=system, temperature=temperature, top_p=top_p, **kwargs)
+        for line in answer.split('\n'):
+            yield line
+
     @abstractmethod
     def get_num_tokens(self, text):
         raise NotImplementedError
@@ -19,6 +39,10 @@ class LLMOpenIE(LLM):
     def entity_extraction(self, text: str, output_language: str) -> list[dict]:
         raise NotImplementedError
 
+    def iter_entity_extraction(self, text: str, output_language: str) -> Iterator[dict]:
+        # Implementations able to stream the answer can override this to yield each entity as soon as it is generated
+        yield from self.entity_extraction(text, output_language)
+
     @abstractmethod
     def phrase_selection(self, text: str, entity_id: int, entities: list[dict]) -> str:
         raise NotImplementedError
@@ -27,6 +51,10 @@ class LLMOpenIE(LLM):
     def mention_recognition(self, sentence: str, entities: list[dict]) -> list[int]:
         raise NotImplementedError
 
+    def mention_recognition_batch(self, sentences: list[str], entities: list[dict]) -> list[list[int]]:
+        # Implementations able to check many sentences with a single request can override this
+        return [self.mention_recognition(sentence, entities) for sentence in sentences]
+
     @abstractmethod
     def relation_extraction(self, sentence: str, sentence_entities_ids: list[int],
                             entities: list[dict], output_language: str) -> list[dict]:
@@ -35,3 +63,46 @@ class LLMOpenIE(LLM):
     @abstractmethod
     def predicate_description(self, sentence: str, triplets: list[dict], output_language: str) -> None:
         raise NotImplementedError
+
+    def fused_relation_extraction(self, sentence: str, sentence_entities_ids: list[int],
+                                  entities: list[dict], output_language: str) -> list[dict]:
+        # Relations together with the descriptions of their predicates: implementations able to get both with a single
+        #  request can override this, falling back to the two separate stages
+        triplets = self.relation_extraction(sentence, sentence_entities_ids, entities, output_language)
+        if triplets:
+            self.predicate_description(sentence, triplets, output_language)
+        return triplets
+
+    # Asynchronous counterparts of the stages: by default they run the blocking stage in a worker thread, so that any
+    #  implementation can be used by `async_oie_pipeline`; override them when a native asynchronous path is available
+
+    async def async_entity_extraction(self, text: str, output_language: str) -> list[dict]:
+        return await asyncio.to_thread(self.entity_extraction, text, output_language)
+
+    async def async_iter_entity_extraction(self, text: str, output_language: str) -> AsyncIterator[dict]:
+        for e_dict in await self.async_entity_extraction(text, output_language):
+            yield e_dict
+
+    async def async_phrase_selection(self, text: str, entity_id: int, entities: list[dict]) -> str:
+        return await asyncio.to_thread(self.phrase_selection, text, entity_id, entities)
+
+    async def async_mention_recognition(self, sentence: str, entities: list[dict]) -> list[int]:
+        return await asyncio.to_thread(self.mention_recognition, sentence, entities)
+
+    async def async_mention_recognition_batch(self, sentences: list[str], entities: list[dict]) -> list[list[int]]:
+        return await asyncio.to_thread(self.mention_recognition_batch, sentences, entities)
+
+    async def async_relation_extraction(self, sentence: str, sentence_entities_ids: list[int],
+                                        entities: list[dict], output_language: str) -> list[dict]:
+        return await asyncio.to_thread(
+            self.relation_extraction, sentence, sentence_entities_ids, entities, output_language)
+
+    async def async_predicate_description(self, sentence: str, triplets: list[dict], output_language: str) -> None:
+        await asyncio.to_thread(self.predicate_description, sentence, triplets, output_language)
+
+    async def async_fused_relation_extraction(self, sentence: str, sentence_entities_ids: list[int],
+                                              entities: list[dict], output_language: str) -> list[dict]:
+        triplets = await self.async_relation_extraction(sentence, sentence_entities_ids, entities, output_language)
+        if triplets:
+            await self.async_predicate_description(sentence, triplets, output_language)
+        return triplets
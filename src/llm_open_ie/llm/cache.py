@@ -0,0 +1,143 @@
+from __future__ import annotations
+
+from hashlib import sha256
+from pathlib import Path
+import json
+import sqlite3
+import threading
+import time
+
+CACHE_MODES = ['read_write', 'read_only']
+
+
+# Persistent store of chat completions, addressed by the hash of everything that determines the answer (model, prompts
+#  and sampling parameters). It lives in a single SQLite file, so it can be shared by threads and processes, and it
+#  evicts the least recently used answers once its content exceeds `max_size_bytes`.
+# In `read_write` mode the new answers are written through to disk as soon as they are received, while in `read_only`
+#  mode the cache is only looked up (e.g. to replay a frozen evaluation run).
+class CompletionCache:
+    __path: Path
+    __mode: str
+    __max_size_bytes: int | None
+    __size_bytes: int
+    __hits: int
+    __misses: int
+    __connection: sqlite3.Connection
+    __lock: threading.Lock
+
+    def __init__(self, path: str | Path, mode: str = 'read_write', max_size_bytes: int = None):
+        if mode not in CACHE_MODES:
+            options_str = ', '.join([f'`{v}`' for v in CACHE_MODES])
+            raise ValueError(f'`{mode}` is not a valid option: choose one between {options_str}')
+
+        self.__path = Path(path)
+        self.__mode = mode
+        self.__max_size_bytes = max_size_bytes
+        self.__hits = 0
+        self.__misses = 0
+        self.__lock = threading.Lock()
+
+        if mode == 'read_only':
+            # Nothing is created in `read_only` mode: a missing cache most likely means a wrong path
+            if not self.__path.is_file():
+                raise ValueError(f'The cache "{self.__path}" does not exist: it cannot be opened in `read_only` mode.')
+            self.__connection = sqlite3.connect(
+                f'{self.__path.resolve().as_uri()}?mode=ro', uri=True, check_same_thread=False)
+            if not self.__has_completions_table():
+                self.__connection.close()
+                raise ValueError(f'"{self.__path}" is not a completion cache: it has no `completions` table.')
+        else:
+            self.__path.parent.mkdir(parents=True, exist_ok=True)
+            self.__connection = sqlite3.connect(self.__path, timeout=30, check_same_thread=False)
+            self.__connection.execute('PRAGMA journal_mode=WAL')
+            self.__connection.execute(
+                'CREATE TABLE IF NOT EXISTS completions ('
+                ' key TEXT PRIMARY KEY, answer TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)')
+            self.__connection.execute('CREATE INDEX IF NOT EXISTS completions_lru ON completions (last_access)')
+            self.__connection.commit()
+        self.__size_bytes = self.__connection.execute('SELECT COALESCE(SUM(size), 0) FROM completions').fetchone()[0]
+
+    @staticmethod
+    def make_key(model: str, system: str | None, user: str, **sampling_params) -> str:
+        key_content = json.dumps(
+            {'model': model, 'system': system, 'user': user, 'params': sampling_params},
+            sort_keys=True, ensure_ascii=False)
+        return sha256(key_content.encode('utf-8')).hexdigest()
+
+    @property
+    def mode(self) -> str:
+        return self.__mode
+
+    @property
+    def hits(self) -> int:
+        return self.__hits
+
+    @property
+    def misses(self) -> int:
+        return self.__misses
+
+    @property
+    def size_bytes(self) -> int:
+        return self.__size_bytes
+
+    def stats(self) -> dict:
+        n_lookups = self.__hits + self.__misses
+        return {
+            'hits': self.__hits,
+            'misses': self.__misses,
+            'hit_ratio': self.__hits / n_lookups if n_lookups else 0.0,
+            'size_bytes': self.__size_bytes
+        }
+
+    def get(self, key: str) -> str | None:
+        with self.__lock:
+            row = self.__connection.execute('SELECT answer FROM completions WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.__misses += 1
+                return None
+            self.__hits += 1
+            if self.__mode == 'read_write':
+                self.__connection.execute('UPDATE completions SET last_access = ? WHERE key = ?', (time.time(), key))
+                self.__connection.commit()
+            return row[0]
+
+    def put(self, key: str, answer: str):
+        if self.__mode == 'read_only':
+            return
+        size = len(answer.encode('utf-8'))
+        with self.__lock:
+            old_row = self.__connection.execute('SELECT size FROM completions WHERE key = ?', (key,)).fetchone()
+            self.__connection.execute(
+                'INSERT OR REPLACE INTO completions (key, answer, size, last_access) VALUES (?, ?, ?, ?)',
+                (key, answer, size, time.time()))
+            self.__size_bytes += size - (old_row[0] if old_row else 0)
+            self.__evict()
+            self.__connection.commit()
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+    def __has_completions_table(self) -> bool:
+        try:
+            return self.__connection.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'completions'").fetchone() is not None
+        except sqlite3.DatabaseError:
+            # Not a SQLite file at all
+            return False
+
+    def __evict(self):
+        # Drop the least recently used answers until the content fits again the maximum size
+        if self.__max_size_bytes is None or self.__size_bytes <= self.__max_size_bytes:
+            return
+        # Other processes may be writing on the same file: count again before choosing what to drop
+        self.__size_bytes = self.__connection.execute('SELECT COALESCE(SUM(size), 0) FROM completions').fetchone()[0]
+        cursor = self.__connection.execute('SELECT key, size FROM completions ORDER BY last_access')
+        evicted_keys = []
+        for key, size in cursor:
+            if self.__size_bytes <= self.__max_size_bytes:
+                break
+            evicted_keys.append((key,))
+            self.__size_bytes -= size
+        cursor.close()
+        self.__connection.executemany('DELETE FROM completions WHERE key = ?', evicted_keys)
@@ -0,0 +1,142 @@
+from __future__ import annotations
+
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Awaitable, Callable, Iterator, TypeVar
+import asyncio
+import contextvars
+import threading
+
+from llm_open_ie.metrics import record_hedge
+
+# Latencies kept for each stage, the most recent ones, to estimate its percentiles
+LATENCY_WINDOW = 512
+# Latencies needed before a percentile of a stage is trusted
+MIN_LATENCY_SAMPLES = 20
+
+T = TypeVar('T')
+
+# Retry budget of the document processed in the current context, shared by its worker threads and tasks
+_current_retry_budget: ContextVar[RetryBudget | None] = ContextVar('current_retry_budget', default=None)
+
+
+# Retries left to the requests of a document: once they are spent, a failed request is not sent again and its error
+#  fails the document, instead of retrying for as long as the errors last
+class RetryBudget:
+    __max_retries: int
+    __retries: int
+    __lock: threading.Lock
+
+    def __init__(self, max_retries: int):
+        if max_retries < 0:
+            raise ValueError(f'`max_retries` must be a non-negative integer, got {max_retries}.')
+        self.__max_retries = max_retries
+        self.__retries = 0
+        self.__lock = threading.Lock()
+
+    @property
+    def max_retries(self) -> int:
+        return self.__max_retries
+
+    @property
+    def retries(self) -> int:
+        return self.__retries
+
+    def spend(self) -> bool:
+        with self.__lock:
+            if self.__retries >= self.__max_retries:
+                return False
+            self.__retries += 1
+            return True
+
+
+@contextmanager
+def retry_budget_scope(max_retries: int | None) -> Iterator[RetryBudget | None]:
+    # Limit the retries of the requests of the current context (no limit with `None`)
+    budget = RetryBudget(max_retries) if max_retries is not None else None
+    token = _current_retry_budget.set(budget)
+    try:
+        yield budget
+    finally:
+        _current_retry_budget.reset(token)
+
+
+def spend_retry() -> bool:
+    budget = _current_retry_budget.get()
+    return budget is None or budget.spend()
+
+
+# Latencies of the most recent requests of each stage, to tell when a request is slow for its stage
+class LatencyTracker:
+    __latencies: dict[str, deque[float]]
+    __lock: threading.Lock
+
+    def __init__(self):
+        self.__latencies = dict()
+        self.__lock = threading.Lock()
+
+    def add(self, stage: str, latency: float):
+        with self.__lock:
+            self.__latencies.setdefault(stage, deque(maxlen=LATENCY_WINDOW)).append(latency)
+
+    def quantile(self, stage: str, q: float) -> float | None:
+        # `None` until enough latencies of the stage are known
+        with self.__lock:
+            latencies = sorted(self.__latencies.get(stage, []))
+        if len(latencies) < MIN_LATENCY_SAMPLES:
+            return None
+        return latencies[min(len(latencies) - 1, int(q * len(latencies)))]
+
+
+def hedged_call(request: Callable[[threading.Event], T], hedge_after: float) -> T:
+    # Run `request` in a worker thread and, if it is not over after `hedge_after` seconds, a duplicate of it in another
+    #  one: the first to succeed wins. The other one is told (by the event passed to `request`) to stop before its next
+    #  attempt, since a request already sent cannot be interrupted: it is left to end in the background.
+    cancel_event = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='llm-open-ie-hedge')
+    try:
+        futures = [executor.submit(contextvars.copy_context().run, request, cancel_event)]
+        if not wait(futures, timeout=hedge_after).done:
+            futures.append(executor.submit(contextvars.copy_context().run, request, cancel_event))
+        error, pending = None, set(futures)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    _record_hedge(futures, future)
+                    return future.result()
+                error = error if error is not None else future.exception()
+        _record_hedge(futures, None)
+        raise error
+    finally:
+        cancel_event.set()
+        executor.shutdown(wait=False)
+
+
+async def async_hedged_call(request: Callable[[], Awaitable[T]], hedge_after: float) -> T:
+    # Same as `hedged_call`, but the losing request is cancelled right away
+    tasks = [asyncio.create_task(request())]
+    try:
+        done, _ = await asyncio.wait(tasks, timeout=hedge_after)
+        if not done:
+            tasks.append(asyncio.create_task(request()))
+        error, pending = None, set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    _record_hedge(tasks, task)
+                    return task.result()
+                error = error if error is not None else task.exception()
+        _record_hedge(tasks, None)
+        raise error
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def _record_hedge(calls: list, winner):
+    if len(calls) > 1:
+        record_hedge(won=winner is calls[1])
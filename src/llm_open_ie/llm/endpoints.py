@@ -0,0 +1,220 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import TYPE_CHECKING
+import json
+import os
+import threading
+import time
+
+from llm_open_ie.llm.rate_limiter import RateLimiter
+from llm_open_ie.logger import LOGGER
+
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI, OpenAI
+
+# Connections kept open by the HTTP clients of each endpoint, reused by its consecutive requests
+MAX_CONNECTIONS = 100
+
+
+# OpenAI-compatible backend of the chat completions: an API key, the base URL of its server (OpenAI itself when not
+#  set, or e.g. a local server exposing the same API) and the rate budget of that key. Its clients are created on the
+#  first request and then reused, together with their pool of HTTP connections. Ready-made `client` and `async_client`
+#  can be given instead (e.g. to record or replay the answers), in which case the API key is not needed.
+class Endpoint:
+    __name: str
+    __api_key: str | None
+    __base_url: str | None
+    __rate_limiter: RateLimiter
+    __max_connections: int
+    __client: OpenAI | None
+    __async_client: AsyncOpenAI | None
+    __requests: int
+    __failures: int
+    __in_flight: int
+    __consecutive_failures: int
+    __unhealthy_until_timestamp: float
+    __lock: threading.Lock
+
+    def __init__(self, api_key: str = None, base_url: str = None, rate_limiter: RateLimiter = None, name: str = None,
+                 max_connections: int = MAX_CONNECTIONS, client: OpenAI = None, async_client: AsyncOpenAI = None):
+        if api_key is None and (client is None or async_client is None):
+            raise ValueError('`api_key` is needed, unless both `client` and `async_client` are given.')
+
+        self.__name = name if name is not None else (base_url or 'openai')
+        self.__api_key = api_key
+        self.__base_url = base_url
+        self.__rate_limiter = rate_limiter if rate_limiter is not None else RateLimiter()
+        self.__max_connections = max_connections
+        self.__client = client
+        self.__async_client = async_client
+        self.__requests = 0
+        self.__failures = 0
+        self.__in_flight = 0
+        self.__consecutive_failures = 0
+        self.__unhealthy_until_timestamp = 0.0
+        self.__lock = threading.Lock()
+
+    @property
+    def name(self) -> str:
+        return self.__name
+
+    @property
+    def rate_limiter(self) -> RateLimiter:
+        return self.__rate_limiter
+
+    @property
+    def client(self) -> OpenAI:
+        if self.__client is None:
+            from openai import OpenAI
+            import httpx
+            with self.__lock:
+                if self.__client is None:
+                    # Retries are handled by `GPTOpenIE`, on the rate limiters, instead of inside the clients
+                    self.__client = OpenAI(
+                        api_key=self.__api_key, base_url=self.__base_url, max_retries=0,
+                        http_client=httpx.Client(limits=self.__limits()))
+        return self.__client
+
+    @property
+    def async_client(self) -> AsyncOpenAI:
+        if self.__async_client is None:
+            from openai import AsyncOpenAI
+            import httpx
+            with self.__lock:
+                if self.__async_client is None:
+                    self.__async_client = AsyncOpenAI(
+                        api_key=self.__api_key, base_url=self.__base_url, max_retries=0,
+                        http_client=httpx.AsyncClient(limits=self.__limits()))
+        return self.__async_client
+
+    def is_healthy(self) -> bool:
+        return time.monotonic() >= self.__unhealthy_until_timestamp
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {
+                'requests': self.__requests,
+                'failures': self.__failures,
+                'in_flight': self.__in_flight,
+                'healthy': self.is_healthy()
+            }
+
+    def _start_request(self):
+        with self.__lock:
+            self.__requests += 1
+            self.__in_flight += 1
+
+    def _end_request(self, is_failed: bool | None, failure_threshold: int, cooldown_seconds: float,
+                     disable: bool = False):
+        # After `failure_threshold` consecutive failures (or a single one with `disable`), the endpoint is left out
+        #  for `cooldown_seconds`; then it is tried again, and a single failure is enough to leave it out again
+        with self.__lock:
+            self.__in_flight -= 1
+            if is_failed is None:
+                return
+            if not is_failed:
+                self.__consecutive_failures = 0
+                return
+            self.__failures += 1
+            self.__consecutive_failures += 1
+            if disable or self.__consecutive_failures >= failure_threshold:
+                self.__unhealthy_until_timestamp = time.monotonic() + cooldown_seconds
+                LOGGER.warning(f'Endpoint "{self.__name}" left out for {cooldown_seconds:.0f} seconds after'
+                               f' {self.__consecutive_failures} consecutive failures.')
+
+    def _load(self, num_tokens: int) -> tuple[float, int, int]:
+        return self.__rate_limiter.estimate_wait(num_tokens), self.__in_flight, self.__requests
+
+    def _unhealthy_until(self) -> float:
+        return self.__unhealthy_until_timestamp
+
+    def __limits(self):
+        import httpx
+        return httpx.Limits(max_connections=self.__max_connections, max_keepalive_connections=self.__max_connections)
+
+
+# Endpoints sharing the requests of a `GPTOpenIE`: each request is sent to the healthy endpoint whose rate budget would
+#  make it wait the least (then with the fewest requests in flight, then sent so far), so that the throughput adds up
+#  across API keys and servers. The endpoints failing repeatedly are left out for a while, and the failed requests are
+#  sent again to the other endpoints right away.
+class EndpointPool:
+    __endpoints: list[Endpoint]
+    __failure_threshold: int
+    __cooldown_seconds: float
+
+    def __init__(self, endpoints: list[Endpoint], failure_threshold: int = 3, cooldown_seconds: float = 30.0):
+        if not endpoints:
+            raise ValueError('An endpoint pool needs at least an endpoint.')
+        if len({e.name for e in endpoints}) < len(endpoints):
+            raise ValueError('The endpoints of a pool must have different names.')
+        if failure_threshold < 1:
+            raise ValueError(f'`failure_threshold` must be a positive integer, got {failure_threshold}.')
+
+        self.__endpoints = list(endpoints)
+        self.__failure_threshold = failure_threshold
+        self.__cooldown_seconds = cooldown_seconds
+
+    @property
+    def endpoints(self) -> list[Endpoint]:
+        return list(self.__endpoints)
+
+    def select(self, num_tokens: int = 0, exclude: Endpoint = None) -> Endpoint:
+        # When every endpoint is left out, the one whose cooldown ends first is tried anyway; `exclude` (e.g. the
+        #  endpoint a request has just failed on) is only chosen when it is the only healthy one
+        healthy_endpoints = [e for e in self.__endpoints if e.is_healthy()]
+        if not healthy_endpoints:
+            return min(self.__endpoints, key=lambda e: e._unhealthy_until())
+        other_endpoints = [e for e in healthy_endpoints if e is not exclude]
+        return min(other_endpoints or healthy_endpoints, key=lambda e: e._load(num_tokens))
+
+    def acquire(self, num_tokens: int = 0, exclude: Endpoint = None) -> tuple[Endpoint, float]:
+        # Choose the endpoint of a request and wait for its rate budget; return it with the waited time
+        endpoint = self.select(num_tokens, exclude)
+        wait = endpoint.rate_limiter.acquire(num_tokens)
+        endpoint._start_request()
+        return endpoint, wait
+
+    async def async_acquire(self, num_tokens: int = 0, exclude: Endpoint = None) -> tuple[Endpoint, float]:
+        endpoint = self.select(num_tokens, exclude)
+        wait = await endpoint.rate_limiter.async_acquire(num_tokens)
+        endpoint._start_request()
+        return endpoint, wait
+
+    def report_success(self, endpoint: Endpoint):
+        endpoint._end_request(False, self.__failure_threshold, self.__cooldown_seconds)
+
+    def release(self, endpoint: Endpoint):
+        # End a request that says nothing about the health of its endpoint (e.g. a rate limit or a client error)
+        endpoint._end_request(None, self.__failure_threshold, self.__cooldown_seconds)
+
+    def report_failure(self, endpoint: Endpoint, disable: bool = False):
+        # `disable` leaves the endpoint out right away, e.g. when its API key is rejected or its quota is exhausted
+        endpoint._end_request(True, self.__failure_threshold, self.__cooldown_seconds, disable=disable)
+
+    def has_alternative(self, endpoint: Endpoint) -> bool:
+        return any([e is not endpoint and e.is_healthy() for e in self.__endpoints])
+
+    def stats(self) -> dict:
+        return {e.name: e.stats() for e in self.__endpoints}
+
+
+def read_endpoint_pool(path: str | Path, budget_share: float = 1.0, **pool_kwargs) -> EndpointPool:
+    # Pool of the endpoints listed in a JSON file, each one as an object with an optional `name` and `base_url`, the
+    #  `api_key` (or the `api_key_env` variable holding it, `OPENAI_API_KEY` by default), and its optional `rpm`,
+    #  `tpm` and `max_connections`. Only a `budget_share` of the rate budgets is used, e.g. when many processes share
+    #  the same endpoints.
+    with Path(path).open('r', encoding='utf-8') as f:
+        entries = json.load(f)
+    endpoints = []
+    for i, entry in enumerate(entries):
+        api_key = entry.get('api_key') or os.environ.get(entry.get('api_key_env', 'OPENAI_API_KEY'))
+        if not api_key:
+            raise ValueError(f'Endpoint {i} in "{path}" has no `api_key`, nor a set `api_key_env` variable.')
+        rate_limiter = RateLimiter(
+            requests_per_minute=entry.get('rpm', 3_500) * budget_share,
+            tokens_per_minute=entry.get('tpm', 90_000) * budget_share)
+        endpoints.append(Endpoint(
+            api_key=api_key, base_url=entry.get('base_url'), rate_limiter=rate_limiter, name=entry.get('name'),
+            max_connections=entry.get('max_connections', MAX_CONNECTIONS)))
+    return EndpointPool(endpoints, **pool_kwargs)
@@ -1,90 +1,739 @@
+from __future__ import annotations
+
+from email.utils import parsedate_to_datetime
+from functools import cache, partial
 from getpass import getpass
+from typing import TYPE_CHECKING, AsyncIterator, Callable, Iterator
+import asyncio
 import os
+import threading
 import time
 
-from openai import OpenAI, OpenAIError, APIError, RateLimitError
-import tiktoken
-
 from llm_open_ie.llm import LLMOpenIE
+from llm_open_ie.llm.cache import CompletionCache
+from llm_open_ie.llm.deadlines import LatencyTracker, async_hedged_call, hedged_call, spend_retry
+from llm_open_ie.llm.endpoints import Endpoint, EndpointPool
+from llm_open_ie.llm.rate_limiter import RateLimiter
+from llm_open_ie.llm.routing import ModelRoute, ModelRouter
 from llm_open_ie.logger import LOGGER
+from llm_open_ie.mention_index import MENTION_POLICIES, MentionIndexStats
+from llm_open_ie.metrics import (
+    async_iter_in_stage, current_stage, iter_in_stage, record_call, record_escalation, stage_scope)
+from llm_open_ie.predicate_registry import PredicateRegistry
+
+# `openai` and `tiktoken` are only imported when the first request is sent or the first tokens are counted
+if TYPE_CHECKING:
+    from openai import AsyncOpenAI, OpenAI, OpenAIError
+    import tiktoken
+
+DEFAULT_MODEL = 'gpt-3.5-turbo-0301'
+# Tokens booked on the rate limiter for the answer of a request, whose actual length is only known afterwards
+EXPECTED_COMPLETION_TOKENS = 256
+# Tokens added by the chat format to each message, on top of its content
+MESSAGE_OVERHEAD_TOKENS = 4
 
 
 class GPTOpenIE(LLMOpenIE):
-    __last_request_timestamp: float
-    __rate_limit_sleep: float
-    __client: OpenAI
-    __encoder: tiktoken.Encoding
-
-    def __init__(self, api_key_input: str = 'environ', rate_limit_sleep: float = 10.0):
-        api_key_input_values = ['environ', 'keyboard']
-        if api_key_input == api_key_input_values[0]:
-            openai_api_key = os.environ.get('OPENAI_API_KEY', None)
-            if not openai_api_key:
-                raise ValueError(
-                    '`api_key_input` is set to `environ`, but the environmental variable `OPENAI_API_KEY` is not set.')
-        elif api_key_input == api_key_input_values[1]:
-            openai_api_key = getpass(prompt='Insert your OpenAI API key: ')
+    __endpoints: EndpointPool
+    __model: str
+    __cache: CompletionCache | None
+    __entity_chunk_tokens: dict
+    __mention_policy: str
+    __mention_index_stats: MentionIndexStats
+    __predicate_registry: PredicateRegistry | None
+    __max_prompt_tokens: int | None
+    __request_timeout: float | None
+    __call_deadline: float | None
+    __hedge_after: float | None
+    __hedge_quantile: float | None
+    __latencies: LatencyTracker
+    __router: ModelRouter | None
+
+    def __init__(self, api_key_input: str = 'environ', rate_limit_sleep: float = None, *,
+                 rate_limiter: RateLimiter = None, cache: CompletionCache = None,
+                 max_chunk_tokens: int = None, chunk_overlap_tokens: int = None, mention_policy: str = 'off',
+                 predicate_registry: PredicateRegistry = None, model: str = DEFAULT_MODEL,
+                 endpoints: EndpointPool = None, client: OpenAI = None, async_client: AsyncOpenAI = None,
+                 max_prompt_tokens: int = None, request_timeout: float = None, call_deadline: float = None,
+                 hedge_after: float = None, hedge_quantile: float = None, router: ModelRouter = None):
+        # The requests are sent to the `endpoints` of the pool (API keys and OpenAI-compatible servers, each with its
+        #  own rate budget), or else to OpenAI with a single API key, limited by `rate_limiter`
+        if endpoints is not None:
+            if any([v is not None for v in [rate_limiter, rate_limit_sleep, client, async_client]]):
+                raise ValueError('`endpoints` cannot be set together with `rate_limiter`, `rate_limit_sleep`, `client`'
+                                 ' or `async_client`: set them on its endpoints instead.')
         else:
-            options_str = ', '.join([f'`{v}`' for v in api_key_input_values])
-            raise ValueError(f'`{api_key_input}` is not a valid option: choose one between {options_str}')
+            if rate_limiter is None:
+                # `rate_limit_sleep` is kept for backward compatibility: a fixed sleep between requests is a RPM budget
+                rate_limiter = RateLimiter() if rate_limit_sleep is None else RateLimiter(
+                    requests_per_minute=60 / rate_limit_sleep if rate_limit_sleep > 0 else float('inf'))
+            elif rate_limit_sleep is not None:
+                raise ValueError('`rate_limiter` and `rate_limit_sleep` cannot be both set.')
+            # `client` and `async_client` replace the OpenAI clients (e.g. to record or replay the answers): the API
+            #  key is only needed for the missing ones, which are created on their first request
+            openai_api_key = get_api_key(api_key_input) if client is None or async_client is None else None
+            endpoints = EndpointPool([Endpoint(
+                api_key=openai_api_key, rate_limiter=rate_limiter, client=client, async_client=async_client)])
+
+        if mention_policy not in MENTION_POLICIES:
+            options_str = ', '.join([f'`{v}`' for v in MENTION_POLICIES])
+            raise ValueError(f'`{mention_policy}` is not a valid option: choose one between {options_str}')
+        if max_prompt_tokens is not None and max_prompt_tokens < 1:
+            raise ValueError(f'`max_prompt_tokens` must be a positive integer, got {max_prompt_tokens}.')
+        for name, seconds in [('request_timeout', request_timeout), ('call_deadline', call_deadline),
+                              ('hedge_after', hedge_after)]:
+            if seconds is not None and seconds <= 0:
+                raise ValueError(f'`{name}` must be a positive number of seconds, got {seconds}.')
+        if hedge_quantile is not None and not 0 < hedge_quantile < 1:
+            raise ValueError(f'`hedge_quantile` must be between 0 and 1 (both excluded), got {hedge_quantile}.')
+
+        self.__endpoints = endpoints
+        self.__model = model
+        self.__cache = cache
+        # Chunking of the long texts in the entity extraction (stage defaults when not set)
+        self.__entity_chunk_tokens = {
+            k: v for k, v in [('max_chunk_tokens', max_chunk_tokens), ('chunk_overlap_tokens', chunk_overlap_tokens)]
+            if v is not None
+        }
+        # Lexical pre-check of the mentions, before (or instead of) asking the LLM
+        self.__mention_policy = mention_policy
+        self.__mention_index_stats = MentionIndexStats()
+        # Descriptions of the predicates already described, in this or in other documents
+        self.__predicate_registry = predicate_registry
+        # Budget of the prompt tokens of each request: longer candidate lists are split across more requests
+        self.__max_prompt_tokens = max_prompt_tokens
+        # Time limits of each request and of each call, including its retries (no limit when not set)
+        self.__request_timeout = request_timeout
+        self.__call_deadline = call_deadline
+        # A duplicate of a request is sent when it is not answered within the `hedge_quantile` of the latencies of its
+        #  stage, or within `hedge_after` seconds until enough latencies are known (no duplicates when neither is set)
+        self.__hedge_after = hedge_after
+        self.__hedge_quantile = hedge_quantile
+        self.__latencies = LatencyTracker()
+        # Model, endpoints and answer tokens ceiling of the requests of each stage (the ones of the LLM when not set)
+        self.__router = router
+
+    @property
+    def rate_limiter(self) -> RateLimiter:
+        # Rate limiter of the first endpoint, i.e. the only one unless a pool of endpoints is given
+        return self.__endpoints.endpoints[0].rate_limiter
+
+    @property
+    def endpoints(self) -> EndpointPool:
+        return self.__endpoints
+
+    @property
+    def model(self) -> str:
+        return self.__model
+
+    @property
+    def router(self) -> ModelRouter | None:
+        return self.__router
+
+    @property
+    def routing_stats(self) -> dict | None:
+        # Calls of each model in each stage, with the latency and the tokens moved off the model of the LLM
+        return self.__router.stats.as_dict(self.__model) if self.__router is not None else None
+
+    @property
+    def cache(self) -> CompletionCache | None:
+        return self.__cache
 
-        self.__last_request_timestamp = 0.0
-        self.__rate_limit_sleep = rate_limit_sleep
-        self.__client = OpenAI(api_key=openai_api_key)
-        self.__encoder = tiktoken.get_encoding('cl100k_base')
+    @property
+    def entity_chunk_tokens(self) -> dict:
+        return dict(self.__entity_chunk_tokens)
 
-    def chat_completion(self, user: str, system: str = None,
-                        model: str = 'gpt-3.5-turbo-0301', temperature: float = 0, top_p: float = 0):
+    @property
+    def mention_policy(self) -> str:
+        return self.__mention_policy
+
+    @property
+    def mention_index_stats(self) -> MentionIndexStats:
+        return self.__mention_index_stats
+
+    @property
+    def predicate_registry(self) -> PredicateRegistry | None:
+        return self.__predicate_registry
+
+    @property
+    def max_prompt_tokens(self) -> int | None:
+        return self.__max_prompt_tokens
+
+    def chat_completion(self, user: str, system: str = None, model: str = None, temperature: float = 0,
+                        top_p: float = 0, is_valid_line: Callable[[str], bool] = None):
         # More info here: https://platform.openai.com/docs/api-reference/chat/create
-        messages = [{'role': 'user', 'content': user}]
-        if system is not None:
-            messages.insert(0, {'role': 'system', 'content': system})
+        # Unless a `model` is given, the request is routed by its stage and prompt size; `is_valid_line` tells the lines
+        #  of a well-formed answer, to ask the stronger model of the router again when too many of them are not
+        route = self.__route(current_stage(), user, system) if model is None else None
+        answer = self.__complete(route or ModelRoute(model), user, system, temperature, top_p)
+        escalation = self.__escalation(route, answer, is_valid_line)
+        if escalation is not None:
+            answer = self.__complete(escalation, user, system, temperature, top_p)
+
+        return answer
+
+    async def async_chat_completion(self, user: str, system: str = None, model: str = None, temperature: float = 0,
+                                    top_p: float = 0, is_valid_line: Callable[[str], bool] = None):
+        # Same as `chat_completion`, but awaiting the asynchronous client so that many requests can be in flight
+        route = self.__route(current_stage(), user, system) if model is None else None
+        answer = await self.__async_complete(route or ModelRoute(model), user, system, temperature, top_p)
+        escalation = self.__escalation(route, answer, is_valid_line)
+        if escalation is not None:
+            answer = await self.__async_complete(escalation, user, system, temperature, top_p)
+
+        return answer
+
+    def stream_chat_completion(self, user: str, system: str = None, model: str = None,
+                               temperature: float = 0, top_p: float = 0) -> Iterator[str]:
+        # Same as `chat_completion`, but yielding each line of the answer as soon as it is complete. A request is
+        #  retried only when it fails before its first line, since the lines already yielded cannot be taken back (nor
+        #  asked again to a stronger model)
+        route = (self.__route(current_stage(), user, system) if model is None else None) or ModelRoute(model)
+        model, endpoints = self.__route_model(route), self.__route_endpoints(route)
+        cache_key, answer = self.__cache_lookup(user, system, model, temperature, top_p, route.max_tokens)
+        if answer is not None:
+            record_call(model, cached=True)
+            yield from answer.split('\n')
+            return
+
+        from openai import OpenAIError
+        messages = self.__messages(user, system)
+        num_tokens = self.__estimate_num_tokens(messages, route.max_tokens)
+        deadline = self.__deadline()
+
+        attempt = 0
+        queue_wait = 0.0
+        failed_endpoint = None
+        while True:
+            endpoint, wait = endpoints.acquire(num_tokens, exclude=failed_endpoint)
+            queue_wait += wait
+            request_timestamp = time.perf_counter()
+            answer_lines, line_buffer, usage, finish_reason = [], '', None, None
+            try:
+                with endpoint.client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    top_p=top_p,
+                    stream=True,
+                    stream_options={'include_usage': True},
+                    **self.__max_tokens_kwargs(route),
+                    **self.__timeout_kwargs(deadline)
+                ) as stream:
+                    for chunk in stream:
+                        usage = getattr(chunk, 'usage', None) or usage
+                        if chunk.choices:
+                            finish_reason = getattr(chunk.choices[0], 'finish_reason', None) or finish_reason
+                        if not chunk.choices or not chunk.choices[0].delta.content:
+                            continue
+                        *lines, line_buffer = (line_buffer + chunk.choices[0].delta.content).split('\n')
+                        for line in lines:
+                            answer_lines.append(line)
+                            yield line
+                break
+            except OpenAIError as e:
+                if answer_lines:
+                    endpoints.report_failure(endpoint)
+                    raise
+                time.sleep(self.__retry_delay(e, attempt, endpoints, endpoint, deadline))
+                attempt += 1
+                failed_endpoint = endpoint
+            except BaseException:
+                endpoints.release(endpoint)
+                raise
+
+        answer_lines.append(line_buffer)
+        endpoints.report_success(endpoint)
+        self.__adjust_rate_limiter(endpoint, usage, num_tokens)
+        self.__record_call(model, usage, queue_wait, time.perf_counter() - request_timestamp, attempt, finish_reason)
+        if self.__cache is not None:
+            self.__cache.put(cache_key, '\n'.join(answer_lines))
+
+        yield line_buffer
+
+    async def async_stream_chat_completion(self, user: str, system: str = None, model: str = None,
+                                           temperature: float = 0, top_p: float = 0) -> AsyncIterator[str]:
+        # Same as `stream_chat_completion`, but awaiting the asynchronous client
+        route = (self.__route(current_stage(), user, system) if model is None else None) or ModelRoute(model)
+        model, endpoints = self.__route_model(route), self.__route_endpoints(route)
+        cache_key, answer = self.__cache_lookup(user, system, model, temperature, top_p, route.max_tokens)
+        if answer is not None:
+            record_call(model, cached=True)
+            for line in answer.split('\n'):
+                yield line
+            return
+
+        from openai import OpenAIError
+        messages = self.__messages(user, system)
+        num_tokens = self.__estimate_num_tokens(messages, route.max_tokens)
+        deadline = self.__deadline()
+
+        attempt = 0
+        queue_wait = 0.0
+        failed_endpoint = None
+        while True:
+            endpoint, wait = await endpoints.async_acquire(num_tokens, exclude=failed_endpoint)
+            queue_wait += wait
+            request_timestamp = time.perf_counter()
+            answer_lines, line_buffer, usage, finish_reason = [], '', None, None
+            try:
+                async with await endpoint.async_client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    top_p=top_p,
+                    stream=True,
+                    stream_options={'include_usage': True},
+                    **self.__max_tokens_kwargs(route),
+                    **self.__timeout_kwargs(deadline)
+                ) as stream:
+                    async for chunk in stream:
+                        usage = getattr(chunk, 'usage', None) or usage
+                        if chunk.choices:
+                            finish_reason = getattr(chunk.choices[0], 'finish_reason', None) or finish_reason
+                        if not chunk.choices or not chunk.choices[0].delta.content:
+                            continue
+                        *lines, line_buffer = (line_buffer + chunk.choices[0].delta.content).split('\n')
+                        for line in lines:
+                            answer_lines.append(line)
+                            yield line
+                break
+            except OpenAIError as e:
+                if answer_lines:
+                    endpoints.report_failure(endpoint)
+                    raise
+                await asyncio.sleep(self.__retry_delay(e, attempt, endpoints, endpoint, deadline))
+                attempt += 1
+                failed_endpoint = endpoint
+            except BaseException:
+                endpoints.release(endpoint)
+                raise
+
+        answer_lines.append(line_buffer)
+        endpoints.report_success(endpoint)
+        self.__adjust_rate_limiter(endpoint, usage, num_tokens)
+        self.__record_call(model, usage, queue_wait, time.perf_counter() - request_timestamp, attempt, finish_reason)
+        if self.__cache is not None:
+            self.__cache.put(cache_key, '\n'.join(answer_lines))
+
+        yield line_buffer
+
+    def get_num_tokens(self, text):
+        return len(_get_encoder().encode(text))
+
+    def request_params(self, stage: str, user: str, system: str = None) -> dict:
+        # Model and answer ceiling of a request of `stage`, as routed by `chat_completion` (e.g. to send it with the
+        #  Batch API instead)
+        route = self.__route(stage, user, system) or ModelRoute()
+        return {'model': self.__route_model(route), **self.__max_tokens_kwargs(route)}
+
+    def __complete(self, route: ModelRoute, user: str, system: str | None, temperature: float, top_p: float) -> str:
+        model = self.__route_model(route)
+        cache_key, answer = self.__cache_lookup(user, system, model, temperature, top_p, route.max_tokens)
+        if answer is not None:
+            record_call(model, cached=True)
+            return answer
+
+        request = partial(self.__request, route, self.__messages(user, system), temperature, top_p, self.__deadline())
+        hedge_after = self.__hedge_threshold(model)
+        answer = request() if hedge_after is None else hedged_call(request, hedge_after)
+        if self.__cache is not None:
+            self.__cache.put(cache_key, answer)
+
+        return answer
+
+    async def __async_complete(self, route: ModelRoute, user: str, system: str | None, temperature: float,
+                               top_p: float) -> str:
+        model = self.__route_model(route)
+        cache_key, answer = self.__cache_lookup(user, system, model, temperature, top_p, route.max_tokens)
+        if answer is not None:
+            record_call(model, cached=True)
+            return answer
+
+        request = partial(
+            self.__async_request, route, self.__messages(user, system), temperature, top_p, self.__deadline())
+        hedge_after = self.__hedge_threshold(model)
+        answer = await (request() if hedge_after is None else async_hedged_call(request, hedge_after))
+        if self.__cache is not None:
+            self.__cache.put(cache_key, answer)
 
-        elapsed = time.time() - self.__last_request_timestamp
-        if elapsed < self.__rate_limit_sleep:
-            time.sleep(self.__rate_limit_sleep - elapsed)
+        return answer
+
+    def __request(self, route: ModelRoute, messages: list[dict], temperature: float, top_p: float,
+                  deadline: float | None, cancel_event: threading.Event = None) -> str | None:
+        # Send the request until it succeeds, or its error is not worth a retry; `None` if it is cancelled (when
+        #  another request for the same answer succeeded first) before being sent again
+        from openai import OpenAIError
+        model, endpoints = self.__route_model(route), self.__route_endpoints(route)
+        num_tokens = self.__estimate_num_tokens(messages, route.max_tokens)
 
         response = None
-        need_completion = True
-        while need_completion:
+        attempt = 0
+        queue_wait = 0.0
+        failed_endpoint = None
+        while response is None:
+            if cancel_event is not None and cancel_event.is_set():
+                return None
+            endpoint, wait = endpoints.acquire(num_tokens, exclude=failed_endpoint)
+            queue_wait += wait
+            request_timestamp = time.perf_counter()
             try:
-                response = self.__client.chat.completions.create(
+                response = endpoint.client.chat.completions.create(
                     model=model,
                     messages=messages,
                     temperature=temperature,
-                    top_p=top_p
+                    top_p=top_p,
+                    **self.__max_tokens_kwargs(route),
+                    **self.__timeout_kwargs(deadline)
                 )
-                need_completion = False
-            except (OpenAIError, APIError, RateLimitError) as e:
-                LOGGER.warning(
-                    f'OpenAI `{type(e).__name__}` faced.'
-                    f' Trying request again in {self.__rate_limit_sleep: .2f} seconds.')
-                time.sleep(self.__rate_limit_sleep)
+            except OpenAIError as e:
+                time.sleep(self.__retry_delay(e, attempt, endpoints, endpoint, deadline))
+                attempt += 1
+                failed_endpoint = endpoint
+            except BaseException:
+                endpoints.release(endpoint)
+                raise
 
-        answer = response.choices[0].message.content
+        return self.__answer(endpoints, endpoint, response, model, num_tokens, queue_wait, request_timestamp, attempt)
 
-        return answer
+    async def __async_request(self, route: ModelRoute, messages: list[dict], temperature: float, top_p: float,
+                              deadline: float | None) -> str:
+        # Cancelled like any task, when another request for the same answer succeeded first
+        from openai import OpenAIError
+        model, endpoints = self.__route_model(route), self.__route_endpoints(route)
+        num_tokens = self.__estimate_num_tokens(messages, route.max_tokens)
 
-    def get_num_tokens(self, text):
-        return len(self.__encoder.encode(text))
+        response = None
+        attempt = 0
+        queue_wait = 0.0
+        failed_endpoint = None
+        while response is None:
+            endpoint, wait = await endpoints.async_acquire(num_tokens, exclude=failed_endpoint)
+            queue_wait += wait
+            request_timestamp = time.perf_counter()
+            try:
+                response = await endpoint.async_client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    top_p=top_p,
+                    **self.__max_tokens_kwargs(route),
+                    **self.__timeout_kwargs(deadline)
+                )
+            except OpenAIError as e:
+                await asyncio.sleep(self.__retry_delay(e, attempt, endpoints, endpoint, deadline))
+                attempt += 1
+                failed_endpoint = endpoint
+            except BaseException:
+                endpoints.release(endpoint)
+                raise
+
+        return self.__answer(endpoints, endpoint, response, model, num_tokens, queue_wait, request_timestamp, attempt)
+
+    def __answer(self, endpoints: EndpointPool, endpoint: Endpoint, response, model: str, num_tokens: int,
+                 queue_wait: float, request_timestamp: float, attempt: int) -> str:
+        latency = time.perf_counter() - request_timestamp
+        usage = getattr(response, 'usage', None)
+        endpoints.report_success(endpoint)
+        self.__adjust_rate_limiter(endpoint, usage, num_tokens)
+        self.__record_call(
+            model, usage, queue_wait, latency, attempt, getattr(response.choices[0], 'finish_reason', None))
+        self.__latencies.add(self.__latency_key(model), latency)
+        return response.choices[0].message.content
+
+    @staticmethod
+    def __messages(user: str, system: str = None) -> list[dict]:
+        messages = [{'role': 'user', 'content': user}]
+        if system is not None:
+            messages.insert(0, {'role': 'system', 'content': system})
+        return messages
+
+    def __route(self, stage: str, user: str, system: str | None) -> ModelRoute | None:
+        # `None` when the request goes to the model (and the endpoints) of the LLM
+        if self.__router is None:
+            return None
+        return self.__router.route(stage, self.__count_prompt_tokens(self.__messages(user, system)))
+
+    def __route_model(self, route: ModelRoute) -> str:
+        return route.model if route.model is not None else self.__model
+
+    def __route_endpoints(self, route: ModelRoute) -> EndpointPool:
+        return route.endpoints if route.endpoints is not None else self.__endpoints
+
+    @staticmethod
+    def __max_tokens_kwargs(route: ModelRoute) -> dict:
+        return {'max_tokens': route.max_tokens} if route.max_tokens is not None else {}
+
+    def __escalation(self, route: ModelRoute | None, answer: str,
+                     is_valid_line: Callable[[str], bool] | None) -> ModelRoute | None:
+        # Stronger route to send a routed request to again, when too many lines of its answer are malformed
+        if route is None or not self.__router.should_escalate(answer, is_valid_line):
+            return None
+        escalation = self.__router.escalation
+        LOGGER.warning(f'Too many malformed lines in the answer of `{self.__route_model(route)}`: asking'
+                       f' `{self.__route_model(escalation)}` again.')
+        record_escalation()
+        self.__router.stats.add_escalation(current_stage())
+        return escalation
+
+    def __cache_lookup(self, user: str, system: str | None, model: str, temperature: float, top_p: float,
+                       max_tokens: int | None) -> tuple[str | None, str | None]:
+        if self.__cache is None:
+            return None, None
+        # The answers capped by `max_tokens` are kept apart, while the other keys are the same as before the routing
+        max_tokens_params = {'max_tokens': max_tokens} if max_tokens is not None else {}
+        cache_key = self.__cache.make_key(
+            model, system, user, temperature=temperature, top_p=top_p, **max_tokens_params)
+        return cache_key, self.__cache.get(cache_key)
+
+    def __count_prompt_tokens(self, messages: list[dict]) -> int:
+        return sum([self.get_num_tokens(m['content']) + MESSAGE_OVERHEAD_TOKENS for m in messages])
+
+    def __estimate_num_tokens(self, messages: list[dict], max_tokens: int | None) -> int:
+        completion_tokens = min(EXPECTED_COMPLETION_TOKENS, max_tokens or EXPECTED_COMPLETION_TOKENS)
+        return self.__count_prompt_tokens(messages) + completion_tokens
+
+    @staticmethod
+    def __adjust_rate_limiter(endpoint: Endpoint, usage, num_tokens: int):
+        # Give back (or take) the difference between the booked and the actually used tokens
+        if usage is not None:
+            endpoint.rate_limiter.adjust(usage.total_tokens - num_tokens)
+
+    def __record_call(self, model: str, usage, queue_wait: float, latency: float, retries: int,
+                      finish_reason: str | None):
+        prompt_tokens = usage.prompt_tokens if usage is not None else 0
+        completion_tokens = usage.completion_tokens if usage is not None else 0
+        record_call(
+            model,
+            queue_wait_seconds=queue_wait,
+            latency_seconds=latency,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens,
+            retries=retries
+        )
+        # An answer cut at its tokens limit (e.g. the `max_tokens` of its route) most likely misses its last lines
+        is_capped = finish_reason == 'length'
+        if is_capped:
+            LOGGER.warning(f'Answer of `{model}` cut at its tokens limit.')
+        if self.__router is not None:
+            self.__router.stats.add_call(current_stage(), model, latency, prompt_tokens, completion_tokens, is_capped)
+
+    def __deadline(self) -> float | None:
+        return time.monotonic() + self.__call_deadline if self.__call_deadline is not None else None
+
+    def __timeout_kwargs(self, deadline: float | None) -> dict:
+        # The timeout of a request is only passed when set, since `None` would disable the default one of the client;
+        #  the requests of a call with a deadline cannot last past it
+        timeout = self.__request_timeout
+        if deadline is not None:
+            remaining = max(deadline - time.monotonic(), 0.01)
+            timeout = remaining if timeout is None else min(timeout, remaining)
+        return {'timeout': timeout} if timeout is not None else {}
+
+    def __hedge_threshold(self, model: str) -> float | None:
+        if self.__hedge_quantile is not None:
+            threshold = self.__latencies.quantile(self.__latency_key(model), self.__hedge_quantile)
+            if threshold is not None:
+                return threshold
+        return self.__hedge_after
+
+    @staticmethod
+    def __latency_key(model: str) -> str:
+        # The latencies of a stage are kept apart for each model its requests are routed to
+        return f'{current_stage()}/{model}'
+
+    def __retry_delay(self, error: OpenAIError, attempt: int, endpoints: EndpointPool, endpoint: Endpoint,
+                      deadline: float = None) -> float:
+        from openai import (
+            APIConnectionError, APIStatusError, AuthenticationError, PermissionDeniedError, RateLimitError)
+        # A rejected API key or an exhausted quota (reported as a rate limit too, but waiting would not help) only
+        #  concern the endpoint of the request, which is left out while the other endpoints take its requests
+        is_endpoint_error = getattr(error, 'code', None) == 'insufficient_quota' or isinstance(
+            error, (AuthenticationError, PermissionDeniedError))
+        is_server_error = isinstance(error, APIConnectionError) or (
+            isinstance(error, APIStatusError) and error.status_code >= 500)
+        if is_endpoint_error or is_server_error:
+            endpoints.report_failure(endpoint, disable=is_endpoint_error)
+        else:
+            endpoints.release(endpoint)
+        if is_endpoint_error and endpoints.has_alternative(endpoint):
+            self.__check_retry(error, 0.0, deadline)
+            LOGGER.warning(f'OpenAI `{type(error).__name__}` faced on "{endpoint.name}". Trying request again on'
+                           f' another endpoint.')
+            return 0.0
+
+        # Only rate limits, server errors and connection problems are worth a retry: anything else is a client error
+        #  that would fail again in the same way
+        if is_endpoint_error or not (is_server_error or isinstance(error, RateLimitError)):
+            raise error
+
+        retry_after = _get_retry_after(error)
+        delay = endpoint.rate_limiter.backoff_delay(attempt, retry_after)
+        if isinstance(error, RateLimitError):
+            # The budget is shared: hold every other request too, rather than letting them hit the limit again
+            endpoint.rate_limiter.pause(delay)
+        if endpoints.has_alternative(endpoint):
+            # The other endpoints can take the request right away (the least busy one, leaving out the failed one)
+            self.__check_retry(error, 0.0, deadline)
+            LOGGER.warning(f'OpenAI `{type(error).__name__}` faced on "{endpoint.name}". Trying request again on'
+                           f' another endpoint.')
+            return 0.0
+        self.__check_retry(error, delay, deadline)
+        LOGGER.warning(
+            f'OpenAI `{type(error).__name__}` faced. Trying request again in {delay: .2f} seconds.')
+        return delay
+
+    @staticmethod
+    def __check_retry(error: OpenAIError, delay: float, deadline: float | None):
+        # Give up when the retry would start past the deadline of the call, or the retries of the document are spent
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            LOGGER.warning(f'OpenAI `{type(error).__name__}` faced, with no time left to try the request again.')
+            raise error
+        if not spend_retry():
+            LOGGER.warning(f'OpenAI `{type(error).__name__}` faced, with no retries left for the document.')
+            raise error
 
     def entity_extraction(self, text: str, output_language: str) -> list[dict]:
         from llm_open_ie.llm.gpt.stages.entity_extraction import extract_entities
-        return extract_entities(self, text, output_language)
+        with stage_scope('entity_extraction'):
+            return extract_entities(self, text, output_language, **self.__entity_chunk_tokens)
+
+    def iter_entity_extraction(self, text: str, output_language: str) -> Iterator[dict]:
+        from llm_open_ie.llm.gpt.stages.entity_extraction import iter_entities
+        yield from iter_in_stage(
+            'entity_extraction', iter_entities(self, text, output_language, **self.__entity_chunk_tokens))
 
     def phrase_selection(self, text: str, entity_id: int, entities: list[dict]) -> str:
         from llm_open_ie.llm.gpt.stages.phrase_selection import select_phrase
-        return select_phrase(self, text, entity_id, entities)
+        with stage_scope('phrase_selection'):
+            return select_phrase(self, text, entity_id, entities)
 
     def mention_recognition(self, sentence: str, entities: list[dict]) -> list[int]:
         from llm_open_ie.llm.gpt.stages.mention_recognition import recognize_mentions
-        return recognize_mentions(self, sentence, entities)
+        with stage_scope('mention_recognition'):
+            return recognize_mentions(
+                self, sentence, entities, mention_policy=self.__mention_policy, stats=self.__mention_index_stats)
+
+    def mention_recognition_batch(self, sentences: list[str], entities: list[dict]) -> list[list[int]]:
+        from llm_open_ie.llm.gpt.stages.mention_recognition import recognize_mentions_batch
+        with stage_scope('mention_recognition'):
+            return recognize_mentions_batch(
+                self, sentences, entities, mention_policy=self.__mention_policy, stats=self.__mention_index_stats)
 
     def relation_extraction(self, sentence: str, sentence_entities_ids: list[int],
                             entities: list[dict], output_language: str) -> list[dict]:
         from llm_open_ie.llm.gpt.stages.relation_extraction import extract_relations
-        return extract_relations(self, sentence, sentence_entities_ids, entities, output_language)
+        with stage_scope('relation_extraction'):
+            return extract_relations(self, sentence, sentence_entities_ids, entities, output_language)
 
     def predicate_description(self, sentence: str, triplets: list[dict], output_language: str) -> None:
         from llm_open_ie.llm.gpt.stages.predicate_description import describe_predicates
-        describe_predicates(self, sentence, triplets, output_language)
+        with stage_scope('predicate_description'):
+            describe_predicates(self, sentence, triplets, output_language)
+
+    def fused_relation_extraction(self, sentence: str, sentence_entities_ids: list[int],
+                                  entities: list[dict], output_language: str) -> list[dict]:
+        from llm_open_ie.llm.gpt.stages.fused_relation_extraction import extract_described_relations
+        with stage_scope('fused_relation_extraction'):
+            triplets = extract_described_relations(self, sentence, sentence_entities_ids, entities, output_language)
+        if triplets is not None:
+            return triplets
+        LOGGER.warning('Described relations not parsed: extracting and describing them with two requests instead.')
+        return super().fused_relation_extraction(sentence, sentence_entities_ids, entities, output_language)
+
+    async def async_entity_extraction(self, text: str, output_language: str) -> list[dict]:
+        from llm_open_ie.llm.gpt.stages.entity_extraction import async_extract_entities
+        with stage_scope('entity_extraction'):
+            return await async_extract_entities(self, text, output_language, **self.__entity_chunk_tokens)
+
+    async def async_iter_entity_extraction(self, text: str, output_language: str) -> AsyncIterator[dict]:
+        from llm_open_ie.llm.gpt.stages.entity_extraction import async_iter_entities
+        async for e_dict in async_iter_in_stage(
+                'entity_extraction', async_iter_entities(self, text, output_language, **self.__entity_chunk_tokens)):
+            yield e_dict
+
+    async def async_phrase_selection(self, text: str, entity_id: int, entities: list[dict]) -> str:
+        # No request involved: no need to leave the event loop
+        return self.phrase_selection(text, entity_id, entities)
+
+    async def async_mention_recognition(self, sentence: str, entities: list[dict]) -> list[int]:
+        from llm_open_ie.llm.gpt.stages.mention_recognition import async_recognize_mentions
+        with stage_scope('mention_recognition'):
+            return await async_recognize_mentions(
+                self, sentence, entities, mention_policy=self.__mention_policy, stats=self.__mention_index_stats)
+
+    async def async_mention_recognition_batch(self, sentences: list[str], entities: list[dict]) -> list[list[int]]:
+        from llm_open_ie.llm.gpt.stages.mention_recognition import async_recognize_mentions_batch
+        with stage_scope('mention_recognition'):
+            return await async_recognize_mentions_batch(
+                self, sentences, entities, mention_policy=self.__mention_policy, stats=self.__mention_index_stats)
+
+    async def async_relation_extraction(self, sentence: str, sentence_entities_ids: list[int],
+                                        entities: list[dict], output_language: str) -> list[dict]:
+        from llm_open_ie.llm.gpt.stages.relation_extraction import async_extract_relations
+        with stage_scope('relation_extraction'):
+            return await async_extract_relations(self, sentence, sentence_entities_ids, entities, output_language)
+
+    async def async_predicate_description(self, sentence: str, triplets: list[dict], output_language: str) -> None:
+        from llm_open_ie.llm.gpt.stages.predicate_description import async_describe_predicates
+        with stage_scope('predicate_description'):
+            await async_describe_predicates(self, sentence, triplets, output_language)
+
+    async def async_fused_relation_extraction(self, sentence: str, sentence_entities_ids: list[int],
+                                              entities: list[dict], output_language: str) -> list[dict]:
+        from llm_open_ie.llm.gpt.stages.fused_relation_extraction import async_extract_described_relations
+        with stage_scope('fused_relation_extraction'):
+            triplets = await async_extract_described_relations(
+                self, sentence, sentence_entities_ids, entities, output_language)
+        if triplets is not None:
+            return triplets
+        LOGGER.warning('Described relations not parsed: extracting and describing them with two requests instead.')
+        return await super().async_fused_relation_extraction(
+            sentence, sentence_entities_ids, entities, output_language)
+
+
+def get_api_key(api_key_input: str = 'environ') -> str:
+    api_key_input_values = ['environ', 'keyboard']
+    if api_key_input == api_key_input_values[0]:
+        openai_api_key = os.environ.get('OPENAI_API_KEY', None)
+        if not openai_api_key:
+            raise ValueError(
+                '`api_key_input` is set to `environ`, but the environmental variable `OPENAI_API_KEY` is not set.')
+    elif api_key_input == api_key_input_values[1]:
+        openai_api_key = getpass(prompt='Insert your OpenAI API key: ')
+    else:
+        options_str = ', '.join([f'`{v}`' for v in api_key_input_values])
+        raise ValueError(f'`{api_key_input}` is not a valid option: choose one between {options_str}')
+    return openai_api_key
+
+
+@cache
+def _get_encoder() -> tiktoken.Encoding:
+    # Shared by all the instances, and only loaded when the first tokens are counted
+    import tiktoken
+    return tiktoken.get_encoding('cl100k_base')
+
+
+def _get_retry_after(error: OpenAIError) -> float | None:
+    # Read the `Retry-After` header of the failed response, either expressed in seconds or as an HTTP date
+    response = getattr(error, 'response', None)
+    if response is None:
+        return None
+    headers = response.headers
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms is not None:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get('retry-after')
+    if retry_after is None:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
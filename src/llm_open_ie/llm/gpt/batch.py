@@ -0,0 +1,420 @@
+from __future__ import annotations
+
+from pathlib import Path
+from types import ModuleType
+from typing import TYPE_CHECKING, Callable
+import json
+import os
+import time
+
+from llm_open_ie.chunking import split_text
+from llm_open_ie.corpus import iter_documents, to_dataset_record
+from llm_open_ie.llm.gpt import GPTOpenIE
+from llm_open_ie.llm.gpt.prompt import Prompt
+from llm_open_ie.llm.gpt.stages import (
+    entity_extraction, fused_relation_extraction, mention_recognition, predicate_description, relation_extraction)
+from llm_open_ie.logger import LOGGER
+from llm_open_ie.pipeline import _normalize_language
+
+if TYPE_CHECKING:
+    from openai import OpenAI
+
+# Stages run breadth-first: the requests of a stage for all the documents are sent as a single job before the next
+#  stage starts. The fused relation extraction only has requests with `fuse_relations`, and then the relation
+#  extraction and predicate description only have the ones of the sentences whose described relations were rejected.
+BATCH_STAGES = [
+    'entity_extraction', 'mention_recognition', 'fused_relation_extraction', 'relation_extraction',
+    'predicate_description'
+]
+# Maximum number of requests in an input file of the Batch API: larger stages are sent as more batches
+MAX_BATCH_REQUESTS = 50_000
+# Statuses of a batch that do not change anymore
+FINAL_BATCH_STATUSES = ['completed', 'failed', 'expired', 'cancelled']
+BATCH_ENDPOINT = '/v1/chat/completions'
+BATCH_COMPLETION_WINDOW = '24h'
+STATE_FILE_NAME = 'state.json'
+
+
+# Runs the pipeline on a whole corpus breadth-first through the OpenAI Batch API, trading the latency of each document
+#  for the lower cost and higher throughput of the batches: the requests of each stage for all the documents are
+#  written in a JSONL file, submitted as a batch, polled until it is over and collected, and their answers are parsed
+#  by the same functions of the stages. The requests failed in a batch are sent again in a new one, for at most
+#  `max_rounds` batches per stage, after which their documents fail.
+# The state of the job (the documents with the results of the stages so far, the batches in progress and the answers
+#  collected) is saved in `work_dir` together with the batch files, so that a job interrupted at any point is resumed
+#  by running it again with the same `work_dir`, without submitting again the batches already submitted.
+class BatchScheduler:
+    __gpt: GPTOpenIE
+    __work_dir: Path
+    __client: OpenAI
+    __poll_interval: float
+    __max_rounds: int
+    __fuse_relations: bool
+
+    def __init__(self, gpt: GPTOpenIE, work_dir: str | Path, client: OpenAI = None, poll_interval: float = 60.0,
+                 max_rounds: int = 3, fuse_relations: bool = False):
+        # `gpt` builds the prompts (model, prompt budget, mention policy and predicate registry), while the batches
+        #  are sent with `client`: the OpenAI client of its first endpoint, unless another one (or a stand-in, such as
+        #  `ReplayBatchClient`) is given
+        if poll_interval < 0:
+            raise ValueError(f'`poll_interval` must be a non-negative number of seconds, got {poll_interval}.')
+        if max_rounds < 1:
+            raise ValueError(f'`max_rounds` must be a positive integer, got {max_rounds}.')
+        self.__gpt = gpt
+        self.__work_dir = Path(work_dir)
+        self.__client = client if client is not None else gpt.endpoints.endpoints[0].client
+        self.__poll_interval = poll_interval
+        self.__max_rounds = max_rounds
+        self.__fuse_relations = fuse_relations
+
+    @property
+    def work_dir(self) -> Path:
+        return self.__work_dir
+
+    def run(self, documents_path: str | Path, output_path: str | Path, output_language: str = 'English') -> dict:
+        # Append the results of the completed documents to the `output_path` JSONL file once the last stage is over
+        state = self.__load_state()
+        if state is None:
+            state = self.__init_state(documents_path, _normalize_language(output_language))
+        elif state['fuse_relations'] != self.__fuse_relations:
+            raise ValueError(f'The job in "{self.__work_dir}" was started with `fuse_relations` set to'
+                             f' {state["fuse_relations"]}: resume it with the same value, or use another `work_dir`.')
+        else:
+            LOGGER.info(f'Resuming the batch job in "{self.__work_dir}".')
+
+        while state['stage'] < len(BATCH_STAGES):
+            stage = BATCH_STAGES[state['stage']]
+            if state['batch_ids'] is None:
+                if state['round'] == 0:
+                    self.__compile_stage(stage, state)
+                requests = self.__pending_requests(stage, state)
+                if requests and state['round'] < self.__max_rounds:
+                    state['batch_ids'] = self.__submit(stage, state['round'], requests)
+                    state['batches'] += len(state['batch_ids'])
+                    self.__save_state(state)
+            if state['batch_ids'] is not None:
+                state['answers'].update(self.__collect(state['batch_ids']))
+                state['batch_ids'] = None
+                state['round'] += 1
+                self.__save_state(state)
+                continue
+            self.__parse_stage(stage, state)
+            state.update(stage=state['stage'] + 1, round=0, answers=dict())
+            self.__save_state(state)
+
+        if not state['is_written']:
+            output_path = Path(output_path)
+            output_path.parent.mkdir(parents=True, exist_ok=True)
+            with output_path.open('a', encoding='utf-8') as output_file:
+                for doc_state in state['documents']:
+                    if doc_state['error'] is None:
+                        triplets = [t_dict for e_triplets in doc_state['triplets'] for t_dict in e_triplets or []]
+                        record = to_dataset_record(doc_state['doc'], doc_state['entities'], triplets)
+                        output_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+            state['is_written'] = True
+            self.__save_state(state)
+
+        stats = {
+            'completed': sum([doc_state['error'] is None for doc_state in state['documents']]),
+            'failed': sum([doc_state['error'] is not None for doc_state in state['documents']]),
+            'requests': state['requests'],
+            'batches': state['batches']
+        }
+        LOGGER.info(f'Batch job finished: {stats["completed"]} completed, {stats["failed"]} failed documents.')
+        return stats
+
+    def __init_state(self, documents_path: str | Path, output_language: str) -> dict:
+        documents = [
+            {'doc': doc, 'entities': None, 'sentences': None, 'mentions': None, 'triplets': None, 'requests': dict(),
+             'error': None}
+            for doc in iter_documents(documents_path)
+        ]
+        LOGGER.info(f'Starting a batch job on {len(documents)} documents in "{self.__work_dir}".')
+        return {
+            'output_language': output_language,
+            'fuse_relations': self.__fuse_relations,
+            'stage': 0,
+            'round': 0,
+            'batch_ids': None,
+            'answers': dict(),
+            'requests': {stage: 0 for stage in BATCH_STAGES},
+            'batches': 0,
+            'is_written': False,
+            'documents': documents
+        }
+
+    def __load_state(self) -> dict | None:
+        state_path = self.__work_dir / STATE_FILE_NAME
+        if not state_path.exists():
+            return None
+        return json.loads(state_path.read_text(encoding='utf-8'))
+
+    def __save_state(self, state: dict):
+        # Written aside and then renamed, so that an interruption never leaves a truncated state
+        self.__work_dir.mkdir(parents=True, exist_ok=True)
+        state_path = self.__work_dir / STATE_FILE_NAME
+        temp_path = state_path.with_suffix('.tmp')
+        temp_path.write_text(json.dumps(state, ensure_ascii=False), encoding='utf-8')
+        os.replace(temp_path, state_path)
+
+    def __compile_stage(self, stage: str, state: dict):
+        # Write the requests of the stage for all the documents in its input file, keeping in each document what is
+        #  needed to parse their answers
+        compile_requests, _ = _STAGE_FUNCTIONS[stage]
+        self.__work_dir.mkdir(parents=True, exist_ok=True)
+        n_requests = 0
+        with (self.__work_dir / f'{stage}.jsonl').open('w', encoding='utf-8') as f:
+            for doc_i, doc_state in enumerate(state['documents']):
+                doc_state['requests'] = dict()
+                if doc_state['error'] is not None:
+                    continue
+                if stage == 'fused_relation_extraction' and not self.__fuse_relations:
+                    continue
+                for key, prompt, payload in compile_requests(self.__gpt, doc_state, state['output_language']):
+                    doc_state['requests'][key] = payload
+                    f.write(json.dumps(self.__request_line(stage, f'{doc_i}/{key}', prompt), ensure_ascii=False) + '\n')
+                    n_requests += 1
+        state['requests'][stage] = n_requests
+        LOGGER.info(f'Stage `{stage}`: {n_requests} requests.')
+
+    def __request_line(self, stage: str, custom_id: str, prompt: Prompt) -> dict:
+        # Same body of the requests of `GPTOpenIE.chat_completion` (routed to the same model, but with no escalation of
+        #  the malformed answers), so that the answers can be cached and recorded alike
+        return {
+            'custom_id': custom_id,
+            'method': 'POST',
+            'url': BATCH_ENDPOINT,
+            'body': {
+                **self.__gpt.request_params(stage, prompt.user, prompt.system),
+                'messages': [{'role': 'system', 'content': prompt.system}, {'role': 'user', 'content': prompt.user}],
+                'temperature': 0,
+                'top_p': 0
+            }
+        }
+
+    def __pending_requests(self, stage: str, state: dict) -> list[str]:
+        with (self.__work_dir / f'{stage}.jsonl').open('r', encoding='utf-8') as f:
+            return [line for line in f if line.strip() and json.loads(line)['custom_id'] not in state['answers']]
+
+    def __submit(self, stage: str, round_i: int, requests: list[str]) -> list[str]:
+        batch_ids = []
+        for part_i, part_start in enumerate(range(0, len(requests), MAX_BATCH_REQUESTS)):
+            input_path = self.__work_dir / f'{stage}.{round_i}.{part_i}.input.jsonl'
+            input_path.write_text(''.join(requests[part_start:part_start + MAX_BATCH_REQUESTS]), encoding='utf-8')
+            with input_path.open('rb') as f:
+                input_file = self.__client.files.create(file=f, purpose='batch')
+            batch = self.__client.batches.create(
+                input_file_id=input_file.id, endpoint=BATCH_ENDPOINT, completion_window=BATCH_COMPLETION_WINDOW,
+                metadata={'stage': stage, 'round': str(round_i)})
+            batch_ids.append(batch.id)
+            LOGGER.info(f'Stage `{stage}`: submitted batch "{batch.id}" (round {round_i + 1}/{self.__max_rounds}).')
+        return batch_ids
+
+    def __collect(self, batch_ids: list[str]) -> dict[str, str]:
+        # Wait for the batches to be over and get the answers of their successful requests, by their custom ID
+        answers = dict()
+        for batch_id in batch_ids:
+            batch = self.__retrieve(batch_id)
+            while batch.status not in FINAL_BATCH_STATUSES:
+                time.sleep(self.__poll_interval)
+                batch = self.__retrieve(batch_id)
+            if batch.status != 'completed':
+                LOGGER.warning(
+                    f'Batch "{batch_id}" is `{batch.status}`: its requests without an answer are sent again.')
+            for file_id in [batch.output_file_id, batch.error_file_id]:
+                if file_id is not None:
+                    answers.update(self.__read_answers(file_id))
+        return answers
+
+    def __retrieve(self, batch_id: str):
+        from openai import OpenAIError
+        while True:
+            try:
+                return self.__client.batches.retrieve(batch_id)
+            except OpenAIError as e:
+                LOGGER.warning(f'OpenAI `{type(e).__name__}` faced polling batch "{batch_id}". Trying again in'
+                               f' {self.__poll_interval: .2f} seconds.')
+                time.sleep(self.__poll_interval)
+
+    def __read_answers(self, file_id: str) -> dict[str, str]:
+        # The output files are kept next to the input ones, and their failed requests are only logged
+        content = self.__client.files.content(file_id).text
+        (self.__work_dir / f'{file_id}.output.jsonl').write_text(content, encoding='utf-8')
+        answers = dict()
+        n_failed = 0
+        for line in content.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get('response')
+            if result.get('error') is None and response is not None and response['status_code'] == 200:
+                answers[result['custom_id']] = response['body']['choices'][0]['message']['content']
+            else:
+                n_failed += 1
+                LOGGER.debug(f'Request "{result["custom_id"]}" failed: {result.get("error") or response}')
+        if n_failed > 0:
+            LOGGER.warning(f'{n_failed} requests failed in the batch file "{file_id}".')
+        return answers
+
+    def __parse_stage(self, stage: str, state: dict):
+        # Parse the answers of each document, which fails when some of its requests were never answered
+        _, parse_answers = _STAGE_FUNCTIONS[stage]
+        for doc_i, doc_state in enumerate(state['documents']):
+            if doc_state['error'] is not None:
+                continue
+            answers = {key: state['answers'].get(f'{doc_i}/{key}') for key in doc_state['requests']}
+            n_missing = sum([answer is None for answer in answers.values()])
+            if n_missing > 0:
+                doc_state['error'] = f'{n_missing} requests of the `{stage}` stage were not answered.'
+            else:
+                try:
+                    parse_answers(self.__gpt, doc_state, answers, state['output_language'])
+                except Exception as e:
+                    doc_state['error'] = f'`{type(e).__name__}` parsing the `{stage}` stage: {e}'
+            if doc_state['error'] is not None:
+                LOGGER.error(f'Document "{doc_state["doc"]["id"]}" failed: {doc_state["error"]}')
+            doc_state['requests'] = dict()
+
+
+# Requests of each stage for a document, as their keys, prompts and what is needed to parse their answers, and parsers
+#  of the answers of each stage for a document, setting its results for the next stages
+
+def _entity_extraction_requests(gpt: GPTOpenIE, doc_state: dict,
+                                output_language: str) -> list[tuple[str, Prompt, None]]:
+    text = doc_state['doc']['text']
+    chunk_tokens = gpt.entity_chunk_tokens
+    chunks = split_text(
+        text, gpt.get_num_tokens, chunk_tokens.get('max_chunk_tokens', entity_extraction.MAX_CHUNK_TOKENS),
+        chunk_tokens.get('chunk_overlap_tokens', entity_extraction.CHUNK_OVERLAP_TOKENS))
+    if len(chunks) <= 1:
+        chunks = [text]
+    return [(f'c{i}', entity_extraction._build_prompt(chunk, output_language), None) for i, chunk in enumerate(chunks)]
+
+
+def _parse_entity_extraction(gpt: GPTOpenIE, doc_state: dict, answers: dict[str, str], output_language: str):
+    chunks_entities = [entity_extraction._answer_parser(answer) for answer in answers.values()]
+    entities = chunks_entities[0] if len(chunks_entities) == 1 else entity_extraction._merge_entities(chunks_entities)
+    doc_state['entities'] = entities
+    # The phrase selection sends no request
+    doc_state['sentences'] = [
+        gpt.phrase_selection(doc_state['doc']['text'], e_i, entities) for e_i in range(len(entities))]
+    doc_state['triplets'] = [None] * len(entities)
+
+
+def _mention_recognition_requests(gpt: GPTOpenIE, doc_state: dict,
+                                  output_language: str) -> list[tuple[str, Prompt, dict]]:
+    # The entities told mentioned by the lexical pre-check (if any) are kept right away
+    entities = doc_state['entities']
+    prefiltered = mention_recognition._prefilter(
+        gpt, doc_state['sentences'], entities, gpt.mention_policy, gpt.mention_index_stats)
+    doc_state['mentions'] = [mentioned_ids for mentioned_ids, _ in prefiltered]
+    requests = []
+    for e_i, (sentence, (_, candidate_ids)) in enumerate(zip(doc_state['sentences'], prefiltered)):
+        if not candidate_ids:
+            continue
+        for g_i, group_ids in enumerate(mention_recognition._split_candidates(gpt, sentence, entities, candidate_ids)):
+            prompt = mention_recognition._build_prompt(sentence, [entities[i] for i in group_ids])
+            requests.append((f'e{e_i}/g{g_i}', prompt, {'entity': e_i, 'ids': group_ids}))
+    return requests
+
+
+def _parse_mention_recognition(gpt: GPTOpenIE, doc_state: dict, answers: dict[str, str], output_language: str):
+    entities = doc_state['entities']
+    recognized_ids = dict()
+    for key, payload in doc_state['requests'].items():
+        group_ids = payload['ids']
+        group_mentions = mention_recognition._answer_parser(answers[key], [entities[i] for i in group_ids])
+        recognized_ids.setdefault(payload['entity'], []).extend([group_ids[i] for i in group_mentions])
+    for e_i, e_recognized_ids in recognized_ids.items():
+        doc_state['mentions'][e_i] = mention_recognition._merge_mentions(doc_state['mentions'][e_i], e_recognized_ids)
+
+
+def _fused_relation_extraction_requests(gpt: GPTOpenIE, doc_state: dict,
+                                        output_language: str) -> list[tuple[str, Prompt, dict]]:
+    return _relation_requests(gpt, fused_relation_extraction, doc_state, output_language)
+
+
+def _parse_fused_relation_extraction(gpt: GPTOpenIE, doc_state: dict, answers: dict[str, str], output_language: str):
+    for e_i, e_groups_triplets in _groups_triplets(fused_relation_extraction, doc_state, answers).items():
+        if any([group_triplets is None for group_triplets in e_groups_triplets]):
+            # Left to the relation extraction and predicate description stages
+            LOGGER.warning('Described relations not parsed: extracting and describing them with two requests instead.')
+            continue
+        triplets = fused_relation_extraction._merge_triplets(e_groups_triplets)
+        fused_relation_extraction._apply_registry(gpt.predicate_registry, triplets, output_language)
+        doc_state['triplets'][e_i] = triplets
+
+
+def _relation_extraction_requests(gpt: GPTOpenIE, doc_state: dict,
+                                  output_language: str) -> list[tuple[str, Prompt, dict]]:
+    return _relation_requests(gpt, relation_extraction, doc_state, output_language)
+
+
+def _parse_relation_extraction(gpt: GPTOpenIE, doc_state: dict, answers: dict[str, str], output_language: str):
+    for e_i, e_groups_triplets in _groups_triplets(relation_extraction, doc_state, answers).items():
+        doc_state['triplets'][e_i] = relation_extraction._merge_triplets(e_groups_triplets)
+
+
+def _relation_requests(gpt: GPTOpenIE, stage_module: ModuleType, doc_state: dict,
+                       output_language: str) -> list[tuple[str, Prompt, dict]]:
+    # Requests of the sentences with at least 2 mentioned entities, whose relations are not known yet
+    sentences, entities = doc_state['sentences'], doc_state['entities']
+    requests = []
+    for e_i, mentioned_ids in enumerate(doc_state['mentions']):
+        if len(mentioned_ids) < 2 or doc_state['triplets'][e_i] is not None:
+            continue
+        for g_i, group_ids in enumerate(
+                stage_module._split_entities(gpt, sentences[e_i], mentioned_ids, entities, output_language)):
+            prompt = stage_module._build_prompt(sentences[e_i], group_ids, entities, output_language)
+            requests.append((f'e{e_i}/g{g_i}', prompt, {'entity': e_i}))
+    return requests
+
+
+def _groups_triplets(stage_module: ModuleType, doc_state: dict,
+                     answers: dict[str, str]) -> dict[int, list[list[dict] | None]]:
+    groups_triplets = dict()
+    for key, payload in doc_state['requests'].items():
+        group_triplets = stage_module._answer_parser(answers[key], doc_state['entities'])
+        groups_triplets.setdefault(payload['entity'], []).append(group_triplets)
+    return groups_triplets
+
+
+def _predicate_description_requests(gpt: GPTOpenIE, doc_state: dict,
+                                    output_language: str) -> list[tuple[str, Prompt, dict]]:
+    # Only the triplets of the relation extraction have no description yet: the fused ones come with it
+    requests = []
+    for e_i, triplets in enumerate(doc_state['triplets']):
+        if not triplets or 'pred_description' in triplets[0]:
+            continue
+        unknown_triplets = predicate_description._reuse_known_predicates(
+            gpt.predicate_registry, triplets, output_language)
+        if not unknown_triplets:
+            continue
+        sentence = doc_state['sentences'][e_i]
+        for g_i, group_triplets in enumerate(
+                predicate_description._split_triplets(gpt, sentence, unknown_triplets, output_language)):
+            # The triplets are referred to by their position, as the state is saved as JSON
+            group_ids = {id(t_dict) for t_dict in group_triplets}
+            prompt = predicate_description._build_prompt(sentence, group_triplets, output_language)
+            requests.append((f'e{e_i}/g{g_i}', prompt, {
+                'entity': e_i, 'ids': [i for i, t_dict in enumerate(triplets) if id(t_dict) in group_ids]}))
+    return requests
+
+
+def _parse_predicate_description(gpt: GPTOpenIE, doc_state: dict, answers: dict[str, str], output_language: str):
+    described_triplets = dict()
+    for key, payload in doc_state['requests'].items():
+        group_triplets = [doc_state['triplets'][payload['entity']][i] for i in payload['ids']]
+        predicate_description._answer_parser(answers[key], group_triplets)
+        described_triplets.setdefault(payload['entity'], []).extend(group_triplets)
+    for e_triplets in described_triplets.values():
+        predicate_description._register_predicates(gpt.predicate_registry, e_triplets, output_language)
+
+
+_STAGE_FUNCTIONS: dict[str, tuple[Callable, Callable]] = {
+    'entity_extraction': (_entity_extraction_requests, _parse_entity_extraction),
+    'mention_recognition': (_mention_recognition_requests, _parse_mention_recognition),
+    'fused_relation_extraction': (_fused_relation_extraction_requests, _parse_fused_relation_extraction),
+    'relation_extraction': (_relation_extraction_requests, _parse_relation_extraction),
+    'predicate_description': (_predicate_description_requests, _parse_predicate_description)
+}
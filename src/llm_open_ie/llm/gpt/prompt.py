@@ -0,0 +1,109 @@
+from __future__ import annotations
+
+from functools import lru_cache
+from typing import Callable
+
+from llm_open_ie.llm import LLM
+from llm_open_ie.logger import LOGGER
+from llm_open_ie.metrics import is_collecting_metrics, record_prompt, record_split_calls
+
+
+# Prompt of a stage call: a system message and the parts of the user message, each one either static (the same for all
+#  the calls of the stage on a document, such as the instructions and the entity list) or dynamic (such as the
+#  sentence). The static parts always come first, so that the calls of a stage share an identical prefix, which the
+#  providers can cache and the stages can count in `prefix_tokens`.
+class Prompt:
+    __system: str
+    __static_user: str
+    __dynamic_user: str
+
+    def __init__(self, system: str, user_parts: list[tuple[str, bool]]):
+        # `user_parts` are the texts of the user message, each one with whether it is static
+        self.__system = system
+        self.__static_user = ''.join([part for part, is_static in user_parts if is_static])
+        self.__dynamic_user = ''.join([part for part, is_static in user_parts if not is_static])
+
+    @property
+    def system(self) -> str:
+        return self.__system
+
+    @property
+    def user(self) -> str:
+        return self.__static_user + self.__dynamic_user
+
+    def num_tokens(self, llm: LLM) -> int:
+        return llm.get_num_tokens(self.__system) + llm.get_num_tokens(self.user)
+
+    def prefix_tokens(self, llm: LLM) -> int:
+        return llm.get_num_tokens(self.__system) + llm.get_num_tokens(self.__static_user)
+
+
+@lru_cache(maxsize=64)
+def format_system(system_template: str, **fields: str) -> str:
+    # The system prompts only depend on the output language: format them once
+    return system_template.format(**fields)
+
+
+def complete(llm: LLM, prompt: Prompt, is_valid_line: Callable[[str], bool] = None) -> str:
+    # `is_valid_line` tells the lines of a well-formed answer of the stage, so that the LLM can ask a stronger model
+    #  again when too many of them are not
+    record_prompt_tokens(llm, prompt)
+    return llm.chat_completion(system=prompt.system, user=prompt.user, **_check_kwargs(is_valid_line))
+
+
+async def async_complete(llm: LLM, prompt: Prompt, is_valid_line: Callable[[str], bool] = None) -> str:
+    record_prompt_tokens(llm, prompt)
+    return await llm.async_chat_completion(system=prompt.system, user=prompt.user, **_check_kwargs(is_valid_line))
+
+
+def _check_kwargs(is_valid_line: Callable[[str], bool] | None) -> dict:
+    # Only passed when set, so that the LLMs not checking the answers are called as before
+    return {'is_valid_line': is_valid_line} if is_valid_line is not None else {}
+
+
+def record_prompt_tokens(llm: LLM, prompt: Prompt):
+    # The tokens are only counted when the metrics are collected
+    if is_collecting_metrics():
+        record_prompt(prompt.num_tokens(llm), prompt.prefix_tokens(llm))
+
+
+def split_to_budget(llm: LLM, build_prompt: Callable[[list], Prompt], items: list,
+                    max_prompt_tokens: int | None) -> list[list]:
+    # Split the `items` listed in a prompt (e.g. the candidate entities) in consecutive groups, each one with a prompt
+    #  within `max_prompt_tokens`; an item exceeding the budget by itself is still sent, alone
+    if max_prompt_tokens is None or not items or build_prompt(items).num_tokens(llm) <= max_prompt_tokens:
+        return [items]
+    groups = _pack(llm, build_prompt, items, max_prompt_tokens)
+    record_split_calls(len(groups) - 1)
+    LOGGER.info(f'Prompt of {len(items)} items split in {len(groups)} calls to fit {max_prompt_tokens} tokens.')
+    return groups
+
+
+def split_pairs_to_budget(llm: LLM, build_prompt: Callable[[list], Prompt], items: list,
+                          max_prompt_tokens: int | None) -> list[list]:
+    # Split the `items` listed in a prompt so that each pair of them (e.g. the subject and object of a relation) is
+    #  still listed together in at least one group within `max_prompt_tokens`: the items are packed in halves of the
+    #  budget, which are then sent two by two
+    if max_prompt_tokens is None or not items or build_prompt(items).num_tokens(llm) <= max_prompt_tokens:
+        return [items]
+    base_tokens = build_prompt([]).num_tokens(llm)
+    halves = _pack(llm, build_prompt, items, base_tokens + (max_prompt_tokens - base_tokens) // 2)
+    groups = [halves[i] + halves[j] for i in range(len(halves)) for j in range(i + 1, len(halves))] or halves
+    record_split_calls(len(groups) - 1)
+    LOGGER.info(f'Prompt of {len(items)} items split in {len(groups)} calls to fit {max_prompt_tokens} tokens.')
+    return groups
+
+
+def _pack(llm: LLM, build_prompt: Callable[[list], Prompt], items: list, max_prompt_tokens: int) -> list[list]:
+    # Tokens of each item estimated once, as the tokens it adds to the prompt without items
+    base_tokens = build_prompt([]).num_tokens(llm)
+    groups, group, group_tokens = [], [], base_tokens
+    for item in items:
+        item_tokens = build_prompt([item]).num_tokens(llm) - base_tokens
+        if group and group_tokens + item_tokens > max_prompt_tokens:
+            groups.append(group)
+            group, group_tokens = [], base_tokens
+        group.append(item)
+        group_tokens += item_tokens
+    groups.append(group)
+    return groups
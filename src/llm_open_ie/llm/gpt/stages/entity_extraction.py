@@ -1,7 +1,15 @@
+from concurrent.futures import ThreadPoolExecutor
+from typing import AsyncIterator, Iterable, Iterator
+import asyncio
+import contextvars
 import re
 
+from llm_open_ie.chunking import split_text
 from llm_open_ie.llm.gpt import GPTOpenIE
+from llm_open_ie.llm.gpt.prompt import Prompt, async_complete, complete, format_system, record_prompt_tokens
 from llm_open_ie.logger import LOGGER
+from llm_open_ie.matching import normalize_label
+from llm_open_ie.metrics import record_parse
 
 SYSTEM = '''\
 The information in a text is expressed by mentions of concepts such as assertions, facts, individuals, objects,\
@@ -15,37 +23,212 @@ The user text language may be anything, but your output should be {output_langua
 '''
 
 
-def extract_entities(gpt: GPTOpenIE, text: str, output_language: str) -> list[dict]:
-    answer = gpt.chat_completion(
-        system=SYSTEM.format(output_language=output_language),
-        user=text)
+# Texts longer than this number of tokens are split in chunks, whose entities are extracted separately and then merged
+MAX_CHUNK_TOKENS = 1_500
+# Number of tokens shared by consecutive chunks
+CHUNK_OVERLAP_TOKENS = 100
+# Maximum number of chunks whose entities are extracted at the same time
+MAX_PARALLEL_CHUNKS = 4
+
+
+def extract_entities(gpt: GPTOpenIE, text: str, output_language: str,
+                     max_chunk_tokens: int = MAX_CHUNK_TOKENS,
+                     chunk_overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> list[dict]:
+    chunks = split_text(text, gpt.get_num_tokens, max_chunk_tokens, chunk_overlap_tokens)
+    if len(chunks) <= 1:
+        return _extract_chunk_entities(gpt, text, output_language)
+
+    LOGGER.info(f'Text split in {len(chunks)} chunks for the entity extraction.')
+    with ThreadPoolExecutor(max_workers=MAX_PARALLEL_CHUNKS) as executor:
+        # Each chunk runs in a copy of the caller context, so that the context variables (e.g. the benchmark stage)
+        #  are still set in the worker threads
+        chunks_futures = [
+            executor.submit(contextvars.copy_context().run, _extract_chunk_entities, gpt, chunk, output_language)
+            for chunk in chunks
+        ]
+        chunks_entities = [chunk_future.result() for chunk_future in chunks_futures]
+    return _merge_entities(chunks_entities)
+
+
+async def async_extract_entities(gpt: GPTOpenIE, text: str, output_language: str,
+                                 max_chunk_tokens: int = MAX_CHUNK_TOKENS,
+                                 chunk_overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> list[dict]:
+    chunks = split_text(text, gpt.get_num_tokens, max_chunk_tokens, chunk_overlap_tokens)
+    if len(chunks) <= 1:
+        return await _async_extract_chunk_entities(gpt, text, output_language)
+
+    LOGGER.info(f'Text split in {len(chunks)} chunks for the entity extraction.')
+    semaphore = asyncio.Semaphore(MAX_PARALLEL_CHUNKS)
+
+    async def extract_chunk_entities(chunk: str) -> list[dict]:
+        async with semaphore:
+            return await _async_extract_chunk_entities(gpt, chunk, output_language)
+
+    chunks_entities = await asyncio.gather(*[extract_chunk_entities(chunk) for chunk in chunks])
+    return _merge_entities(chunks_entities)
+
+
+def iter_entities(gpt: GPTOpenIE, text: str, output_language: str,
+                  max_chunk_tokens: int = MAX_CHUNK_TOKENS,
+                  chunk_overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> Iterator[dict]:
+    # Same as `extract_entities`, but yielding each entity as soon as its answer line is streamed. The entities of the
+    #  first chunk are streamed while the other chunks are extracted in the background: their new entities are yielded
+    #  afterwards, in the chunks order, and the types of the duplicates are added to the already yielded entities
+    chunks = split_text(text, gpt.get_num_tokens, max_chunk_tokens, chunk_overlap_tokens)
+    if len(chunks) <= 1:
+        yield from _iter_chunk_entities(gpt, text, output_language)
+        return
+
+    LOGGER.info(f'Text split in {len(chunks)} chunks for the entity extraction.')
+    merged_entities = dict()
+    with ThreadPoolExecutor(max_workers=max(1, MAX_PARALLEL_CHUNKS - 1)) as executor:
+        chunks_futures = [
+            executor.submit(contextvars.copy_context().run, _extract_chunk_entities, gpt, chunk, output_language)
+            for chunk in chunks[1:]
+        ]
+        try:
+            yield from _iter_new_entities(merged_entities, _iter_chunk_entities(gpt, chunks[0], output_language))
+            for chunk_future in chunks_futures:
+                yield from _iter_new_entities(merged_entities, chunk_future.result())
+        finally:
+            for chunk_future in chunks_futures:
+                chunk_future.cancel()
+
+
+async def async_iter_entities(gpt: GPTOpenIE, text: str, output_language: str,
+                              max_chunk_tokens: int = MAX_CHUNK_TOKENS,
+                              chunk_overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> AsyncIterator[dict]:
+    chunks = split_text(text, gpt.get_num_tokens, max_chunk_tokens, chunk_overlap_tokens)
+    if len(chunks) <= 1:
+        async for e_dict in _async_iter_chunk_entities(gpt, text, output_language):
+            yield e_dict
+        return
+
+    LOGGER.info(f'Text split in {len(chunks)} chunks for the entity extraction.')
+    semaphore = asyncio.Semaphore(max(1, MAX_PARALLEL_CHUNKS - 1))
+
+    async def extract_chunk_entities(chunk: str) -> list[dict]:
+        async with semaphore:
+            return await _async_extract_chunk_entities(gpt, chunk, output_language)
+
+    merged_entities = dict()
+    chunks_tasks = [asyncio.create_task(extract_chunk_entities(chunk)) for chunk in chunks[1:]]
+    try:
+        async for e_dict in _async_iter_chunk_entities(gpt, chunks[0], output_language):
+            for new_e_dict in _iter_new_entities(merged_entities, [e_dict]):
+                yield new_e_dict
+        for chunk_task in chunks_tasks:
+            for new_e_dict in _iter_new_entities(merged_entities, await chunk_task):
+                yield new_e_dict
+    finally:
+        for chunk_task in chunks_tasks:
+            chunk_task.cancel()
+
+
+def _extract_chunk_entities(gpt: GPTOpenIE, text: str, output_language: str) -> list[dict]:
+    answer = complete(gpt, _build_prompt(text, output_language), is_valid_line=_matches_answer_line_pattern)
     return _answer_parser(answer)
 
 
+async def _async_extract_chunk_entities(gpt: GPTOpenIE, text: str, output_language: str) -> list[dict]:
+    answer = await async_complete(
+        gpt, _build_prompt(text, output_language), is_valid_line=_matches_answer_line_pattern)
+    return _answer_parser(answer)
+
+
+def _iter_chunk_entities(gpt: GPTOpenIE, text: str, output_language: str) -> Iterator[dict]:
+    prompt = _build_prompt(text, output_language)
+    record_prompt_tokens(gpt, prompt)
+    n_lines, n_parsed_lines = 0, 0
+    for line in gpt.stream_chat_completion(system=prompt.system, user=prompt.user):
+        if not line.strip():
+            continue
+        n_lines += 1
+        if _is_valid_answer_line_pattern(line):
+            n_parsed_lines += 1
+            yield _parse_answer_line(line)
+    _report_dropped_lines(n_lines, n_parsed_lines)
+
+
+async def _async_iter_chunk_entities(gpt: GPTOpenIE, text: str, output_language: str) -> AsyncIterator[dict]:
+    prompt = _build_prompt(text, output_language)
+    record_prompt_tokens(gpt, prompt)
+    n_lines, n_parsed_lines = 0, 0
+    async for line in gpt.async_stream_chat_completion(system=prompt.system, user=prompt.user):
+        if not line.strip():
+            continue
+        n_lines += 1
+        if _is_valid_answer_line_pattern(line):
+            n_parsed_lines += 1
+            yield _parse_answer_line(line)
+    _report_dropped_lines(n_lines, n_parsed_lines)
+
+
+def _build_prompt(text: str, output_language: str) -> Prompt:
+    # Only the system prompt is shared by the calls: the whole user message is the text
+    return Prompt(format_system(SYSTEM, output_language=output_language), [(text, False)])
+
+
+def _merge_entities(chunks_entities: list[list[dict]]) -> list[dict]:
+    # Keep the first occurrence of each entity (in the text order), matching the duplicates from other chunks by their
+    #  normalized label and adding their types to the ones of the kept entity
+    merged_entities = dict()
+    for chunk_entities in chunks_entities:
+        for _ in _iter_new_entities(merged_entities, chunk_entities):
+            pass
+
+    n_duplicates = sum([len(chunk_entities) for chunk_entities in chunks_entities]) - len(merged_entities)
+    if n_duplicates > 0:
+        LOGGER.info(f'Merged {n_duplicates} entities found in more than one chunk.')
+
+    return list(merged_entities.values())
+
+
+def _iter_new_entities(merged_entities: dict[str, dict], entities: Iterable[dict]) -> Iterator[dict]:
+    # Add the entities to the merged ones, yielding only the new ones: the types of the duplicates are added to the
+    #  merged entity instead
+    for e_dict in entities:
+        key = normalize_label(e_dict['label'])
+        if key not in merged_entities:
+            merged_entities[key] = {**e_dict, 'types': list(e_dict['types'])}
+            yield merged_entities[key]
+            continue
+        merged_types = merged_entities[key]['types']
+        merged_types_keys = {t.lower() for t in merged_types}
+        merged_types.extend([t for t in e_dict['types'] if t.lower() not in merged_types_keys])
+
+
 def _answer_parser(answer: str) -> list[dict]:
     answer_lines = answer.strip().split('\n')
     parsed_answer_lines = [_parse_answer_line(line) for line in answer_lines if _is_valid_answer_line_pattern(line)]
+    _report_dropped_lines(len(answer_lines), len(parsed_answer_lines))
+    return parsed_answer_lines
 
-    n_dropped_lines = len(answer_lines) - len(parsed_answer_lines)
-    if n_dropped_lines > 0:
-        LOGGER.warning(f'Dropped {n_dropped_lines}/{len(answer_lines)} wrongly spelled entities information.')
 
-    return parsed_answer_lines
+def _report_dropped_lines(n_lines: int, n_parsed_lines: int):
+    n_dropped_lines = n_lines - n_parsed_lines
+    if n_dropped_lines > 0:
+        LOGGER.warning(f'Dropped {n_dropped_lines}/{n_lines} wrongly spelled entities information.')
+    record_parse(n_lines, n_dropped_lines)
 
 
 def _is_valid_answer_line_pattern(answer_line: str) -> bool:
+    is_valid = _matches_answer_line_pattern(answer_line)
+    if not is_valid:
+        LOGGER.warning(f'Wrongly spelled entity information: "{answer_line}".')
+
+    return is_valid
+
+
+def _matches_answer_line_pattern(answer_line: str) -> bool:
     # Regular expression to describe the full pattern of a line in the answer
-    is_valid = bool(re.fullmatch(
+    return bool(re.fullmatch(
         r'- ?([^|]+)'                # Entity label
         r'([|]{3})'                  # Separator
         r'([^|]+)'                   # Entity description
         r'([|]{3})'                  # Separator
         r'( ?\[([^,]+, ?)*[^,]+])',  # Entity types (comma separator)
         answer_line.strip()))
-    if not is_valid:
-        LOGGER.warning(f'Wrongly spelled entity information: "{answer_line}".')
-
-    return is_valid
 
 
 def _parse_answer_line(answer_line: str) -> dict:
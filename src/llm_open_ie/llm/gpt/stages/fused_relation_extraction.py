@@ -0,0 +1,156 @@
+import asyncio
+import re
+
+from llm_open_ie.llm.gpt import GPTOpenIE
+from llm_open_ie.llm.gpt.prompt import Prompt, async_complete, complete, format_system, split_pairs_to_budget
+from llm_open_ie.llm.gpt.stages.relation_extraction import (
+    ENTITY_COUNT_START, USER_ENTITIES, USER_SENTENCE, _check_mention_consistency, _merge_triplets, _parse_entity_string)
+from llm_open_ie.logger import LOGGER
+from llm_open_ie.metrics import record_parse
+from llm_open_ie.predicate_registry import PredicateRegistry
+
+SYSTEM = '''\
+You find relations between entities in the text and describe them: the user provides you a list of known entities and\
+ a sentence in which those entities may be related. For each entity you check the relation with the other entities and\
+ if it exists you express the relation using a "predicate" that is expressive yet straightforward (max 5 words). Think\
+ about a predicate that could be used in an ontology for a knowledge graph.
+For each relation, you also provide an extended description of its "predicate", which means you give a summary of the\
+ type of relation, characteristics, behaviors, or associations that the "predicate" is expressing between the\
+ "subject" and "object". The description must be general and reusable, so it must make no explicit references to the\
+ "subject" and "object".
+Your output is the list of relations formatted as RDF triplets followed by the predicate description, that you format\
+ with an initial hyphen this way:
+`- <entity> (<entity index>)|||<predicate>|||<entity> (<entity index>)|||<predicate description>`
+The user text language may be anything, but your output should be {output_language}!
+'''
+
+# Minimum share of the answer lines to parse as consistent triplets: below it, the answer is rejected and the relations
+#  are extracted and described again by the two separate stages
+MIN_PARSED_LINES_RATIO = 0.5
+
+
+def extract_described_relations(gpt: GPTOpenIE, sentence: str, sentence_entities_ids: list[int],
+                                entities: list[dict], output_language: str) -> list[dict] | None:
+    # Extract the relations in the sentence together with the descriptions of their predicates, with a single call
+    #  (for each group of entities, when they do not fit in the prompt budget of `gpt`); `None` if an answer is rejected
+    groups_triplets = []
+    for group_ids in _split_entities(gpt, sentence, sentence_entities_ids, entities, output_language):
+        answer = complete(gpt, _build_prompt(sentence, group_ids, entities, output_language),
+                          is_valid_line=_matches_answer_line_pattern)
+        group_triplets = _answer_parser(answer, entities)
+        if group_triplets is None:
+            return None
+        groups_triplets.append(group_triplets)
+    triplets = _merge_triplets(groups_triplets)
+    _apply_registry(gpt.predicate_registry, triplets, output_language)
+    return triplets
+
+
+async def async_extract_described_relations(gpt: GPTOpenIE, sentence: str, sentence_entities_ids: list[int],
+                                            entities: list[dict], output_language: str) -> list[dict] | None:
+    async def extract_group_relations(group_ids: list[int]) -> list[dict] | None:
+        answer = await async_complete(gpt, _build_prompt(sentence, group_ids, entities, output_language),
+                                      is_valid_line=_matches_answer_line_pattern)
+        return _answer_parser(answer, entities)
+
+    groups_triplets = await asyncio.gather(*[
+        extract_group_relations(group_ids)
+        for group_ids in _split_entities(gpt, sentence, sentence_entities_ids, entities, output_language)
+    ])
+    if any([group_triplets is None for group_triplets in groups_triplets]):
+        return None
+    triplets = _merge_triplets(groups_triplets)
+    _apply_registry(gpt.predicate_registry, triplets, output_language)
+    return triplets
+
+
+def _split_entities(gpt: GPTOpenIE, sentence: str, sentence_entities_ids: list[int],
+                    entities: list[dict], output_language: str) -> list[list[int]]:
+    return split_pairs_to_budget(
+        gpt, lambda ids: _build_prompt(sentence, ids, entities, output_language), sentence_entities_ids,
+        gpt.max_prompt_tokens)
+
+
+def _apply_registry(registry: PredicateRegistry | None, triplets: list[dict], output_language: str):
+    # The descriptions come with the relations, so no call is saved by the registry: still, the registered descriptions
+    #  replace the generated ones, to describe the same predicates in the same way in every document
+    if registry is None:
+        return
+    for triplet_dict in triplets:
+        pred_description = registry.get(triplet_dict['pred_label'], output_language)
+        if pred_description is not None:
+            triplet_dict['pred_description'] = pred_description
+        else:
+            registry.add(triplet_dict['pred_label'], triplet_dict['pred_description'], output_language)
+
+
+def _build_prompt(sentence: str, sentence_entities_ids: list[int],
+                  entities: list[dict], output_language: str) -> Prompt:
+    sentence_entities = [(i + ENTITY_COUNT_START, entities[i],) for i in sentence_entities_ids]
+    entities_list_str = '\n'.join([f'{i}) {e["label"]}' for i, e in sentence_entities])
+    return Prompt(format_system(SYSTEM, output_language=output_language), [
+        (USER_ENTITIES.format(entities_numbered_list=entities_list_str), True),
+        (USER_SENTENCE.format(context_sentence=sentence), False)
+    ])
+
+
+def _answer_parser(answer: str, entities: list[dict]) -> list[dict] | None:
+    answer_lines = [line for line in answer.strip().split('\n') if line.strip()]
+    parsed_answer_lines = [_parse_answer_line(line) for line in answer_lines if _is_valid_answer_line_pattern(line)]
+
+    n_dropped_lines = len(answer_lines) - len(parsed_answer_lines)
+    if n_dropped_lines > 0:
+        LOGGER.warning(f'Dropped {n_dropped_lines}/{len(answer_lines)} wrongly spelled described relation information.')
+
+    entities_labels = [e['label'].lower() for e in entities]
+    consistent_answers = [
+        answer for answer in parsed_answer_lines if _check_mention_consistency(answer, entities_labels)]
+    n_dropped_lines = len(parsed_answer_lines) - len(consistent_answers)
+    if n_dropped_lines > 0:
+        LOGGER.warning(
+            f'Dropped {n_dropped_lines}/{len(parsed_answer_lines)} inconsistent described relation information.')
+    record_parse(len(answer_lines), len(answer_lines) - len(parsed_answer_lines), n_dropped_lines)
+
+    if len(consistent_answers) < MIN_PARSED_LINES_RATIO * len(answer_lines):
+        LOGGER.warning(f'Rejected the described relations answer: only {len(consistent_answers)}/{len(answer_lines)}'
+                       f' lines parsed.')
+        return None
+    return consistent_answers
+
+
+def _is_valid_answer_line_pattern(answer_line: str) -> bool:
+    is_valid = _matches_answer_line_pattern(answer_line)
+    if not is_valid:
+        LOGGER.warning(f'Wrongly spelled described relation information: "{answer_line}".')
+
+    return is_valid
+
+
+def _matches_answer_line_pattern(answer_line: str) -> bool:
+    # Regular expression to describe the full pattern of a line in the answer
+    return bool(re.fullmatch(
+        r'- ?([^|]+)\(\d+\) ?'  # Entity label and ID
+        r'([|]{3})'              # Separator
+        r'([^|]+)'               # Predicate label
+        r'([|]{3})'              # Separator
+        r'([^|]+)\(\d+\) ?'     # Object label and ID
+        r'([|]{3})'              # Separator
+        r'([^|]+)',              # Predicate description
+        answer_line.strip()))
+
+
+def _parse_answer_line(answer_line: str) -> dict:
+    # Skip the starting hyphen '- ' and split by '|||' to get the triplets components and the predicate description
+    subject, predicate, object, description = re.sub(r'^- ?', '', answer_line.strip()).split('|||')
+
+    subject_label, subject_id = _parse_entity_string(subject)
+    object_label, object_id = _parse_entity_string(object)
+
+    return {
+        'subj_label': subject_label,
+        'subj_id': subject_id,
+        'pred_label': predicate.strip(),
+        'obj_label': object_label,
+        'obj_id': object_id,
+        'pred_description': description.strip()
+    }
@@ -1,8 +1,12 @@
-from difflib import SequenceMatcher
+import asyncio
 import re
 
 from llm_open_ie.llm.gpt import GPTOpenIE
+from llm_open_ie.llm.gpt.prompt import Prompt, async_complete, complete, split_to_budget
 from llm_open_ie.logger import LOGGER
+from llm_open_ie.metrics import record_parse
+from llm_open_ie.matching import ratio_at_least
+from llm_open_ie.mention_index import MENTION_POLICIES, MentionIndexStats, get_mention_index
 
 SYSTEM = '''\
 You identify mentions of entities in the text: the user provides you a list of known entities and a sentence in which\
@@ -12,30 +16,251 @@ You write the user list again in the same order with your additional answer form
 `<entity ID>) <entity>|||<yes/no>`
 '''
 
-USER = '''\
+# The user message lists the entities first, so that the calls on the same entities share the prompt prefix
+USER_ENTITIES = '''\
 User entities:
 ```
 {entities_numbered_list}
 ```
 
+'''
+
+USER_SENTENCE = '''\
 Sentence:
 ```
 {context_sentence}
 ```
 '''
 
+BATCH_SYSTEM = '''\
+You identify mentions of entities in the text: the user provides you a list of known entities and some numbered\
+ sentences in which those entities may be mentioned. For each sentence and for each entity you tell if the entity is\
+ actually mentioned in that sentence by saying "yes" or "no".
+For each sentence, you write its header and then the user list again in the same order with your additional answer,\
+ formatted this way:
+`Sentence <sentence ID>:`
+`<entity ID>) <entity>|||<yes/no>`
+'''
+
+BATCH_USER_SENTENCES = '''\
+Sentences:
+{numbered_sentences}
+'''
+
+BATCH_SENTENCE = '''\
+Sentence {sentence_id}:
+```
+{context_sentence}
+```
+'''
+
 ENTITY_COUNT_START = 1
+SENTENCE_COUNT_START = 1
 LABEL_SIM_RATIO_TH = 0.90
+# Maximum number of tokens of a batched request, counting both the prompt and the expected answer
+BATCH_MAX_TOKENS = 3_500
+# Tokens of the "yes"/"no" answer and separators added to each entity line of the answer
+ANSWER_LINE_OVERHEAD_TOKENS = 4
+
+
+def recognize_mentions(gpt: GPTOpenIE, sentence: str, entities: list[dict],
+                       mention_policy: str = 'off', stats: MentionIndexStats = None) -> list[int]:
+    # With the `prefilter` policy, only the entities that cannot be told mentioned or absent by the lexical index are
+    #  checked by the LLM; with the `lexical` policy, the LLM is never asked
+    [(mentioned_ids, candidate_ids)] = _prefilter(gpt, [sentence], entities, mention_policy, stats)
+    if not candidate_ids:
+        return mentioned_ids
+    return _merge_mentions(mentioned_ids, _recognize_candidates(gpt, sentence, entities, candidate_ids))
+
+
+async def async_recognize_mentions(gpt: GPTOpenIE, sentence: str, entities: list[dict],
+                                   mention_policy: str = 'off', stats: MentionIndexStats = None) -> list[int]:
+    [(mentioned_ids, candidate_ids)] = _prefilter(gpt, [sentence], entities, mention_policy, stats)
+    if not candidate_ids:
+        return mentioned_ids
+    return _merge_mentions(mentioned_ids, await _async_recognize_candidates(gpt, sentence, entities, candidate_ids))
+
+
+def recognize_mentions_batch(gpt: GPTOpenIE, sentences: list[str], entities: list[dict],
+                             max_batch_tokens: int = BATCH_MAX_TOKENS,
+                             mention_policy: str = 'off', stats: MentionIndexStats = None) -> list[list[int]]:
+    # Check many sentences against the same entity list with a single request, sending the list only once; the
+    #  sentences whose answer cannot be told apart in the batched answer are checked again one by one
+    prefiltered = _prefilter(gpt, sentences, entities, mention_policy, stats)
+    sentences_mentions = [None] * len(sentences)
+    for batch, batch_entities_ids in _pack_batches(gpt, sentences, entities, prefiltered, max_batch_tokens):
+        if len(batch) > 1:
+            batch_entities = [entities[i] for i in batch_entities_ids]
+            answer = complete(gpt, _build_batch_prompt([sentences[i] for i in batch], batch_entities))
+            for i, mentions in zip(batch, _batch_answer_parser(answer, batch_entities, len(batch))):
+                if mentions is not None:
+                    sentences_mentions[i] = _merge_batch_mentions(prefiltered[i], batch_entities_ids, mentions)
+        for i in batch:
+            if sentences_mentions[i] is None:
+                mentioned_ids, candidate_ids = prefiltered[i]
+                sentences_mentions[i] = _merge_mentions(
+                    mentioned_ids, _recognize_candidates(gpt, sentences[i], entities, candidate_ids))
+    return [
+        mentions if mentions is not None else prefiltered[i][0] for i, mentions in enumerate(sentences_mentions)]
+
+
+async def async_recognize_mentions_batch(gpt: GPTOpenIE, sentences: list[str], entities: list[dict],
+                                         max_batch_tokens: int = BATCH_MAX_TOKENS,
+                                         mention_policy: str = 'off', stats: MentionIndexStats = None
+                                         ) -> list[list[int]]:
+    prefiltered = _prefilter(gpt, sentences, entities, mention_policy, stats)
+    sentences_mentions = [None] * len(sentences)
+
+    async def recognize_batch(batch: list[int], batch_entities_ids: list[int]):
+        if len(batch) > 1:
+            batch_entities = [entities[i] for i in batch_entities_ids]
+            answer = await async_complete(gpt, _build_batch_prompt([sentences[i] for i in batch], batch_entities))
+            for i, mentions in zip(batch, _batch_answer_parser(answer, batch_entities, len(batch))):
+                if mentions is not None:
+                    sentences_mentions[i] = _merge_batch_mentions(prefiltered[i], batch_entities_ids, mentions)
+        for i in batch:
+            if sentences_mentions[i] is None:
+                mentioned_ids, candidate_ids = prefiltered[i]
+                sentences_mentions[i] = _merge_mentions(
+                    mentioned_ids, await _async_recognize_candidates(gpt, sentences[i], entities, candidate_ids))
+
+    await asyncio.gather(*[
+        recognize_batch(batch, batch_entities_ids)
+        for batch, batch_entities_ids in _pack_batches(gpt, sentences, entities, prefiltered, max_batch_tokens)
+    ])
+    return [
+        mentions if mentions is not None else prefiltered[i][0] for i, mentions in enumerate(sentences_mentions)]
+
+
+def _recognize_candidates(gpt: GPTOpenIE, sentence: str, entities: list[dict], candidate_ids: list[int]) -> list[int]:
+    # Ask only about the candidate entities, renumbered in the prompt, and map the answer back to the entity IDs; the
+    #  candidates not fitting in the prompt budget of `gpt` are asked about in more calls
+    recognized_ids = []
+    for group_ids in _split_candidates(gpt, sentence, entities, candidate_ids):
+        group_entities = [entities[i] for i in group_ids]
+        answer = complete(gpt, _build_prompt(sentence, group_entities), is_valid_line=_matches_answer_line_pattern)
+        recognized_ids.extend([group_ids[i] for i in _answer_parser(answer, group_entities)])
+    return recognized_ids
+
+
+async def _async_recognize_candidates(gpt: GPTOpenIE, sentence: str, entities: list[dict],
+                                      candidate_ids: list[int]) -> list[int]:
+    async def recognize_group(group_ids: list[int]) -> list[int]:
+        group_entities = [entities[i] for i in group_ids]
+        answer = await async_complete(
+            gpt, _build_prompt(sentence, group_entities), is_valid_line=_matches_answer_line_pattern)
+        return [group_ids[i] for i in _answer_parser(answer, group_entities)]
+
+    groups_recognized_ids = await asyncio.gather(*[
+        recognize_group(group_ids) for group_ids in _split_candidates(gpt, sentence, entities, candidate_ids)])
+    return [i for group_recognized_ids in groups_recognized_ids for i in group_recognized_ids]
+
+
+def _split_candidates(gpt: GPTOpenIE, sentence: str, entities: list[dict], candidate_ids: list[int]) -> list[list[int]]:
+    return split_to_budget(
+        gpt, lambda ids: _build_prompt(sentence, [entities[i] for i in ids]), candidate_ids, gpt.max_prompt_tokens)
+
+
+def _prefilter(gpt: GPTOpenIE, sentences: list[str], entities: list[dict],
+               mention_policy: str, stats: MentionIndexStats = None) -> list[tuple[list[int], list[int]]]:
+    # Get, for each sentence, the entities already known to be mentioned and the candidates to ask the LLM about
+    if mention_policy not in MENTION_POLICIES:
+        options_str = ', '.join([f'`{v}`' for v in MENTION_POLICIES])
+        raise ValueError(f'`{mention_policy}` is not a valid option: choose one between {options_str}')
+    if mention_policy == 'off':
+        return [([], list(range(len(entities)))) for _ in sentences]
+
+    mention_index = get_mention_index(tuple([e['label'] for e in entities]))
+    prefiltered = []
+    for sentence in sentences:
+        mentioned_ids, absent_ids, ambiguous_ids = mention_index.classify(sentence)
+        candidate_ids = ambiguous_ids if mention_policy == 'prefilter' else []
+        prefiltered.append((mentioned_ids, candidate_ids))
 
+        if stats is not None:
+            full_prompt_tokens = _build_prompt(sentence, entities).num_tokens(gpt)
+            candidates_prompt_tokens = _build_prompt(
+                sentence, [entities[i] for i in candidate_ids]).num_tokens(gpt) if candidate_ids else 0
+            stats.add(
+                sentences=1,
+                skipped_requests=int(not candidate_ids),
+                saved_prompt_tokens=full_prompt_tokens - candidates_prompt_tokens,
+                lexical_mentions=len(mentioned_ids),
+                lexical_absences=len(absent_ids),
+                ambiguous=len(ambiguous_ids)
+            )
+    return prefiltered
 
-def recognize_mentions(gpt: GPTOpenIE, sentence: str, entities: list[dict]) -> list[int]:
-    entities_list_str = '\n'.join([f'{i}) {e["label"]}' for i, e in enumerate(entities, ENTITY_COUNT_START)])
 
-    answer = gpt.chat_completion(
-        system=SYSTEM,
-        user=USER.format(entities_numbered_list=entities_list_str, context_sentence=sentence)
-    )
-    return _answer_parser(answer, entities)
+def _merge_mentions(mentioned_ids: list[int], recognized_ids: list[int]) -> list[int]:
+    if not mentioned_ids:
+        return recognized_ids
+    return sorted(set(mentioned_ids) | set(recognized_ids))
+
+
+def _merge_batch_mentions(prefiltered: tuple[list[int], list[int]], batch_entities_ids: list[int],
+                          batch_mentions: list[int]) -> list[int]:
+    # The batch is asked about the candidates of all its sentences: keep only the ones of this sentence
+    mentioned_ids, candidate_ids = prefiltered
+    candidate_ids = set(candidate_ids)
+    recognized_ids = [batch_entities_ids[i] for i in batch_mentions if batch_entities_ids[i] in candidate_ids]
+    return _merge_mentions(mentioned_ids, recognized_ids)
+
+
+def _build_prompt(sentence: str, entities: list[dict]) -> Prompt:
+    return Prompt(SYSTEM, [
+        (USER_ENTITIES.format(entities_numbered_list=_entities_list_str(entities)), True),
+        (USER_SENTENCE.format(context_sentence=sentence), False)
+    ])
+
+
+def _build_batch_prompt(sentences: list[str], entities: list[dict]) -> Prompt:
+    numbered_sentences = '\n'.join([
+        BATCH_SENTENCE.format(sentence_id=i, context_sentence=sentence)
+        for i, sentence in enumerate(sentences, SENTENCE_COUNT_START)
+    ])
+    return Prompt(BATCH_SYSTEM, [
+        (USER_ENTITIES.format(entities_numbered_list=_entities_list_str(entities)), True),
+        (BATCH_USER_SENTENCES.format(numbered_sentences=numbered_sentences), False)
+    ])
+
+
+def _entities_list_str(entities: list[dict]) -> str:
+    return '\n'.join([f'{i}) {e["label"]}' for i, e in enumerate(entities, ENTITY_COUNT_START)])
+
+
+def _pack_batches(gpt: GPTOpenIE, sentences: list[str], entities: list[dict],
+                  prefiltered: list[tuple[list[int], list[int]]],
+                  max_batch_tokens: int) -> list[tuple[list[int], list[int]]]:
+    # Greedily fill each batch with consecutive sentences, as long as the prompt and the expected answer (which repeats
+    #  the whole entity list for each sentence) fit in the tokens budget, and the prompt alone in the one of `gpt`. The
+    #  sentences without candidates are skipped, and each batch is asked only about the candidate entities of its
+    #  sentences
+    batches = []
+    batch, batch_entities_ids = [], set()
+
+    def fits_batch(batch_sentences_ids: list[int], entities_ids: set[int]) -> bool:
+        entities_ids = sorted(entities_ids)
+        batch_entities = [entities[i] for i in entities_ids]
+        prompt_tokens = _build_batch_prompt([sentences[i] for i in batch_sentences_ids], batch_entities).num_tokens(gpt)
+        if gpt.max_prompt_tokens is not None and prompt_tokens > gpt.max_prompt_tokens:
+            return False
+        answer_tokens = gpt.get_num_tokens(_entities_list_str(batch_entities))
+        answer_tokens += ANSWER_LINE_OVERHEAD_TOKENS * len(batch_entities)
+        return prompt_tokens + answer_tokens * len(batch_sentences_ids) <= max_batch_tokens
+
+    for i, (_, candidate_ids) in enumerate(prefiltered):
+        if not candidate_ids:
+            continue
+        extended_entities_ids = batch_entities_ids | set(candidate_ids)
+        if batch and not fits_batch(batch + [i], extended_entities_ids):
+            batches.append((batch, sorted(batch_entities_ids)))
+            batch, extended_entities_ids = [], set(candidate_ids)
+        batch.append(i)
+        batch_entities_ids = extended_entities_ids
+    if batch:
+        batches.append((batch, sorted(batch_entities_ids)))
+    return batches
 
 
 def _answer_parser(answer: str, entities: list[dict]) -> list[int]:
@@ -46,26 +271,74 @@ def _answer_parser(answer: str, entities: list[dict]) -> list[int]:
     if n_dropped_lines > 0:
         LOGGER.warning(f'Dropped {n_dropped_lines}/{len(answer_lines)} wrongly spelled mentions information.')
 
-    consistent_answers = [answer for answer in parsed_answer_lines if _check_mention_consistency(answer, entities)]
+    entities_labels = [e['label'].lower() for e in entities]
+    consistent_answers = [
+        answer for answer in parsed_answer_lines if _check_mention_consistency(answer, entities_labels)]
     n_dropped_lines = len(parsed_answer_lines) - len(consistent_answers)
     if n_dropped_lines > 0:
         LOGGER.warning(f'Dropped {n_dropped_lines}/{len(parsed_answer_lines)} inconsistent mentions information.')
+    record_parse(len(answer_lines), len(answer_lines) - len(parsed_answer_lines), n_dropped_lines)
+
+    return [entity_mention['id'] for entity_mention in consistent_answers if entity_mention['is_mentioned']]
+
+
+def _batch_answer_parser(answer: str, entities: list[dict], n_sentences: int) -> list[list[int] | None]:
+    # Split the answer in the sections introduced by the sentence headers and parse each one as a single answer; the
+    #  sentences without a complete section are returned as `None`
+    sections_lines = dict()
+    section_lines = None
+    for line in answer.strip().split('\n'):
+        header_match = re.fullmatch(r'[#* ]*Sentence (\d+)[#*:. ]*', line.strip(), flags=re.IGNORECASE)
+        if header_match:
+            section_lines = sections_lines.setdefault(int(header_match.group(1)) - SENTENCE_COUNT_START, [])
+        elif section_lines is not None and line.strip():
+            section_lines.append(line)
+
+    n_missing_sections = sum([1 for i in range(n_sentences) if not sections_lines.get(i)])
+    if n_missing_sections > 0:
+        LOGGER.warning(f'Missing {n_missing_sections}/{n_sentences} sentences in batched mentions information.')
+
+    return [
+        _section_parser(sections_lines[i], entities) if sections_lines.get(i) else None for i in range(n_sentences)
+    ]
+
+
+def _section_parser(section_lines: list[str], entities: list[dict]) -> list[int] | None:
+    # Unlike a single answer, a section is only kept when all its lines are well formed and consistent and they answer
+    #  for every entity: otherwise (e.g. in a truncated answer) its sentence is checked again on its own
+    parsed_answer_lines = [_parse_answer_line(line) for line in section_lines if _is_valid_answer_line_pattern(line)]
+    entities_labels = [e['label'].lower() for e in entities]
+    consistent_answers = [
+        answer for answer in parsed_answer_lines if _check_mention_consistency(answer, entities_labels)]
+    record_parse(len(section_lines), len(section_lines) - len(parsed_answer_lines),
+                 len(parsed_answer_lines) - len(consistent_answers))
+
+    answered_ids = {entity_mention['id'] for entity_mention in consistent_answers}
+    n_missing_entities = len(set(range(len(entities))) - answered_ids)
+    if len(consistent_answers) < len(section_lines) or n_missing_entities > 0:
+        LOGGER.warning(f'Discarded a batched mentions section with {len(section_lines) - len(consistent_answers)}'
+                       f' wrongly spelled or inconsistent lines and {n_missing_entities} missing entities.')
+        return None
 
     return [entity_mention['id'] for entity_mention in consistent_answers if entity_mention['is_mentioned']]
 
 
 def _is_valid_answer_line_pattern(answer_line: str) -> bool:
+    is_valid = _matches_answer_line_pattern(answer_line)
+    if not is_valid:
+        LOGGER.warning(f'Wrongly spelled mention information: "{answer_line}".')
+
+    return is_valid
+
+
+def _matches_answer_line_pattern(answer_line: str) -> bool:
     # Regular expression to describe the full pattern of a line in the answer
-    is_valid = bool(re.fullmatch(
+    return bool(re.fullmatch(
         r'\d+\) ?'                   # Entity ID
         r'[^|]+'                     # Entiy label
         r'([|]{3}) ?'                # Separator
         r'([Yy][Ee][Ss]|[Nn][Oo])',  # Answer
         answer_line.strip()))
-    if not is_valid:
-        LOGGER.warning(f'Wrongly spelled mention information: "{answer_line}".')
-
-    return is_valid
 
 
 def _parse_answer_line(answer_line: str) -> dict:
@@ -90,11 +363,10 @@ def _parse_answer_line(answer_line: str) -> dict:
     }
 
 
-def _check_mention_consistency(mention_dict: dict, entities: list[dict]) -> bool:
+def _check_mention_consistency(mention_dict: dict, entities_labels: list[str]) -> bool:
     e_index = mention_dict['id']
     # There is no such entity
-    if not (0 <= e_index < len(entities)):
+    if not (0 <= e_index < len(entities_labels)):
         return False
     # Forgive little syntactic differences: do not request perfect string matches
-    seq_match = SequenceMatcher(None, mention_dict['label'].lower(), entities[e_index]['label'].lower())
-    return seq_match.ratio() >= LABEL_SIM_RATIO_TH
+    return ratio_at_least(mention_dict['label'].lower(), entities_labels[e_index], LABEL_SIM_RATIO_TH)
@@ -1,8 +1,12 @@
-from difflib import get_close_matches
+import asyncio
 import re
 
 from llm_open_ie.llm.gpt import GPTOpenIE
+from llm_open_ie.llm.gpt.prompt import Prompt, async_complete, complete, format_system, split_to_budget
 from llm_open_ie.logger import LOGGER
+from llm_open_ie.metrics import record_parse
+from llm_open_ie.matching import CloseMatcher
+from llm_open_ie.predicate_registry import PredicateRegistry
 
 SYSTEM = '''\
 You provide an extended description of the "predicates" in a set of RDF triplets, which means you give a summary of\
@@ -32,15 +36,73 @@ LABEL_SIM_RATIO_TH = 0.90
 
 
 def describe_predicates(gpt: GPTOpenIE, sentence: str, triplets: list[dict], output_language: str) -> None:
+    unknown_triplets = _reuse_known_predicates(gpt.predicate_registry, triplets, output_language)
+    if not unknown_triplets:
+        return
+    # When the triplets do not fit in the prompt budget of `gpt`, their predicates are described in more calls
+    for group_triplets in _split_triplets(gpt, sentence, unknown_triplets, output_language):
+        answer = complete(gpt, _build_prompt(sentence, group_triplets, output_language),
+                          is_valid_line=_matches_answer_line_pattern)
+        _answer_parser(answer, group_triplets)
+    _register_predicates(gpt.predicate_registry, unknown_triplets, output_language)
+
+
+async def async_describe_predicates(gpt: GPTOpenIE, sentence: str, triplets: list[dict], output_language: str) -> None:
+    unknown_triplets = _reuse_known_predicates(gpt.predicate_registry, triplets, output_language)
+    if not unknown_triplets:
+        return
+
+    async def describe_group_predicates(group_triplets: list[dict]):
+        answer = await async_complete(gpt, _build_prompt(sentence, group_triplets, output_language),
+                                      is_valid_line=_matches_answer_line_pattern)
+        _answer_parser(answer, group_triplets)
+
+    await asyncio.gather(*[
+        describe_group_predicates(group_triplets)
+        for group_triplets in _split_triplets(gpt, sentence, unknown_triplets, output_language)
+    ])
+    _register_predicates(gpt.predicate_registry, unknown_triplets, output_language)
+
+
+def _split_triplets(gpt: GPTOpenIE, sentence: str, triplets: list[dict], output_language: str) -> list[list[dict]]:
+    return split_to_budget(
+        gpt, lambda group_triplets: _build_prompt(sentence, group_triplets, output_language), triplets,
+        gpt.max_prompt_tokens)
+
+
+def _reuse_known_predicates(registry: PredicateRegistry | None, triplets: list[dict],
+                            output_language: str) -> list[dict]:
+    # Give the known predicates their registered description, and return the triplets to describe with the LLM
+    if registry is None:
+        return triplets
+    unknown_triplets = []
+    for triplet_dict in triplets:
+        pred_description = registry.get(triplet_dict['pred_label'], output_language)
+        if pred_description is not None:
+            triplet_dict['pred_description'] = pred_description
+        else:
+            unknown_triplets.append(triplet_dict)
+    if triplets and not unknown_triplets:
+        registry.add_skipped_request()
+    return unknown_triplets
+
+
+def _register_predicates(registry: PredicateRegistry | None, triplets: list[dict], output_language: str):
+    if registry is None:
+        return
+    for triplet_dict in triplets:
+        if triplet_dict['pred_description'] is not None:
+            registry.add(triplet_dict['pred_label'], triplet_dict['pred_description'], output_language)
+
+
+def _build_prompt(sentence: str, triplets: list[dict], output_language: str) -> Prompt:
+    # Both the sentence and the triplets change from call to call: only the system prompt is shared
     triplets_str = '\n'.join(
         [f'- {t_dict["subj_label"]}|||{t_dict["pred_label"]}|||{t_dict["obj_label"]}'for t_dict in triplets]
     )
-
-    answer = gpt.chat_completion(
-        system=SYSTEM.format(output_language=output_language),
-        user=USER.format(context_sentence=sentence, triplets_list=triplets_str)
-    )
-    _answer_parser(answer, triplets)
+    return Prompt(format_system(SYSTEM, output_language=output_language), [
+        (USER.format(context_sentence=sentence, triplets_list=triplets_str), False)
+    ])
 
 
 def _answer_parser(answer: str, triplets: list[dict]):
@@ -51,15 +113,18 @@ def _answer_parser(answer: str, triplets: list[dict]):
     if n_dropped_lines > 0:
         LOGGER.warning(f'Dropped {n_dropped_lines}/{len(answer_lines)} wrongly spelled predicate information.')
 
-    consistent_answers = [answer for answer in parsed_answer_lines if _check_mention_consistency(answer, triplets)]
+    predicates_matcher = CloseMatcher(list({t['pred_label'].lower() for t in triplets}))
+    consistent_answers = [
+        answer for answer in parsed_answer_lines if _check_mention_consistency(answer, predicates_matcher)]
     n_dropped_lines = len(parsed_answer_lines) - len(consistent_answers)
     if n_dropped_lines > 0:
         LOGGER.warning(f'Dropped {n_dropped_lines}/{len(parsed_answer_lines)} inconsistent predicate information.')
+    record_parse(len(answer_lines), len(answer_lines) - len(parsed_answer_lines), n_dropped_lines)
 
     predicates_dict = {d['label'].lower(): d['description'] for d in consistent_answers}
-    predicates_keys = list(predicates_dict.keys())
+    predicates_keys_matcher = CloseMatcher(list(predicates_dict.keys()))
     for triplet_dict in triplets:
-        pred_key = get_close_matches(triplet_dict['pred_label'], predicates_keys, n=1)
+        pred_key = predicates_keys_matcher.get_close_matches(triplet_dict['pred_label'], n=1)
         if pred_key:
             pred_key = pred_key[0]
             triplet_dict['pred_description'] = predicates_dict[pred_key]
@@ -70,16 +135,20 @@ def _answer_parser(answer: str, triplets: list[dict]):
 def _is_valid_answer_line_pattern(answer_line: str) -> bool:
 
     # TODO CONTINUE HERE
+    is_valid = _matches_answer_line_pattern(answer_line)
+    if not is_valid:
+        LOGGER.warning(f'Wrongly spelled predicate information: "{answer_line}".')
+
+    return is_valid
+
+
+def _matches_answer_line_pattern(answer_line: str) -> bool:
     # Regular expression to describe the full pattern of a line in the answer
-    is_valid = bool(re.fullmatch(
+    return bool(re.fullmatch(
         r'- ?([^|]+)'  # Predicate label
         r'([|]{3})'    # Separator
         r'([^|]+)',    # Predicate description
         answer_line.strip()))
-    if not is_valid:
-        LOGGER.warning(f'Wrongly spelled predicate information: "{answer_line}".')
-
-    return is_valid
 
 
 def _parse_answer_line(answer_line: str) -> dict:
@@ -92,8 +161,7 @@ def _parse_answer_line(answer_line: str) -> dict:
     }
 
 
-def _check_mention_consistency(predicate_dict: dict, triplets: list[dict]):
-    all_predicates = list({t['pred_label'].lower() for t in triplets})
+def _check_mention_consistency(predicate_dict: dict, predicates_matcher: CloseMatcher):
     # Forgive little syntactic differences: do not request perfect string matches
-    match = get_close_matches(predicate_dict['label'].lower(), all_predicates, n=1, cutoff=LABEL_SIM_RATIO_TH)
+    match = predicates_matcher.get_close_matches(predicate_dict['label'].lower(), n=1, cutoff=LABEL_SIM_RATIO_TH)
     return bool(match)
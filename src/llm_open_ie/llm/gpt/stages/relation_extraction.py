@@ -1,8 +1,11 @@
-from difflib import SequenceMatcher
+import asyncio
 import re
 
 from llm_open_ie.llm.gpt import GPTOpenIE
+from llm_open_ie.llm.gpt.prompt import Prompt, async_complete, complete, format_system, split_pairs_to_budget
 from llm_open_ie.logger import LOGGER
+from llm_open_ie.metrics import record_parse
+from llm_open_ie.matching import ratio_at_least
 
 SYSTEM = '''\
 You find relations between entities in the text: the user provides you a list of known entities and a sentence in\
@@ -14,12 +17,16 @@ Your output is the list of relations formatted as RDF triplets, that you format
 The user text language may be anything, but your output should be {output_language}!
 '''
 
-USER = '''\
+# The user message lists the entities first, so that the calls on the same entities share the prompt prefix
+USER_ENTITIES = '''\
 User entities:
 ```
 {entities_numbered_list}
 ```
 
+'''
+
+USER_SENTENCE = '''\
 Sentence:
 ```
 {context_sentence}
@@ -32,14 +39,54 @@ LABEL_SIM_RATIO_TH = 0.90
 
 def extract_relations(gpt: GPTOpenIE, sentence: str, sentence_entities_ids: list[int],
                       entities: list[dict], output_language: str) -> list[dict]:
+    # When the entities do not fit in the prompt budget of `gpt`, they are split in groups sharing each pair of them
+    groups_triplets = [
+        _answer_parser(complete(gpt, _build_prompt(sentence, group_ids, entities, output_language),
+                                is_valid_line=_matches_answer_line_pattern), entities)
+        for group_ids in _split_entities(gpt, sentence, sentence_entities_ids, entities, output_language)
+    ]
+    return _merge_triplets(groups_triplets)
+
+
+async def async_extract_relations(gpt: GPTOpenIE, sentence: str, sentence_entities_ids: list[int],
+                                  entities: list[dict], output_language: str) -> list[dict]:
+    async def extract_group_relations(group_ids: list[int]) -> list[dict]:
+        answer = await async_complete(gpt, _build_prompt(sentence, group_ids, entities, output_language),
+                                      is_valid_line=_matches_answer_line_pattern)
+        return _answer_parser(answer, entities)
+
+    groups_triplets = await asyncio.gather(*[
+        extract_group_relations(group_ids)
+        for group_ids in _split_entities(gpt, sentence, sentence_entities_ids, entities, output_language)
+    ])
+    return _merge_triplets(groups_triplets)
+
+
+def _split_entities(gpt: GPTOpenIE, sentence: str, sentence_entities_ids: list[int],
+                    entities: list[dict], output_language: str) -> list[list[int]]:
+    return split_pairs_to_budget(
+        gpt, lambda ids: _build_prompt(sentence, ids, entities, output_language), sentence_entities_ids,
+        gpt.max_prompt_tokens)
+
+
+def _merge_triplets(groups_triplets: list[list[dict]]) -> list[dict]:
+    # The pairs of entities listed in more than one group may be related more than once: keep the first triplet
+    if len(groups_triplets) == 1:
+        return groups_triplets[0]
+    merged_triplets = dict()
+    for t_dict in [t_dict for group_triplets in groups_triplets for t_dict in group_triplets]:
+        merged_triplets.setdefault((t_dict['subj_id'], t_dict['pred_label'].lower(), t_dict['obj_id']), t_dict)
+    return list(merged_triplets.values())
+
+
+def _build_prompt(sentence: str, sentence_entities_ids: list[int],
+                  entities: list[dict], output_language: str) -> Prompt:
     sentence_entities = [(i + ENTITY_COUNT_START, entities[i],) for i in sentence_entities_ids]
     entities_list_str = '\n'.join([f'{i}) {e["label"]}' for i, e in sentence_entities])
-
-    answer = gpt.chat_completion(
-        system=SYSTEM.format(output_language=output_language),
-        user=USER.format(entities_numbered_list=entities_list_str, context_sentence=sentence)
-    )
-    return _answer_parser(answer, entities)
+    return Prompt(format_system(SYSTEM, output_language=output_language), [
+        (USER_ENTITIES.format(entities_numbered_list=entities_list_str), True),
+        (USER_SENTENCE.format(context_sentence=sentence), False)
+    ])
 
 
 def _answer_parser(answer: str, entities: list[dict]) -> list[dict]:
@@ -50,27 +97,34 @@ def _answer_parser(answer: str, entities: list[dict]) -> list[dict]:
     if n_dropped_lines > 0:
         LOGGER.warning(f'Dropped {n_dropped_lines}/{len(answer_lines)} wrongly spelled relation information.')
 
-    consistent_answers = [answer for answer in parsed_answer_lines if _check_mention_consistency(answer, entities)]
+    entities_labels = [e['label'].lower() for e in entities]
+    consistent_answers = [
+        answer for answer in parsed_answer_lines if _check_mention_consistency(answer, entities_labels)]
     n_dropped_lines = len(parsed_answer_lines) - len(consistent_answers)
     if n_dropped_lines > 0:
         LOGGER.warning(f'Dropped {n_dropped_lines}/{len(parsed_answer_lines)} inconsistent relation information.')
+    record_parse(len(answer_lines), len(answer_lines) - len(parsed_answer_lines), n_dropped_lines)
 
     return consistent_answers
 
 
 def _is_valid_answer_line_pattern(answer_line: str) -> bool:
+    is_valid = _matches_answer_line_pattern(answer_line)
+    if not is_valid:
+        LOGGER.warning(f'Wrongly spelled relation information: "{answer_line}".')
+
+    return is_valid
+
+
+def _matches_answer_line_pattern(answer_line: str) -> bool:
     # Regular expression to describe the full pattern of a line in the answer
-    is_valid = bool(re.fullmatch(
+    return bool(re.fullmatch(
         r'- ?([^|]+)\(\d+\) ?'  # Entity label and ID
         r'([|]{3})'              # Separator
         r'([^|]+)'               # Predicate label
         r'([|]{3})'              # Separator
         r'([^|]+)\(\d+\)',      # Object label and ID
         answer_line.strip()))
-    if not is_valid:
-        LOGGER.warning(f'Wrongly spelled relation information: "{answer_line}".')
-
-    return is_valid
 
 
 def _parse_answer_line(answer_line: str) -> dict:
@@ -104,14 +158,13 @@ def _parse_entity_string(e_string: str) -> tuple[str, int]:
     return e_label.strip(), int(e_id_str) - ENTITY_COUNT_START
 
 
-def _check_mention_consistency(relation_dict: dict, entities: list[dict]) -> bool:
+def _check_mention_consistency(relation_dict: dict, entities_labels: list[str]) -> bool:
     for e_str in ['subj', 'obj']:
         e_index = relation_dict[f'{e_str}_id']
         # There is no such entity
-        if not (0 <= e_index < len(entities)):
+        if not (0 <= e_index < len(entities_labels)):
             return False
         # Forgive little syntactic differences: do not request perfect string matches
-        seq_match = SequenceMatcher(None, relation_dict[f'{e_str}_label'].lower(), entities[e_index]['label'].lower())
-        if seq_match.ratio() < LABEL_SIM_RATIO_TH:
+        if not ratio_at_least(relation_dict[f'{e_str}_label'].lower(), entities_labels[e_index], LABEL_SIM_RATIO_TH):
             return False
     return True
@@ -0,0 +1,104 @@
+from __future__ import annotations
+
+import asyncio
+import random
+import threading
+import time
+
+
+# Token buckets for the requests per minute (RPM) and tokens per minute (TPM) budgets of an API key. Every request books
+#  its share of both budgets before being sent, waiting for the buckets to refill if needed. The state is guarded by a
+#  lock that is never held while waiting, so the same limiter can be shared by many threads, coroutines and LLM
+#  instances drawing from the same budget.
+class RateLimiter:
+    __requests_per_minute: float
+    __tokens_per_minute: float
+    __backoff_base: float
+    __backoff_max: float
+    __available_requests: float
+    __available_tokens: float
+    __last_refill_timestamp: float
+    __paused_until_timestamp: float
+    __lock: threading.Lock
+
+    def __init__(self, requests_per_minute: float = 3_500, tokens_per_minute: float = 90_000,
+                 backoff_base: float = 1.0, backoff_max: float = 60.0):
+        if requests_per_minute <= 0 or tokens_per_minute <= 0:
+            raise ValueError('`requests_per_minute` and `tokens_per_minute` must be positive numbers.')
+
+        self.__requests_per_minute = requests_per_minute
+        self.__tokens_per_minute = tokens_per_minute
+        self.__backoff_base = backoff_base
+        self.__backoff_max = backoff_max
+        self.__available_requests = requests_per_minute
+        self.__available_tokens = tokens_per_minute
+        self.__last_refill_timestamp = time.monotonic()
+        self.__paused_until_timestamp = 0.0
+        self.__lock = threading.Lock()
+
+    def acquire(self, num_tokens: int = 0) -> float:
+        # Block the calling thread until the request can be sent; return the waited time
+        wait = self.__reserve(num_tokens)
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    async def async_acquire(self, num_tokens: int = 0) -> float:
+        # Same as `acquire`, but only suspending the calling coroutine
+        wait = self.__reserve(num_tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return wait
+
+    def adjust(self, num_tokens: int):
+        # Correct a previous booking once the actual token usage is known (positive values consume more budget)
+        with self.__lock:
+            self.__refill()
+            self.__available_tokens -= num_tokens
+
+    def pause(self, seconds: float):
+        # Hold every request sharing this budget, e.g. when the server asks to retry after some time
+        with self.__lock:
+            self.__paused_until_timestamp = max(self.__paused_until_timestamp, time.monotonic() + seconds)
+
+    def backoff_delay(self, attempt: int, retry_after: float = None) -> float:
+        # Exponential backoff with full jitter, never shorter than what the server explicitly requested
+        delay = random.uniform(0, min(self.__backoff_max, self.__backoff_base * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def estimate_wait(self, num_tokens: int = 0) -> float:
+        # Time a request would wait if it was sent now, without booking it (e.g. to choose the least busy budget)
+        with self.__lock:
+            self.__refill()
+            return self.__wait(min(num_tokens, self.__tokens_per_minute))
+
+    def __reserve(self, num_tokens: int) -> float:
+        # A single request can never book more than a full minute of tokens, or it would wait forever
+        num_tokens = min(num_tokens, self.__tokens_per_minute)
+        with self.__lock:
+            self.__refill()
+            wait = self.__wait(num_tokens)
+            # Book the budget right away (possibly going below zero): later callers will wait for the refill after
+            #  this one, which keeps the requests in arrival order
+            self.__available_requests -= 1
+            self.__available_tokens -= num_tokens
+        return wait
+
+    def __wait(self, num_tokens: int) -> float:
+        return max(
+            self.__paused_until_timestamp - time.monotonic(),
+            (1 - self.__available_requests) * 60 / self.__requests_per_minute,
+            (num_tokens - self.__available_tokens) * 60 / self.__tokens_per_minute,
+            0.0
+        )
+
+    def __refill(self):
+        now = time.monotonic()
+        elapsed = now - self.__last_refill_timestamp
+        self.__last_refill_timestamp = now
+        self.__available_requests = min(
+            self.__requests_per_minute, self.__available_requests + elapsed * self.__requests_per_minute / 60)
+        self.__available_tokens = min(
+            self.__tokens_per_minute, self.__available_tokens + elapsed * self.__tokens_per_minute / 60)
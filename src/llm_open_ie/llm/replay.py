@@ -0,0 +1,540 @@
+from __future__ import annotations
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from types import SimpleNamespace
+from typing import Callable
+import asyncio
+import json
+import random
+import tempfile
+import threading
+import time
+
+from openai import APIConnectionError, APITimeoutError, AsyncOpenAI, OpenAI
+import httpx
+
+from llm_open_ie.llm.cache import CompletionCache
+from llm_open_ie.llm.gpt import GPTOpenIE, get_api_key
+from llm_open_ie.llm.rate_limiter import RateLimiter
+from llm_open_ie.logger import LOGGER
+
+# Sampling parameters of the requests that determine the answer, besides the model and the prompts
+SAMPLING_PARAMS = ['temperature', 'top_p', 'max_tokens']
+# Length (in characters) of the content pieces of the replayed streams
+STREAM_CHUNK_CHARS = 16
+# Backoff of the replayed requests failed on purpose: short, as the errors are not real
+REPLAY_BACKOFF_BASE = 0.01
+REPLAY_REQUEST = httpx.Request('POST', 'https://replay.invalid/v1/chat/completions')
+
+
+# JSONL file of the exchanges with the LLM (model, prompts, sampling parameters, answer and tokens usage), one per line
+#  and addressed by the same keys of the `CompletionCache`. New exchanges are appended as soon as they are received, and
+#  the last one of each key wins when the file is loaded again.
+class Recording:
+    __path: Path
+    __exchanges: dict[str, dict]
+    __lock: threading.Lock
+
+    def __init__(self, path: str | Path):
+        self.__path = Path(path)
+        self.__exchanges = dict()
+        self.__lock = threading.Lock()
+        if self.__path.exists():
+            with self.__path.open('r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        exchange = json.loads(line)
+                        self.__exchanges[exchange['key']] = exchange
+
+    def __len__(self) -> int:
+        return len(self.__exchanges)
+
+    @property
+    def path(self) -> Path:
+        return self.__path
+
+    def get(self, model: str, messages: list[dict], **sampling_params) -> dict | None:
+        return self.__exchanges.get(_make_key(model, messages, sampling_params))
+
+    def add(self, model: str, messages: list[dict], answer: str, usage: dict | None, **sampling_params):
+        system, user = _split_messages(messages)
+        exchange = {
+            'key': _make_key(model, messages, sampling_params),
+            'model': model,
+            'system': system,
+            'user': user,
+            'params': sampling_params,
+            'answer': answer,
+            'usage': usage
+        }
+        with self.__lock:
+            self.__exchanges[exchange['key']] = exchange
+            self.__path.parent.mkdir(parents=True, exist_ok=True)
+            with self.__path.open('a', encoding='utf-8') as f:
+                f.write(json.dumps(exchange, ensure_ascii=False) + '\n')
+
+
+# Wrappers of the OpenAI clients adding every received answer to a recording; they expose the same interface of
+#  `client.chat.completions`, for both plain and streamed requests
+class RecordingClient:
+    __client: OpenAI
+    __recording: Recording
+    chat: SimpleNamespace
+
+    def __init__(self, client: OpenAI, recording: Recording):
+        self.__client = client
+        self.__recording = recording
+        self.chat = SimpleNamespace(completions=self)
+
+    def create(self, *, model: str, messages: list[dict], stream: bool = False, **params):
+        response = self.__client.chat.completions.create(model=model, messages=messages, stream=stream, **params)
+        on_answer = _recorder(self.__recording, model, messages, params)
+        if stream:
+            return _RecordingStream(response, on_answer)
+        on_answer(response.choices[0].message.content, getattr(response, 'usage', None))
+        return response
+
+
+class AsyncRecordingClient:
+    __client: AsyncOpenAI
+    __recording: Recording
+    chat: SimpleNamespace
+
+    def __init__(self, client: AsyncOpenAI, recording: Recording):
+        self.__client = client
+        self.__recording = recording
+        self.chat = SimpleNamespace(completions=self)
+
+    async def create(self, *, model: str, messages: list[dict], stream: bool = False, **params):
+        response = await self.__client.chat.completions.create(model=model, messages=messages, stream=stream, **params)
+        on_answer = _recorder(self.__recording, model, messages, params)
+        if stream:
+            return _RecordingStream(response, on_answer)
+        on_answer(response.choices[0].message.content, getattr(response, 'usage', None))
+        return response
+
+
+# Stand-ins of the OpenAI clients serving the recorded answers offline, after a synthetic latency (uniformly drawn in
+#  `latency` ± `latency_jitter` seconds, plus `slow_latency` seconds for a random `slow_rate` share of the requests, to
+#  simulate the tail latency) and failing a random `error_rate` share of the requests with a connection error. The
+#  requests lasting more than their `timeout` fail with a timeout error after it, as with the OpenAI clients. With the
+#  same `seed`, the same sequence of requests gets the same latencies and errors.
+class ReplayClient:
+    __recording: Recording
+    __latency: float
+    __latency_jitter: float
+    __error_rate: float
+    __slow_rate: float
+    __slow_latency: float
+    __random: random.Random
+    __lock: threading.Lock
+    chat: SimpleNamespace
+
+    def __init__(self, recording: Recording, latency: float = 0.0, latency_jitter: float = 0.0,
+                 error_rate: float = 0.0, seed: int = None, slow_rate: float = 0.0, slow_latency: float = 0.0):
+        if latency < 0 or not 0 <= latency_jitter <= latency:
+            raise ValueError('`latency` must be a non-negative number and `latency_jitter` must be between 0 and it.')
+        if not 0 <= error_rate < 1:
+            raise ValueError(f'`error_rate` must be between 0 (included) and 1 (excluded), got {error_rate}.')
+        if not 0 <= slow_rate <= 1 or slow_latency < 0:
+            raise ValueError('`slow_rate` must be between 0 and 1 and `slow_latency` must be a non-negative number.')
+
+        self.__recording = recording
+        self.__latency = latency
+        self.__latency_jitter = latency_jitter
+        self.__error_rate = error_rate
+        self.__slow_rate = slow_rate
+        self.__slow_latency = slow_latency
+        self.__random = random.Random(seed)
+        self.__lock = threading.Lock()
+        self.chat = SimpleNamespace(completions=self)
+
+    def create(self, *, model: str, messages: list[dict], stream: bool = False, **params):
+        delay, exchange, is_failed = self.replay(model, messages, **params)
+        timeout = params.get('timeout')
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise APITimeoutError(request=REPLAY_REQUEST)
+        time.sleep(delay)
+        if is_failed:
+            raise APIConnectionError(message='Replay error injected on purpose.', request=REPLAY_REQUEST)
+        return _replay_response(exchange, stream)
+
+    def replay(self, model: str, messages: list[dict], **params) -> tuple[float, dict, bool]:
+        # Get the latency, the recorded exchange and whether the request must fail
+        exchange = self.__recording.get(model, messages, **{k: v for k, v in params.items() if k in SAMPLING_PARAMS})
+        if exchange is None:
+            raise LookupError(
+                f'No answer of `{model}` recorded for this request in "{self.__recording.path}": record it first with'
+                f' `RecordingOpenIE`.')
+        with self.__lock:
+            delay = self.__latency + self.__random.uniform(-self.__latency_jitter, self.__latency_jitter)
+            is_failed = self.__random.random() < self.__error_rate
+            if self.__slow_rate > 0 and self.__random.random() < self.__slow_rate:
+                delay += self.__slow_latency
+        return delay, exchange, is_failed
+
+
+class AsyncReplayClient:
+    __replay_client: ReplayClient
+    chat: SimpleNamespace
+
+    def __init__(self, replay_client: ReplayClient):
+        # Share the random generator of the synchronous client, so both draw from the same sequence
+        self.__replay_client = replay_client
+        self.chat = SimpleNamespace(completions=self)
+
+    async def create(self, *, model: str, messages: list[dict], stream: bool = False, **params):
+        delay, exchange, is_failed = self.__replay_client.replay(model, messages, **params)
+        timeout = params.get('timeout')
+        if timeout is not None and delay > timeout:
+            await asyncio.sleep(timeout)
+            raise APITimeoutError(request=REPLAY_REQUEST)
+        await asyncio.sleep(delay)
+        if is_failed:
+            raise APIConnectionError(message='Replay error injected on purpose.', request=REPLAY_REQUEST)
+        return _replay_response(exchange, stream)
+
+
+# GPT pipeline recording every answer received from OpenAI, so that the same run can be replayed with `ReplayOpenIE`
+class RecordingOpenIE(GPTOpenIE):
+    __recording: Recording
+
+    def __init__(self, recording: Recording, api_key_input: str = 'environ', **kwargs):
+        openai_api_key = get_api_key(api_key_input)
+        self.__recording = recording
+        super().__init__(
+            client=RecordingClient(OpenAI(api_key=openai_api_key, max_retries=0), recording),
+            async_client=AsyncRecordingClient(AsyncOpenAI(api_key=openai_api_key, max_retries=0), recording),
+            **kwargs)
+
+    @property
+    def recording(self) -> Recording:
+        return self.__recording
+
+
+# GPT pipeline answering with the recorded answers only, without any request to OpenAI: the prompts that were not
+#  recorded raise a `LookupError`. The requests are not rate limited, unless a `rate_limiter` is given.
+class ReplayOpenIE(GPTOpenIE):
+    __recording: Recording
+
+    def __init__(self, recording: Recording, latency: float = 0.0, latency_jitter: float = 0.0,
+                 error_rate: float = 0.0, seed: int = None, rate_limiter: RateLimiter = None,
+                 slow_rate: float = 0.0, slow_latency: float = 0.0, **kwargs):
+        if rate_limiter is None:
+            rate_limiter = RateLimiter(
+                requests_per_minute=float('inf'), tokens_per_minute=float('inf'), backoff_base=REPLAY_BACKOFF_BASE)
+        replay_client = ReplayClient(recording, latency, latency_jitter, error_rate, seed, slow_rate, slow_latency)
+        self.__recording = recording
+        super().__init__(
+            client=replay_client, async_client=AsyncReplayClient(replay_client), rate_limiter=rate_limiter, **kwargs)
+
+    @property
+    def recording(self) -> Recording:
+        return self.__recording
+
+
+# Stand-in of the files and batches of the OpenAI client, as used by `BatchScheduler`: each batch input file is read
+#  and answered with the recorded answers by `replay_client` in a background thread, writing the output and error files
+#  in `files_dir` as the Batch API does. The latency of the requests is not waited, while the requests failed on purpose
+#  (see `error_rate`) and the ones that were not recorded end up in the error file.
+class ReplayBatchClient:
+    __replay_client: ReplayClient
+    __files_dir: Path
+    __files: dict[str, Path]
+    __batches: dict[str, SimpleNamespace]
+    __lock: threading.Lock
+    files: SimpleNamespace
+    batches: SimpleNamespace
+
+    def __init__(self, replay_client: ReplayClient, files_dir: str | Path = None):
+        self.__replay_client = replay_client
+        if files_dir is None:
+            files_dir = tempfile.mkdtemp(prefix='replay-batches-')
+        self.__files_dir = Path(files_dir)
+        self.__files = dict()
+        self.__batches = dict()
+        self.__lock = threading.Lock()
+        self.files = SimpleNamespace(create=self.__create_file, content=self.__file_content)
+        self.batches = SimpleNamespace(create=self.__create_batch, retrieve=self.__retrieve_batch)
+
+    def __create_file(self, *, file, purpose: str = 'batch', **kwargs) -> SimpleNamespace:
+        content = file.read() if hasattr(file, 'read') else Path(file).read_bytes()
+        return SimpleNamespace(id=self.__add_file(content.decode('utf-8') if isinstance(content, bytes) else content))
+
+    def __file_content(self, file_id: str) -> SimpleNamespace:
+        with self.__lock:
+            path = self.__files[file_id]
+        return SimpleNamespace(text=path.read_text(encoding='utf-8'))
+
+    def __create_batch(self, *, input_file_id: str, endpoint: str, completion_window: str,
+                       **kwargs) -> SimpleNamespace:
+        with self.__lock:
+            if input_file_id not in self.__files:
+                raise LookupError(f'No file "{input_file_id}" was uploaded.')
+            batch = SimpleNamespace(
+                id=f'batch-{len(self.__batches)}', status='in_progress', input_file_id=input_file_id,
+                output_file_id=None, error_file_id=None, metadata=kwargs.get('metadata'))
+            self.__batches[batch.id] = batch
+        threading.Thread(target=self.__process_batch, args=(batch.id,), daemon=True).start()
+        return SimpleNamespace(**vars(batch))
+
+    def __retrieve_batch(self, batch_id: str) -> SimpleNamespace:
+        with self.__lock:
+            return SimpleNamespace(**vars(self.__batches[batch_id]))
+
+    def __process_batch(self, batch_id: str):
+        with self.__lock:
+            input_path = self.__files[self.__batches[batch_id].input_file_id]
+        output_lines, error_lines = [], []
+        for line in input_path.read_text(encoding='utf-8').splitlines():
+            if not line.strip():
+                continue
+            request = json.loads(line)
+            body = dict(request['body'])
+            model, messages = body.pop('model'), body.pop('messages')
+            result = {'id': f'{batch_id}-{request["custom_id"]}', 'custom_id': request['custom_id']}
+            try:
+                _, exchange, is_failed = self.__replay_client.replay(model, messages, **body)
+            except LookupError as e:
+                error_lines.append({**result, 'response': None, 'error': {'code': 'not_recorded', 'message': str(e)}})
+                continue
+            if is_failed:
+                error_lines.append({
+                    **result, 'response': None,
+                    'error': {'code': 'server_error', 'message': 'Replay error injected on purpose.'}})
+                continue
+            output_lines.append(
+                {**result, 'response': {'status_code': 200, 'body': _replay_body(exchange)}, 'error': None})
+
+        # As with the Batch API, each file is only created when it has some lines
+        output_file_id, error_file_id = [
+            self.__add_file(''.join([json.dumps(line, ensure_ascii=False) + '\n' for line in lines])) if lines else None
+            for lines in [output_lines, error_lines]
+        ]
+        with self.__lock:
+            batch = self.__batches[batch_id]
+            batch.output_file_id, batch.error_file_id = output_file_id, error_file_id
+            batch.status = 'completed'
+
+    def __add_file(self, content: str) -> str:
+        with self.__lock:
+            file_id = f'file-{len(self.__files)}'
+            path = self.__files_dir / f'{file_id}.jsonl'
+            self.__files[file_id] = path
+        self.__files_dir.mkdir(parents=True, exist_ok=True)
+        path.write_text(content, encoding='utf-8')
+        return file_id
+
+
+# Local stand-in of an OpenAI-compatible server, answering `POST <base URL>/chat/completions` requests (plain or
+#  streamed) with the answers of the recording, after the latency and with the errors of `replay_client`: it can be an
+#  endpoint of a `GPTOpenIE` pool (e.g. with `base_url='http://127.0.0.1:8001/v1'`) to exercise the real OpenAI clients
+#  offline. The requests that were not recorded get a 404 error, and the failed ones a 503 error.
+def make_replay_server(replay_client: ReplayClient, host: str = '127.0.0.1', port: int = 8001) -> ThreadingHTTPServer:
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_POST(self):
+            if not self.path.endswith('/chat/completions'):
+                self.__send_error(404, f'Unknown path: {self.path}')
+                return
+            params = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+            model, messages, stream = params.pop('model'), params.pop('messages'), params.pop('stream', False)
+            try:
+                delay, exchange, is_failed = replay_client.replay(model, messages, **params)
+            except LookupError as e:
+                self.__send_error(404, str(e))
+                return
+            time.sleep(delay)
+            try:
+                if is_failed:
+                    self.__send_error(503, 'Replay error injected on purpose.')
+                elif stream:
+                    self.__send_stream(exchange)
+                else:
+                    self.__send_json(200, _replay_body(exchange))
+            except (BrokenPipeError, ConnectionResetError):
+                # The client gave up on the request (e.g. after its timeout) while it was delayed
+                LOGGER.debug(f'{self.address_string()} - connection closed before the answer.')
+                self.close_connection = True
+
+        def log_message(self, format: str, *args):
+            LOGGER.debug(f'{self.address_string()} - {format % args}')
+
+        def __send_error(self, status: int, message: str):
+            self.__send_json(status, {'error': {'message': message, 'type': 'replay_error', 'code': None}})
+
+        def __send_json(self, status: int, body: dict):
+            body_bytes = json.dumps(body, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body_bytes)))
+            self.end_headers()
+            self.wfile.write(body_bytes)
+
+        def __send_stream(self, exchange: dict):
+            # Server-sent events, with the usage in a last chunk without choices and a final `[DONE]`
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/event-stream')
+            self.send_header('Connection', 'close')
+            self.end_headers()
+            for chunk in _replay_chunk_bodies(exchange):
+                self.wfile.write(f'data: {json.dumps(chunk, ensure_ascii=False)}\n\n'.encode('utf-8'))
+            self.wfile.write(b'data: [DONE]\n\n')
+            self.wfile.flush()
+            self.close_connection = True
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+# Wrapper of the plain and asynchronous OpenAI streams, passing the answer to `on_answer` once it is complete
+class _RecordingStream:
+    __stream: object
+    __on_answer: Callable[[str, object], None]
+
+    def __init__(self, stream, on_answer: Callable[[str, object], None]):
+        self.__stream = stream
+        self.__on_answer = on_answer
+
+    def __enter__(self):
+        self.__stream.__enter__()
+        return self
+
+    def __exit__(self, *exc_info):
+        return self.__stream.__exit__(*exc_info)
+
+    async def __aenter__(self):
+        await self.__stream.__aenter__()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return await self.__stream.__aexit__(*exc_info)
+
+    def __iter__(self):
+        content_pieces, usage = [], None
+        for chunk in self.__stream:
+            content_pieces.append(_chunk_content(chunk))
+            usage = getattr(chunk, 'usage', None) or usage
+            yield chunk
+        self.__on_answer(''.join(content_pieces), usage)
+
+    async def __aiter__(self):
+        content_pieces, usage = [], None
+        async for chunk in self.__stream:
+            content_pieces.append(_chunk_content(chunk))
+            usage = getattr(chunk, 'usage', None) or usage
+            yield chunk
+        self.__on_answer(''.join(content_pieces), usage)
+
+
+# Replayed stream, usable both as a plain and as an asynchronous OpenAI stream
+class _ReplayStream:
+    __chunks: list
+
+    def __init__(self, chunks: list):
+        self.__chunks = chunks
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return None
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return None
+
+    def __iter__(self):
+        return iter(self.__chunks)
+
+    async def __aiter__(self):
+        for chunk in self.__chunks:
+            yield chunk
+
+
+def _recorder(recording: Recording, model: str, messages: list[dict], params: dict) -> Callable[[str, object], None]:
+    sampling_params = {k: v for k, v in params.items() if k in SAMPLING_PARAMS}
+
+    def on_answer(answer: str, usage):
+        recording.add(model, messages, answer, _usage_dict(usage), **sampling_params)
+
+    return on_answer
+
+
+def _replay_response(exchange: dict, stream: bool):
+    usage = SimpleNamespace(**exchange['usage']) if exchange['usage'] is not None else None
+    answer = exchange['answer']
+    if not stream:
+        message = SimpleNamespace(role='assistant', content=answer)
+        return SimpleNamespace(
+            model=exchange['model'], choices=[SimpleNamespace(message=message, finish_reason='stop')], usage=usage)
+
+    chunks = [
+        SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=answer[i:i + STREAM_CHUNK_CHARS]))],
+                        usage=None)
+        for i in range(0, len(answer), STREAM_CHUNK_CHARS)
+    ]
+    # As requested with `stream_options={'include_usage': True}`, the usage comes in a last chunk without choices
+    chunks.append(SimpleNamespace(choices=[], usage=usage))
+    return _ReplayStream(chunks)
+
+
+def _replay_body(exchange: dict) -> dict:
+    return {
+        'id': f'replay-{exchange["key"][:16]}',
+        'object': 'chat.completion',
+        'created': int(time.time()),
+        'model': exchange['model'],
+        'choices': [
+            {'index': 0, 'message': {'role': 'assistant', 'content': exchange['answer']}, 'finish_reason': 'stop'}
+        ],
+        'usage': exchange['usage']
+    }
+
+
+def _replay_chunk_bodies(exchange: dict) -> list[dict]:
+    answer = exchange['answer']
+    chunk_header = {
+        'id': f'replay-{exchange["key"][:16]}',
+        'object': 'chat.completion.chunk',
+        'created': int(time.time()),
+        'model': exchange['model']
+    }
+    chunks = [
+        {**chunk_header, 'choices': [{'index': 0, 'delta': {'content': answer[i:i + STREAM_CHUNK_CHARS]},
+                                      'finish_reason': None}]}
+        for i in range(0, len(answer), STREAM_CHUNK_CHARS)
+    ]
+    chunks.append({**chunk_header, 'choices': [], 'usage': exchange['usage']})
+    return chunks
+
+
+def _chunk_content(chunk) -> str:
+    if not chunk.choices:
+        return ''
+    return chunk.choices[0].delta.content or ''
+
+
+def _usage_dict(usage) -> dict | None:
+    if usage is None:
+        return None
+    return {
+        'prompt_tokens': usage.prompt_tokens,
+        'completion_tokens': usage.completion_tokens,
+        'total_tokens': usage.total_tokens
+    }
+
+
+def _split_messages(messages: list[dict]) -> tuple[str | None, str]:
+    system = next((m['content'] for m in messages if m['role'] == 'system'), None)
+    user = next(m['content'] for m in messages if m['role'] == 'user')
+    return system, user
+
+
+def _make_key(model: str, messages: list[dict], sampling_params: dict) -> str:
+    system, user = _split_messages(messages)
+    return CompletionCache.make_key(model, system, user, **sampling_params)
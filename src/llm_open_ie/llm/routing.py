@@ -0,0 +1,184 @@
+from __future__ import annotations
+
+from pathlib import Path
+from typing import Callable
+import json
+import threading
+
+from llm_open_ie.llm.endpoints import EndpointPool, read_endpoint_pool
+
+# Stages whose requests can be routed (the phrase selection sends none)
+ROUTED_STAGES = ['entity_extraction', 'mention_recognition', 'relation_extraction', 'predicate_description',
+                 'fused_relation_extraction']
+# Counters of the calls of each model in each stage
+MODEL_COUNTERS = ['calls', 'latency_seconds', 'prompt_tokens', 'completion_tokens', 'capped_answers']
+
+
+# Model answering some of the requests, on its own endpoints (the ones of the LLM when not set), with a ceiling on the
+#  tokens of each answer (no ceiling when not set); `max_prompt_tokens` restricts it to the prompts up to that size
+class ModelRoute:
+    __model: str | None
+    __endpoints: EndpointPool | None
+    __max_tokens: int | None
+    __max_prompt_tokens: int | None
+
+    def __init__(self, model: str = None, endpoints: EndpointPool = None, max_tokens: int = None,
+                 max_prompt_tokens: int = None):
+        # The model of the LLM is used when `model` is not set
+        for name, tokens in [('max_tokens', max_tokens), ('max_prompt_tokens', max_prompt_tokens)]:
+            if tokens is not None and tokens < 1:
+                raise ValueError(f'`{name}` must be a positive integer, got {tokens}.')
+        self.__model = model
+        self.__endpoints = endpoints
+        self.__max_tokens = max_tokens
+        self.__max_prompt_tokens = max_prompt_tokens
+
+    @property
+    def model(self) -> str | None:
+        return self.__model
+
+    @property
+    def endpoints(self) -> EndpointPool | None:
+        return self.__endpoints
+
+    @property
+    def max_tokens(self) -> int | None:
+        return self.__max_tokens
+
+    @property
+    def max_prompt_tokens(self) -> int | None:
+        return self.__max_prompt_tokens
+
+    def fits(self, prompt_tokens: int) -> bool:
+        return self.__max_prompt_tokens is None or prompt_tokens <= self.__max_prompt_tokens
+
+
+# Routes of the requests of each stage: a request is sent to the first route of its stage fitting the size of its
+#  prompt, or else to the model of the LLM. When more than `max_malformed_rate` of the lines of a routed answer do not
+#  match the pattern of its stage, the request is sent again to the stronger `escalation` route (the model of the LLM
+#  when not set), unless `max_malformed_rate` is `None`.
+class ModelRouter:
+    __routes: dict[str, list[ModelRoute]]
+    __escalation: ModelRoute
+    __max_malformed_rate: float | None
+    __stats: RoutingStats
+
+    def __init__(self, routes: dict[str, ModelRoute | list[ModelRoute]], escalation: ModelRoute = None,
+                 max_malformed_rate: float | None = 0.5):
+        for stage in routes:
+            if stage not in ROUTED_STAGES:
+                options_str = ', '.join([f'`{v}`' for v in ROUTED_STAGES])
+                raise ValueError(f'`{stage}` is not a valid stage: choose one between {options_str}')
+        if max_malformed_rate is not None and not 0 <= max_malformed_rate < 1:
+            raise ValueError(f'`max_malformed_rate` must be between 0 (included) and 1 (excluded), got'
+                             f' {max_malformed_rate}.')
+
+        self.__routes = {
+            stage: [stage_routes] if isinstance(stage_routes, ModelRoute) else list(stage_routes)
+            for stage, stage_routes in routes.items()
+        }
+        self.__escalation = escalation if escalation is not None else ModelRoute()
+        self.__max_malformed_rate = max_malformed_rate
+        self.__stats = RoutingStats()
+
+    @property
+    def escalation(self) -> ModelRoute:
+        return self.__escalation
+
+    @property
+    def stats(self) -> RoutingStats:
+        return self.__stats
+
+    def routes(self, stage: str) -> list[ModelRoute]:
+        return list(self.__routes.get(stage, []))
+
+    def route(self, stage: str, prompt_tokens: int) -> ModelRoute | None:
+        # `None` when the request goes to the model of the LLM
+        for route in self.__routes.get(stage, []):
+            if route.fits(prompt_tokens):
+                return route
+        return None
+
+    def should_escalate(self, answer: str, is_valid_line: Callable[[str], bool] | None) -> bool:
+        # The blank lines are not counted, and the answers with no other line are left to the stage
+        if is_valid_line is None or self.__max_malformed_rate is None:
+            return False
+        answer_lines = [line for line in answer.strip().split('\n') if line.strip()]
+        n_malformed_lines = sum([1 for line in answer_lines if not is_valid_line(line)])
+        return len(answer_lines) > 0 and n_malformed_lines / len(answer_lines) > self.__max_malformed_rate
+
+
+# Calls of each model in each stage, and the routed answers sent again to a stronger model, to tell the latency and the
+#  tokens moved off the model of the LLM
+class RoutingStats:
+    __stages: dict[str, dict[str, dict]]
+    __escalations: dict[str, int]
+    __lock: threading.Lock
+
+    def __init__(self):
+        self.__stages = dict()
+        self.__escalations = dict()
+        self.__lock = threading.Lock()
+
+    def add_call(self, stage: str, model: str, latency_seconds: float, prompt_tokens: int, completion_tokens: int,
+                 is_capped: bool):
+        with self.__lock:
+            counters = self.__stages.setdefault(stage, dict()).setdefault(model, {k: 0 for k in MODEL_COUNTERS})
+            counters['calls'] += 1
+            counters['latency_seconds'] += latency_seconds
+            counters['prompt_tokens'] += prompt_tokens
+            counters['completion_tokens'] += completion_tokens
+            counters['capped_answers'] += int(is_capped)
+
+    def add_escalation(self, stage: str):
+        with self.__lock:
+            self.__escalations[stage] = self.__escalations.get(stage, 0) + 1
+
+    def as_dict(self, default_model: str) -> dict:
+        # For each stage, the calls and tokens of the other models than `default_model`, and the latency they saved
+        #  compared to the mean latency of `default_model` in the same stage (unknown until it answered some of them)
+        with self.__lock:
+            stages = {stage: {m: dict(c) for m, c in models.items()} for stage, models in self.__stages.items()}
+            escalations = dict(self.__escalations)
+        stages_dict = dict()
+        for stage in sorted(set(stages) | set(escalations)):
+            models = stages.get(stage, dict())
+            default_counters = models.get(default_model)
+            routed_counters = [c for m, c in models.items() if m != default_model]
+            latency_saved = None
+            if default_counters is not None and default_counters['calls'] > 0:
+                default_latency = default_counters['latency_seconds'] / default_counters['calls']
+                latency_saved = sum([c['calls'] * default_latency - c['latency_seconds'] for c in routed_counters])
+            stages_dict[stage] = {
+                'models': models,
+                'escalations': escalations.get(stage, 0),
+                'routed_calls': sum([c['calls'] for c in routed_counters]),
+                'routed_tokens': sum([c['prompt_tokens'] + c['completion_tokens'] for c in routed_counters]),
+                'latency_saved_seconds': latency_saved
+            }
+        return stages_dict
+
+
+def read_model_router(path: str | Path, budget_share: float = 1.0, with_endpoints: bool = True) -> ModelRouter:
+    # Router described by a JSON file: its `routes` map each stage to a route object (or a list of them) with the
+    #  `model`, the optional `max_tokens` and `max_prompt_tokens` and the optional `endpoints`, a JSON file of endpoints
+    #  as read by `read_endpoint_pool` (relative to the router file); the optional `escalation` is a route object too,
+    #  next to the optional `max_malformed_rate`. Without `with_endpoints`, the endpoints of the routes are ignored and
+    #  all the requests go to the endpoints of the LLM (e.g. when replaying them).
+    path = Path(path)
+    with path.open('r', encoding='utf-8') as f:
+        config = json.load(f)
+
+    def read_route(entry: dict) -> ModelRoute:
+        endpoints = None
+        if with_endpoints and entry.get('endpoints') is not None:
+            endpoints = read_endpoint_pool(path.parent / entry['endpoints'], budget_share)
+        return ModelRoute(model=entry.get('model'), endpoints=endpoints, max_tokens=entry.get('max_tokens'),
+                          max_prompt_tokens=entry.get('max_prompt_tokens'))
+
+    routes = {
+        stage: [read_route(entry) for entry in (entries if isinstance(entries, list) else [entries])]
+        for stage, entries in config.get('routes', dict()).items()
+    }
+    escalation = read_route(config['escalation']) if config.get('escalation') is not None else None
+    return ModelRouter(routes, escalation=escalation, max_malformed_rate=config.get('max_malformed_rate', 0.5))
@@ -0,0 +1,380 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from hashlib import sha256
+from pathlib import Path
+from typing import AsyncIterator, Iterator
+import json
+import sqlite3
+import threading
+
+from llm_open_ie.llm import LLMOpenIE
+
+MEMOIZED_STAGES = [
+    'entity_extraction', 'mention_recognition', 'relation_extraction', 'predicate_description',
+    'fused_relation_extraction'
+]
+
+_current_report: ContextVar[ReuseReport | None] = ContextVar('current_reuse_report', default=None)
+
+
+# Persistent store of the results of the pipeline stages, addressed by the stage and the hash of its actual inputs (the
+#  text for the entity extraction; the entity sentence and the entities list for the mention recognition and relation
+#  extraction; the sentence and the triplets for the predicate description). It lives in a single SQLite file, so it
+#  can be shared by threads and processes, and across runs.
+class StageMemo:
+    __path: Path
+    __stats: dict[str, dict[str, int]]
+    __connection: sqlite3.Connection
+    __lock: threading.Lock
+
+    def __init__(self, path: str | Path):
+        self.__path = Path(path)
+        self.__stats = {stage: {'hits': 0, 'misses': 0} for stage in MEMOIZED_STAGES}
+        self.__lock = threading.Lock()
+
+        self.__path.parent.mkdir(parents=True, exist_ok=True)
+        self.__connection = sqlite3.connect(self.__path, timeout=30, check_same_thread=False)
+        self.__connection.execute('PRAGMA journal_mode=WAL')
+        self.__connection.execute(
+            'CREATE TABLE IF NOT EXISTS stage_results ('
+            ' stage TEXT NOT NULL, key TEXT NOT NULL, result TEXT NOT NULL, PRIMARY KEY (stage, key))')
+        self.__connection.commit()
+
+    @staticmethod
+    def make_key(**inputs) -> str:
+        key_content = json.dumps(inputs, sort_keys=True, ensure_ascii=False)
+        return sha256(key_content.encode('utf-8')).hexdigest()
+
+    def stats(self) -> dict:
+        with self.__lock:
+            return {stage: dict(stage_stats) for stage, stage_stats in self.__stats.items()}
+
+    def get(self, stage: str, key: str):
+        # Result of a stage for the inputs hashed in `key` (a fresh copy at each call), or `None` if unknown
+        with self.__lock:
+            row = self.__connection.execute(
+                'SELECT result FROM stage_results WHERE stage = ? AND key = ?', (stage, key)).fetchone()
+            self.__stats[stage]['hits' if row is not None else 'misses'] += 1
+        return json.loads(row[0]) if row is not None else None
+
+    def put(self, stage: str, key: str, result):
+        result_str = json.dumps(result, ensure_ascii=False)
+        with self.__lock:
+            self.__connection.execute(
+                'INSERT OR REPLACE INTO stage_results (stage, key, result) VALUES (?, ?, ?)', (stage, key, result_str))
+            self.__connection.commit()
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+
+# Stages of another `LLMOpenIE` memoized on a `StageMemo`: when a document is processed again (e.g. after an edit),
+#  only the stages whose inputs changed call the LLM. Editing the text runs the entity extraction again, but as long
+#  as the same entities are extracted, the sentences of the entities and so the following stages are still reused.
+#  The entities and triplets reused or regenerated in a document can be tracked with `collect_reuse`.
+class MemoizedOpenIE(LLMOpenIE):
+    __llm_oie: LLMOpenIE
+    __memo: StageMemo
+    __model: str | None
+
+    def __init__(self, llm_oie: LLMOpenIE, memo: StageMemo):
+        self.__llm_oie = llm_oie
+        self.__memo = memo
+        # Results of different models are memoized separately
+        self.__model = getattr(llm_oie, 'model', None)
+
+    @property
+    def llm_oie(self) -> LLMOpenIE:
+        return self.__llm_oie
+
+    @property
+    def memo(self) -> StageMemo:
+        return self.__memo
+
+    def chat_completion(self, user: str | list[str], system: str = None, temperature: float = 0, top_p: float = 0,
+                        **kwargs):
+        return self.__llm_oie.chat_completion(user, system=system, temperature=temperature, top_p=top_p, **kwargs)
+
+    async def async_chat_completion(self, user: str | list[str], system: str = None, temperature: float = 0,
+                                    top_p: float = 0, **kwargs):
+        return await self.__llm_oie.async_chat_completion(
+            user, system=system, temperature=temperature, top_p=top_p, **kwargs)
+
+    def stream_chat_completion(self, user: str | list[str], system: str = None, temperature: float = 0,
+                               top_p: float = 0, **kwargs) -> Iterator[str]:
+        return self.__llm_oie.stream_chat_completion(
+            user, system=system, temperature=temperature, top_p=top_p, **kwargs)
+
+    def async_stream_chat_completion(self, user: str | list[str], system: str = None, temperature: float = 0,
+                                     top_p: float = 0, **kwargs) -> AsyncIterator[str]:
+        return self.__llm_oie.async_stream_chat_completion(
+            user, system=system, temperature=temperature, top_p=top_p, **kwargs)
+
+    def get_num_tokens(self, text):
+        return self.__llm_oie.get_num_tokens(text)
+
+    def entity_extraction(self, text: str, output_language: str) -> list[dict]:
+        key = self.__entities_key(text, output_language)
+        text_entities = self.__memo.get('entity_extraction', key)
+        is_reused = text_entities is not None
+        if not is_reused:
+            text_entities = self.__llm_oie.entity_extraction(text, output_language)
+            self.__memo.put('entity_extraction', key, text_entities)
+        _report('entity_extraction', text_entities, is_reused=is_reused)
+        return text_entities
+
+    def iter_entity_extraction(self, text: str, output_language: str) -> Iterator[dict]:
+        # The entities are only memoized once their extraction is over, and replayed all at once
+        key = self.__entities_key(text, output_language)
+        text_entities = self.__memo.get('entity_extraction', key)
+        if text_entities is not None:
+            _report('entity_extraction', text_entities, is_reused=True)
+            yield from text_entities
+            return
+        text_entities = []
+        for e_dict in self.__llm_oie.iter_entity_extraction(text, output_language):
+            text_entities.append(e_dict)
+            _report('entity_extraction', [e_dict], is_reused=False, count_call=False)
+            yield e_dict
+        self.__memo.put('entity_extraction', key, text_entities)
+        _report('entity_extraction', [], is_reused=False)
+
+    def phrase_selection(self, text: str, entity_id: int, entities: list[dict]) -> str:
+        # No request involved: nothing to memoize
+        return self.__llm_oie.phrase_selection(text, entity_id, entities)
+
+    def mention_recognition(self, sentence: str, entities: list[dict]) -> list[int]:
+        key = self.__mentions_key(sentence, entities)
+        mentioned_entities_ids = self.__memo.get('mention_recognition', key)
+        is_reused = mentioned_entities_ids is not None
+        if not is_reused:
+            mentioned_entities_ids = self.__llm_oie.mention_recognition(sentence, entities)
+            self.__memo.put('mention_recognition', key, mentioned_entities_ids)
+        _report('mention_recognition', [], is_reused=is_reused)
+        return mentioned_entities_ids
+
+    def mention_recognition_batch(self, sentences: list[str], entities: list[dict]) -> list[list[int]]:
+        # Only the sentences not memoized are sent to the LLM, still with a single batch
+        keys, sentences_mentioned_entities_ids = self.__memoized_mentions(sentences, entities)
+        missing = [i for i, ids in enumerate(sentences_mentioned_entities_ids) if ids is None]
+        if missing:
+            missing_mentioned_entities_ids = self.__llm_oie.mention_recognition_batch(
+                [sentences[i] for i in missing], entities)
+            self.__put_mentions(keys, sentences_mentioned_entities_ids, missing, missing_mentioned_entities_ids)
+        return sentences_mentioned_entities_ids
+
+    def relation_extraction(self, sentence: str, sentence_entities_ids: list[int],
+                            entities: list[dict], output_language: str) -> list[dict]:
+        key = self.__relations_key(sentence, sentence_entities_ids, entities, output_language)
+        sentence_relations = self.__memo.get('relation_extraction', key)
+        is_reused = sentence_relations is not None
+        if not is_reused:
+            sentence_relations = self.__llm_oie.relation_extraction(
+                sentence, sentence_entities_ids, entities, output_language)
+            self.__memo.put('relation_extraction', key, sentence_relations)
+        _report('relation_extraction', sentence_relations, is_reused=is_reused)
+        return sentence_relations
+
+    def predicate_description(self, sentence: str, triplets: list[dict], output_language: str) -> None:
+        key = self.__predicates_key(sentence, triplets, output_language)
+        descriptions = self.__memo.get('predicate_description', key)
+        if descriptions is None:
+            self.__llm_oie.predicate_description(sentence, triplets, output_language)
+            self.__memo.put('predicate_description', key, [t.get('pred_description') for t in triplets])
+            _report('predicate_description', triplets, is_reused=False)
+            return
+        for t_dict, description in zip(triplets, descriptions):
+            t_dict['pred_description'] = description
+        _report('predicate_description', triplets, is_reused=True)
+
+    def fused_relation_extraction(self, sentence: str, sentence_entities_ids: list[int],
+                                  entities: list[dict], output_language: str) -> list[dict]:
+        key = self.__relations_key(sentence, sentence_entities_ids, entities, output_language)
+        sentence_relations = self.__memo.get('fused_relation_extraction', key)
+        is_reused = sentence_relations is not None
+        if not is_reused:
+            sentence_relations = self.__llm_oie.fused_relation_extraction(
+                sentence, sentence_entities_ids, entities, output_language)
+            self.__memo.put('fused_relation_extraction', key, sentence_relations)
+        _report('fused_relation_extraction', sentence_relations, is_reused=is_reused)
+        return sentence_relations
+
+    async def async_entity_extraction(self, text: str, output_language: str) -> list[dict]:
+        key = self.__entities_key(text, output_language)
+        text_entities = self.__memo.get('entity_extraction', key)
+        is_reused = text_entities is not None
+        if not is_reused:
+            text_entities = await self.__llm_oie.async_entity_extraction(text, output_language)
+            self.__memo.put('entity_extraction', key, text_entities)
+        _report('entity_extraction', text_entities, is_reused=is_reused)
+        return text_entities
+
+    async def async_iter_entity_extraction(self, text: str, output_language: str) -> AsyncIterator[dict]:
+        key = self.__entities_key(text, output_language)
+        text_entities = self.__memo.get('entity_extraction', key)
+        if text_entities is not None:
+            _report('entity_extraction', text_entities, is_reused=True)
+            for e_dict in text_entities:
+                yield e_dict
+            return
+        text_entities = []
+        async for e_dict in self.__llm_oie.async_iter_entity_extraction(text, output_language):
+            text_entities.append(e_dict)
+            _report('entity_extraction', [e_dict], is_reused=False, count_call=False)
+            yield e_dict
+        self.__memo.put('entity_extraction', key, text_entities)
+        _report('entity_extraction', [], is_reused=False)
+
+    async def async_phrase_selection(self, text: str, entity_id: int, entities: list[dict]) -> str:
+        return await self.__llm_oie.async_phrase_selection(text, entity_id, entities)
+
+    async def async_mention_recognition(self, sentence: str, entities: list[dict]) -> list[int]:
+        key = self.__mentions_key(sentence, entities)
+        mentioned_entities_ids = self.__memo.get('mention_recognition', key)
+        is_reused = mentioned_entities_ids is not None
+        if not is_reused:
+            mentioned_entities_ids = await self.__llm_oie.async_mention_recognition(sentence, entities)
+            self.__memo.put('mention_recognition', key, mentioned_entities_ids)
+        _report('mention_recognition', [], is_reused=is_reused)
+        return mentioned_entities_ids
+
+    async def async_mention_recognition_batch(self, sentences: list[str], entities: list[dict]) -> list[list[int]]:
+        keys, sentences_mentioned_entities_ids = self.__memoized_mentions(sentences, entities)
+        missing = [i for i, ids in enumerate(sentences_mentioned_entities_ids) if ids is None]
+        if missing:
+            missing_mentioned_entities_ids = await self.__llm_oie.async_mention_recognition_batch(
+                [sentences[i] for i in missing], entities)
+            self.__put_mentions(keys, sentences_mentioned_entities_ids, missing, missing_mentioned_entities_ids)
+        return sentences_mentioned_entities_ids
+
+    async def async_relation_extraction(self, sentence: str, sentence_entities_ids: list[int],
+                                        entities: list[dict], output_language: str) -> list[dict]:
+        key = self.__relations_key(sentence, sentence_entities_ids, entities, output_language)
+        sentence_relations = self.__memo.get('relation_extraction', key)
+        is_reused = sentence_relations is not None
+        if not is_reused:
+            sentence_relations = await self.__llm_oie.async_relation_extraction(
+                sentence, sentence_entities_ids, entities, output_language)
+            self.__memo.put('relation_extraction', key, sentence_relations)
+        _report('relation_extraction', sentence_relations, is_reused=is_reused)
+        return sentence_relations
+
+    async def async_predicate_description(self, sentence: str, triplets: list[dict], output_language: str) -> None:
+        key = self.__predicates_key(sentence, triplets, output_language)
+        descriptions = self.__memo.get('predicate_description', key)
+        if descriptions is None:
+            await self.__llm_oie.async_predicate_description(sentence, triplets, output_language)
+            self.__memo.put('predicate_description', key, [t.get('pred_description') for t in triplets])
+            _report('predicate_description', triplets, is_reused=False)
+            return
+        for t_dict, description in zip(triplets, descriptions):
+            t_dict['pred_description'] = description
+        _report('predicate_description', triplets, is_reused=True)
+
+    async def async_fused_relation_extraction(self, sentence: str, sentence_entities_ids: list[int],
+                                              entities: list[dict], output_language: str) -> list[dict]:
+        key = self.__relations_key(sentence, sentence_entities_ids, entities, output_language)
+        sentence_relations = self.__memo.get('fused_relation_extraction', key)
+        is_reused = sentence_relations is not None
+        if not is_reused:
+            sentence_relations = await self.__llm_oie.async_fused_relation_extraction(
+                sentence, sentence_entities_ids, entities, output_language)
+            self.__memo.put('fused_relation_extraction', key, sentence_relations)
+        _report('fused_relation_extraction', sentence_relations, is_reused=is_reused)
+        return sentence_relations
+
+    def __entities_key(self, text: str, output_language: str) -> str:
+        return StageMemo.make_key(model=self.__model, text=text, output_language=output_language)
+
+    def __mentions_key(self, sentence: str, entities: list[dict]) -> str:
+        return StageMemo.make_key(model=self.__model, sentence=sentence, entities=_entities_inputs(entities))
+
+    def __relations_key(self, sentence: str, sentence_entities_ids: list[int], entities: list[dict],
+                        output_language: str) -> str:
+        return StageMemo.make_key(
+            model=self.__model, sentence=sentence, sentence_entities_ids=sentence_entities_ids,
+            entities=_entities_inputs(entities), output_language=output_language)
+
+    def __predicates_key(self, sentence: str, triplets: list[dict], output_language: str) -> str:
+        return StageMemo.make_key(
+            model=self.__model, sentence=sentence, output_language=output_language,
+            triplets=[{k: v for k, v in t.items() if k != 'pred_description'} for t in triplets])
+
+    def __memoized_mentions(self, sentences: list[str],
+                            entities: list[dict]) -> tuple[list[str], list[list[int] | None]]:
+        keys = [self.__mentions_key(sentence, entities) for sentence in sentences]
+        sentences_mentioned_entities_ids = [self.__memo.get('mention_recognition', key) for key in keys]
+        for ids in sentences_mentioned_entities_ids:
+            _report('mention_recognition', [], is_reused=ids is not None)
+        return keys, sentences_mentioned_entities_ids
+
+    def __put_mentions(self, keys: list[str], sentences_mentioned_entities_ids: list[list[int] | None],
+                       missing: list[int], missing_mentioned_entities_ids: list[list[int]]):
+        for i, mentioned_entities_ids in zip(missing, missing_mentioned_entities_ids):
+            sentences_mentioned_entities_ids[i] = mentioned_entities_ids
+            self.__memo.put('mention_recognition', keys[i], mentioned_entities_ids)
+
+
+# Entities and triplets of a document read from the memo or generated again by the LLM, and the calls of each stage
+#  answered by the memo (`reused`) or by the LLM (`regenerated`). A triplet is reused only if both its relation
+#  extraction and its predicate description are (or its fused relation extraction is).
+class ReuseReport:
+    __stages: dict[str, dict[str, int]]
+    __items: dict[int, tuple[dict, bool]]
+    __lock: threading.Lock
+
+    def __init__(self):
+        self.__stages = {stage: {'reused': 0, 'regenerated': 0} for stage in MEMOIZED_STAGES}
+        # Reuse of the output dictionaries, by identity; the dictionaries are kept here so that their IDs stay unique
+        self.__items = dict()
+        self.__lock = threading.Lock()
+
+    def add(self, stage: str, items: list[dict], is_reused: bool, count_call: bool = True):
+        with self.__lock:
+            if count_call:
+                self.__stages[stage]['reused' if is_reused else 'regenerated'] += 1
+            for item in items:
+                _, was_reused = self.__items.get(id(item), (item, True))
+                self.__items[id(item)] = (item, was_reused and is_reused)
+
+    def is_reused(self, item: dict) -> bool:
+        with self.__lock:
+            return self.__items.get(id(item), (item, False))[1]
+
+    def stages(self) -> dict:
+        with self.__lock:
+            return {stage: dict(counts) for stage, counts in self.__stages.items()}
+
+    def as_dict(self, entities: list[dict], triplets: list[dict]) -> dict:
+        # Split the output of the pipeline into the reused and the regenerated entities and triplets
+        report = {'stages': self.stages()}
+        for name, items in [('entities', entities), ('triplets', triplets)]:
+            report[name] = {'reused': [], 'regenerated': []}
+            for item in items:
+                report[name]['reused' if self.is_reused(item) else 'regenerated'].append(item)
+        return report
+
+
+@contextmanager
+def collect_reuse(report: ReuseReport = None):
+    # Track in `report` (a new one if not given) the reuse of the stages called by a `MemoizedOpenIE` in this context
+    report = report if report is not None else ReuseReport()
+    token = _current_report.set(report)
+    try:
+        yield report
+    finally:
+        _current_report.reset(token)
+
+
+def _report(stage: str, items: list[dict], is_reused: bool, count_call: bool = True):
+    report = _current_report.get()
+    if report is not None:
+        report.add(stage, items, is_reused, count_call=count_call)
+
+
+def _entities_inputs(entities: list[dict]) -> list[dict]:
+    # Only the fields of the entities given to the LLM, in case other fields are added to them
+    return [{k: e.get(k) for k in ['label', 'description', 'types']} for e in entities]
@@ -1,17 +1,38 @@
-LOGGER = None
+import threading
+
+
+# Stand-in of the root logger, configured on its first use rather than when the package is imported
+class _LazyLogger:
+    __logger = None
+    __lock = threading.Lock()
+
+    def __getattr__(self, name: str):
+        return getattr(self.get(), name)
+
+    def get(self):
+        if _LazyLogger.__logger is None:
+            with _LazyLogger.__lock:
+                if _LazyLogger.__logger is None:
+                    _LazyLogger.__logger = _configure()
+        return _LazyLogger.__logger
+
+
+LOGGER = _LazyLogger()
 
 
 def init():
+    # Configure the logging right away, instead of on the first message
+    LOGGER.get()
+
+
+def _configure():
     import logging
     from logging.config import fileConfig
     from pathlib import Path
 
-    global LOGGER
-
     logger_config_file = Path(__file__).parent.joinpath('logging.ini').resolve()
-    fileConfig(logger_config_file)
-    LOGGER = logging.getLogger()
-    LOGGER.debug(f'Loaded LOGGER from {logger_config_file}')
-
-
-init()
+    # The loggers created by the application before the first message must keep working
+    fileConfig(logger_config_file, disable_existing_loggers=False)
+    logger = logging.getLogger()
+    logger.debug(f'Loaded LOGGER from {logger_config_file}')
+    return logger
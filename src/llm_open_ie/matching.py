@@ -0,0 +1,88 @@
+from __future__ import annotations
+
+from collections import Counter
+from difflib import SequenceMatcher
+import heapq
+import re
+
+# Fast drop-in replacements of the `difflib` similarity checks used by the stage parsers: before computing the actual
+#  `SequenceMatcher.ratio`, the candidates are filtered with the same upper bounds `difflib` uses (the one given by the
+#  strings lengths and the one given by their characters counts), which are cheap and precomputed once per call. The
+#  accepted and rejected matches are exactly the ones of `difflib`.
+
+
+def normalize_label(label: str) -> str:
+    # Lower case words without punctuation, to find the same label written in different ways (e.g. the entities of
+    #  different chunks, the gold surface forms, the predicates of the registry and the labels of the store)
+    return ' '.join(re.sub(r'[^\w\s]', ' ', label.casefold()).split())
+
+
+def ratio_at_least(a: str, b: str, threshold: float) -> bool:
+    # Same as `SequenceMatcher(None, a, b).ratio() >= threshold`
+    if a == b:
+        return 1.0 >= threshold
+    length = len(a) + len(b)
+    if _ratio(min(len(a), len(b)), length) < threshold:
+        return False
+    if _ratio(_count_matches(Counter(a), Counter(b)), length) < threshold:
+        return False
+    return SequenceMatcher(None, a, b).ratio() >= threshold
+
+
+# Index of the possible matches of `difflib.get_close_matches`, bucketed by length and with their characters counts
+class CloseMatcher:
+    __possibilities: list[str]
+    __length_buckets: dict[int, list[int]]
+    __char_counts: list[Counter]
+    __results: dict[tuple[str, int, float], list[str]]
+
+    def __init__(self, possibilities: list[str]):
+        self.__possibilities = list(possibilities)
+        self.__length_buckets = dict()
+        for i, possibility in enumerate(self.__possibilities):
+            self.__length_buckets.setdefault(len(possibility), []).append(i)
+        self.__char_counts = [Counter(possibility) for possibility in self.__possibilities]
+        # The same labels are usually looked up many times (e.g., once per answer line and once per triplet)
+        self.__results = dict()
+
+    def get_close_matches(self, word: str, n: int = 3, cutoff: float = 0.6) -> list[str]:
+        # Same as `difflib.get_close_matches(word, possibilities, n, cutoff)`
+        if not n > 0:
+            raise ValueError(f'n must be > 0: {n!r}')
+        if not 0.0 <= cutoff <= 1.0:
+            raise ValueError(f'cutoff must be in [0.0, 1.0]: {cutoff!r}')
+        if (word, n, cutoff) in self.__results:
+            return list(self.__results[word, n, cutoff])
+
+        word_char_counts = None
+        seq_match = SequenceMatcher()
+        seq_match.set_seq2(word)
+        result = []
+        for length, bucket in self.__length_buckets.items():
+            if _ratio(min(length, len(word)), length + len(word)) < cutoff:
+                continue
+            if word_char_counts is None:
+                word_char_counts = Counter(word)
+            for i in bucket:
+                if _ratio(_count_matches(self.__char_counts[i], word_char_counts), length + len(word)) < cutoff:
+                    continue
+                seq_match.set_seq1(self.__possibilities[i])
+                score = seq_match.ratio()
+                if score >= cutoff:
+                    result.append((score, self.__possibilities[i]))
+
+        self.__results[word, n, cutoff] = [x for score, x in heapq.nlargest(n, result)]
+        return list(self.__results[word, n, cutoff])
+
+
+def _ratio(matches: int, length: int) -> float:
+    # Same formula of `difflib`, so that the bounds are compared to the thresholds with the very same rounding
+    if length:
+        return 2.0 * matches / length
+    return 1.0
+
+
+def _count_matches(a_char_counts: Counter, b_char_counts: Counter) -> int:
+    if len(a_char_counts) > len(b_char_counts):
+        a_char_counts, b_char_counts = b_char_counts, a_char_counts
+    return sum([min(count, b_char_counts[c]) for c, count in a_char_counts.items()])
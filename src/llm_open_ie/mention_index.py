@@ -0,0 +1,127 @@
+from __future__ import annotations
+
+from functools import lru_cache
+import re
+import threading
+import unicodedata
+
+MENTION_POLICIES = ['off', 'prefilter', 'lexical']
+
+# Words that alone are not enough to tell that an entity is mentioned
+STOPWORDS = frozenset([
+    'a', 'an', 'the', 'of', 'in', 'on', 'at', 'to', 'for', 'from', 'by', 'with', 'and', 'or', 'de', 'del', 'della',
+    'di', 'da', 'la', 'le', 'il', 'lo', 'el', 'los', 'las', 'du', 'des', 'der', 'die', 'das', 'von', 'van'
+])
+ARTICLES = frozenset(['a', 'an', 'the'])
+
+
+# Local matcher of the entity labels in a sentence, telling which entities are certainly mentioned (one of the label
+#  variants appears as a whole), which are certainly not (none of the significant words of the label appears) and
+#  which are uncertain and must be checked by the LLM.
+# The label variants are stored in a trie of normalized words, so all of them are found in a single scan of the
+#  sentence words.
+class MentionIndex:
+    __n_entities: int
+    __trie: dict
+    __word_entities: dict[str, set[int]]
+    __unmatchable_entities: set[int]
+
+    def __init__(self, labels: list[str]):
+        self.__n_entities = len(labels)
+        self.__trie = dict()
+        self.__word_entities = dict()
+        self.__unmatchable_entities = set()
+
+        for e_i, label in enumerate(labels):
+            words = normalize_words(label)
+            for variant in _label_variants(words):
+                node = self.__trie
+                for word in variant:
+                    node = node.setdefault(word, dict())
+                node.setdefault(None, set()).add(e_i)
+
+            significant_words = [_stem(w) for w in words if w not in STOPWORDS and (len(w) > 1 or w.isdigit())]
+            if not significant_words:
+                # There is no way to tell if such an entity is absent, so it is always left to the LLM
+                self.__unmatchable_entities.add(e_i)
+            for word in significant_words:
+                self.__word_entities.setdefault(word, set()).add(e_i)
+
+    def classify(self, sentence: str) -> tuple[list[int], list[int], list[int]]:
+        # Return the IDs of the mentioned, absent and ambiguous entities
+        words = normalize_words(sentence)
+
+        mentioned = set()
+        for start in range(len(words)):
+            node = self.__trie
+            for word in words[start:]:
+                node = node.get(word)
+                if node is None:
+                    break
+                mentioned.update(node.get(None, ()))
+
+        partially_mentioned = set(self.__unmatchable_entities)
+        for word in {_stem(w) for w in words}:
+            partially_mentioned.update(self.__word_entities.get(word, ()))
+        ambiguous = partially_mentioned - mentioned
+
+        absent = set(range(self.__n_entities)) - mentioned - ambiguous
+        return sorted(mentioned), sorted(absent), sorted(ambiguous)
+
+
+# Counters of the requests (and prompt tokens) avoided thanks to the mention index; shared by concurrent stages
+class MentionIndexStats:
+    __counters: dict[str, int]
+    __lock: threading.Lock
+
+    def __init__(self):
+        self.__counters = {
+            'sentences': 0,
+            'skipped_requests': 0,
+            'saved_prompt_tokens': 0,
+            'lexical_mentions': 0,
+            'lexical_absences': 0,
+            'ambiguous': 0
+        }
+        self.__lock = threading.Lock()
+
+    def add(self, **counts: int):
+        with self.__lock:
+            for k, v in counts.items():
+                self.__counters[k] += v
+
+    def as_dict(self) -> dict:
+        with self.__lock:
+            return dict(self.__counters)
+
+
+@lru_cache(maxsize=16)
+def get_mention_index(labels: tuple[str, ...]) -> MentionIndex:
+    # The same entity list is used for all the sentences of a document: build its index only once
+    return MentionIndex(list(labels))
+
+
+def normalize_words(text: str) -> list[str]:
+    # Lower case words without accents and punctuation
+    text = unicodedata.normalize('NFKD', text.casefold())
+    text = ''.join([c for c in text if not unicodedata.combining(c)])
+    return re.sub(r'[^\w]+', ' ', text).split()
+
+
+def _label_variants(words: list[str]) -> set[tuple[str, ...]]:
+    variants = {tuple(words)}
+    if len(words) > 1 and words[0] in ARTICLES:
+        variants.add(tuple(words[1:]))
+    # Plural forms of the last word
+    variants.update([tuple(v[:-1]) + (v[-1] + suffix,) for v in list(variants) if v for suffix in ['s', 'es']])
+    variants.update([tuple(v[:-1]) + (v[-1][:-1] + 'ies',) for v in list(variants) if v and v[-1].endswith('y')])
+    return {v for v in variants if v}
+
+
+def _stem(word: str) -> str:
+    # Very light stemming, just to make singular and plural words match
+    if len(word) > 4 and word.endswith('ies'):
+        return word[:-3] + 'y'
+    if len(word) > 3 and word.endswith('s'):
+        return word[:-1]
+    return word
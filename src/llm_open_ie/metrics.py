@@ -0,0 +1,298 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Callable, Iterator
+import json
+import threading
+
+METRICS_FORMATS = ['json', 'prometheus']
+# Stage of the calls and parsed answers sent outside of any stage
+OTHER_STAGE = 'other'
+
+# Counters aggregated for each stage, with the name and help of their Prometheus metric
+STAGE_COUNTERS = {
+    'calls': ('calls_total', 'LLM calls, including the ones answered by the cache'),
+    'cached_calls': ('cached_calls_total', 'LLM calls answered by the cache'),
+    'retries': ('retries_total', 'LLM requests sent again after a failure'),
+    'queue_wait_seconds': ('queue_wait_seconds_total', 'Time waited under the rate limiter before the requests'),
+    'latency_seconds': ('request_latency_seconds_total', 'Time taken by the successful requests'),
+    'prompt_tokens': ('prompt_tokens_total', 'Prompt tokens reported by the LLM usage'),
+    'completion_tokens': ('completion_tokens_total', 'Completion tokens reported by the LLM usage'),
+    'answer_lines': ('answer_lines_total', 'Lines of the parsed answers'),
+    'malformed_lines': ('malformed_lines_total', 'Answer lines dropped because not matching the expected pattern'),
+    'inconsistent_lines': ('inconsistent_lines_total', 'Answer lines dropped because not matching the prompt'),
+    'prompts': ('prompts_total', 'Prompts built by the stages, including the ones answered by the cache'),
+    'prompt_prefix_tokens': ('prompt_prefix_tokens_total',
+                             'Tokens of the prompts static prefix, shared with the other calls of the stage'),
+    'split_calls': ('split_calls_total', 'LLM calls added to keep the prompts within the tokens budget'),
+    'hedged_requests': ('hedged_requests_total', 'Duplicate requests sent because the first one was slow'),
+    'hedge_wins': ('hedge_wins_total', 'Duplicate requests answered before the first one'),
+    'escalated_calls': ('escalated_calls_total',
+                        'Routed LLM calls asked again to a stronger model because of malformed answers')
+}
+
+# Collector of the current pipeline run and stage of the current context: they follow the calls in the worker threads
+#  and tasks started by the pipeline, as long as they copy the context of the caller
+_current_metrics: ContextVar[PipelineMetrics | None] = ContextVar('current_metrics', default=None)
+_current_stage: ContextVar[str | None] = ContextVar('current_stage', default=None)
+
+
+# Metrics of the LLM calls of the pipeline, aggregated for each stage: the ones of a single document are returned by
+#  `oie_pipeline(..., return_metrics=True)`, and many of them can be merged in the metrics of a whole run. Each call and
+#  parsed answer is also passed, as soon as it is recorded, to the optional `callback` (e.g. to forward it to a tracing
+#  system) as an event dictionary.
+class PipelineMetrics:
+    __documents: int
+    __stages: dict[str, dict]
+    __callback: Callable[[dict], None] | None
+    __lock: threading.Lock
+
+    def __init__(self, callback: Callable[[dict], None] = None):
+        self.__documents = 0
+        self.__stages = dict()
+        self.__callback = callback
+        self.__lock = threading.Lock()
+
+    def __getstate__(self) -> dict:
+        # The metrics of the documents processed by other processes are merged in the parent process: the lock and the
+        #  callback stay there
+        return {'documents': self.__documents, 'stages': self.as_dict()['stages']}
+
+    def __setstate__(self, state: dict):
+        self.__documents = state['documents']
+        self.__stages = state['stages']
+        self.__callback = None
+        self.__lock = threading.Lock()
+
+    @property
+    def documents(self) -> int:
+        return self.__documents
+
+    def add_document(self):
+        with self.__lock:
+            self.__documents += 1
+
+    def add_call(self, stage: str | None, model: str, queue_wait_seconds: float = 0.0, latency_seconds: float = 0.0,
+                 prompt_tokens: int = 0, completion_tokens: int = 0, retries: int = 0, cached: bool = False):
+        event = {
+            'event': 'call',
+            'stage': stage if stage is not None else OTHER_STAGE,
+            'model': model,
+            'queue_wait_seconds': queue_wait_seconds,
+            'latency_seconds': latency_seconds,
+            'prompt_tokens': prompt_tokens,
+            'completion_tokens': completion_tokens,
+            'retries': retries,
+            'cached': cached
+        }
+        with self.__lock:
+            counters = self.__stage_counters(event['stage'])
+            counters['calls'] += 1
+            counters['cached_calls'] += int(cached)
+            counters['retries'] += retries
+            counters['queue_wait_seconds'] += queue_wait_seconds
+            counters['latency_seconds'] += latency_seconds
+            counters['max_latency_seconds'] = max(counters['max_latency_seconds'], latency_seconds)
+            counters['prompt_tokens'] += prompt_tokens
+            counters['completion_tokens'] += completion_tokens
+        if self.__callback is not None:
+            self.__callback(event)
+
+    def add_parse(self, stage: str | None, answer_lines: int, malformed_lines: int = 0, inconsistent_lines: int = 0):
+        event = {
+            'event': 'parse',
+            'stage': stage if stage is not None else OTHER_STAGE,
+            'answer_lines': answer_lines,
+            'malformed_lines': malformed_lines,
+            'inconsistent_lines': inconsistent_lines
+        }
+        with self.__lock:
+            counters = self.__stage_counters(event['stage'])
+            counters['answer_lines'] += answer_lines
+            counters['malformed_lines'] += malformed_lines
+            counters['inconsistent_lines'] += inconsistent_lines
+        if self.__callback is not None:
+            self.__callback(event)
+
+    def add_prompt(self, stage: str | None, prompt_tokens: int, prefix_tokens: int):
+        # A prompt built by a stage, with the tokens of its static prefix (cacheable by the provider)
+        event = {
+            'event': 'prompt',
+            'stage': stage if stage is not None else OTHER_STAGE,
+            'prompt_tokens': prompt_tokens,
+            'prefix_tokens': prefix_tokens
+        }
+        with self.__lock:
+            counters = self.__stage_counters(event['stage'])
+            counters['prompts'] += 1
+            counters['prompt_prefix_tokens'] += prefix_tokens
+        if self.__callback is not None:
+            self.__callback(event)
+
+    def add_split_calls(self, stage: str | None, split_calls: int):
+        event = {'event': 'split', 'stage': stage if stage is not None else OTHER_STAGE, 'split_calls': split_calls}
+        with self.__lock:
+            self.__stage_counters(event['stage'])['split_calls'] += split_calls
+        if self.__callback is not None:
+            self.__callback(event)
+
+    def add_hedge(self, stage: str | None, won: bool):
+        # A duplicate of a slow request, which may have been answered first (`won`)
+        event = {'event': 'hedge', 'stage': stage if stage is not None else OTHER_STAGE, 'won': won}
+        with self.__lock:
+            counters = self.__stage_counters(event['stage'])
+            counters['hedged_requests'] += 1
+            counters['hedge_wins'] += int(won)
+        if self.__callback is not None:
+            self.__callback(event)
+
+    def add_escalation(self, stage: str | None):
+        # A routed call asked again to a stronger model, since too many lines of its answer were malformed
+        event = {'event': 'escalation', 'stage': stage if stage is not None else OTHER_STAGE}
+        with self.__lock:
+            self.__stage_counters(event['stage'])['escalated_calls'] += 1
+        if self.__callback is not None:
+            self.__callback(event)
+
+    def merge(self, other: PipelineMetrics):
+        # Add the metrics of other documents (or runs) to these ones
+        other_state = other.__getstate__()
+        with self.__lock:
+            self.__documents += other_state['documents']
+            for stage, other_counters in other_state['stages'].items():
+                counters = self.__stage_counters(stage)
+                for k, v in other_counters.items():
+                    counters[k] = max(counters[k], v) if k == 'max_latency_seconds' else counters[k] + v
+
+    def as_dict(self) -> dict:
+        with self.__lock:
+            stages = {stage: dict(counters) for stage, counters in self.__stages.items()}
+        totals = {k: sum([counters[k] for counters in stages.values()]) for k in STAGE_COUNTERS}
+        totals['max_latency_seconds'] = max([c['max_latency_seconds'] for c in stages.values()], default=0.0)
+        return {'documents': self.__documents, 'totals': totals, 'stages': stages}
+
+    def to_json(self, indent: int = None) -> str:
+        return json.dumps(self.as_dict(), indent=indent)
+
+    def to_prometheus(self, prefix: str = 'llm_open_ie') -> str:
+        # Prometheus text exposition format, with a `stage` label on each metric of the stages
+        metrics_dict = self.as_dict()
+        lines = [
+            f'# HELP {prefix}_documents_total Documents processed by the pipeline',
+            f'# TYPE {prefix}_documents_total counter',
+            f'{prefix}_documents_total {metrics_dict["documents"]}'
+        ]
+        for k, (name, help_str) in STAGE_COUNTERS.items():
+            lines.extend([f'# HELP {prefix}_{name} {help_str}', f'# TYPE {prefix}_{name} counter'])
+            lines.extend([
+                f'{prefix}_{name}{{stage="{stage}"}} {counters[k]}'
+                for stage, counters in metrics_dict['stages'].items()
+            ])
+        lines.extend([
+            f'# HELP {prefix}_request_latency_seconds_max Longest successful request',
+            f'# TYPE {prefix}_request_latency_seconds_max gauge'
+        ])
+        lines.extend([
+            f'{prefix}_request_latency_seconds_max{{stage="{stage}"}} {counters["max_latency_seconds"]}'
+            for stage, counters in metrics_dict['stages'].items()
+        ])
+        return '\n'.join(lines) + '\n'
+
+    def export(self, metrics_format: str = 'json') -> str:
+        if metrics_format not in METRICS_FORMATS:
+            options_str = ', '.join([f'`{v}`' for v in METRICS_FORMATS])
+            raise ValueError(f'`{metrics_format}` is not a valid option: choose one between {options_str}')
+        return self.to_json(indent=2) if metrics_format == 'json' else self.to_prometheus()
+
+    def __stage_counters(self, stage: str) -> dict:
+        if stage not in self.__stages:
+            self.__stages[stage] = {k: 0 for k in STAGE_COUNTERS}
+            self.__stages[stage]['max_latency_seconds'] = 0.0
+        return self.__stages[stage]
+
+
+@contextmanager
+def collect_metrics(metrics: PipelineMetrics | None):
+    # Record the calls and parsed answers of the current context in `metrics` (nothing is recorded with `None`)
+    token = _current_metrics.set(metrics)
+    try:
+        yield metrics
+    finally:
+        _current_metrics.reset(token)
+
+
+@contextmanager
+def stage_scope(stage: str):
+    token = _current_stage.set(stage)
+    try:
+        yield
+    finally:
+        _current_stage.reset(token)
+
+
+def iter_in_stage(stage: str, items: Iterator) -> Iterator:
+    # The stage of a generator is only set while getting its next item, since its caller runs in the same context
+    while True:
+        with stage_scope(stage):
+            item = next(items, StopIteration)
+        if item is StopIteration:
+            return
+        yield item
+
+
+async def async_iter_in_stage(stage: str, items: AsyncIterator) -> AsyncIterator:
+    while True:
+        with stage_scope(stage):
+            item = await anext(items, StopIteration)
+        if item is StopIteration:
+            return
+        yield item
+
+
+def record_call(model: str, queue_wait_seconds: float = 0.0, latency_seconds: float = 0.0, prompt_tokens: int = 0,
+                completion_tokens: int = 0, retries: int = 0, cached: bool = False):
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.add_call(_current_stage.get(), model, queue_wait_seconds, latency_seconds, prompt_tokens,
+                         completion_tokens, retries, cached)
+
+
+def record_parse(answer_lines: int, malformed_lines: int = 0, inconsistent_lines: int = 0):
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.add_parse(_current_stage.get(), answer_lines, malformed_lines, inconsistent_lines)
+
+
+def current_stage() -> str:
+    stage = _current_stage.get()
+    return stage if stage is not None else OTHER_STAGE
+
+
+def is_collecting_metrics() -> bool:
+    # Whether a collector is set in the current context, e.g. to skip counting the tokens only needed by the metrics
+    return _current_metrics.get() is not None
+
+
+def record_prompt(prompt_tokens: int, prefix_tokens: int):
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.add_prompt(_current_stage.get(), prompt_tokens, prefix_tokens)
+
+
+def record_split_calls(split_calls: int):
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.add_split_calls(_current_stage.get(), split_calls)
+
+
+def record_hedge(won: bool):
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.add_hedge(_current_stage.get(), won)
+
+
+def record_escalation():
+    metrics = _current_metrics.get()
+    if metrics is not None:
+        metrics.add_escalation(_current_stage.get())
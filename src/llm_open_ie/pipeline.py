@@ -0,0 +1,462 @@
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import aclosing, suppress
+from typing import AsyncIterator, Callable, Iterator
+import asyncio
+import contextvars
+
+from llm_open_ie.llm import LLMOpenIE
+from llm_open_ie.llm.deadlines import retry_budget_scope
+from llm_open_ie.logger import LOGGER
+from llm_open_ie.metrics import PipelineMetrics, collect_metrics
+
+# Maximum number of entities whose phrase selection and mention recognition run while the entities are still streamed
+MAX_EARLY_ENTITIES = 4
+
+
+def oie_pipeline(text: str, llm_oie: LLMOpenIE, output_language='English',
+                 batch_mentions: bool = False, stream_entities: bool = False, return_metrics: bool = False,
+                 metrics_callback: Callable[[dict], None] = None, fuse_relations: bool = False,
+                 retry_budget: int = None
+                 ) -> tuple[list[dict], list[dict]] | tuple[list[dict], list[dict], PipelineMetrics]:
+    # With `batch_mentions`, the mentions in the sentences of many entities are recognized with a single request; with
+    #  `stream_entities`, the phrase selection and mention recognition of each entity start as soon as it is extracted.
+    # With `fuse_relations`, the relations of each sentence are extracted together with the descriptions of their
+    #  predicates, with a single request instead of two (see `LLMOpenIE.fused_relation_extraction`).
+    # With `retry_budget`, the failed requests of the document are sent again at most that number of times in total.
+    # With `return_metrics`, the metrics of the LLM calls of the document are returned too, while `metrics_callback`
+    #  gets each call and parsed answer as soon as it is recorded (see `PipelineMetrics`)
+    metrics = PipelineMetrics(callback=metrics_callback) if return_metrics or metrics_callback is not None else None
+    with collect_metrics(metrics), retry_budget_scope(retry_budget):
+        text_entities, text_triplets = _oie_pipeline(
+            text, llm_oie, output_language, batch_mentions, stream_entities, fuse_relations)
+    if not return_metrics:
+        return text_entities, text_triplets
+    metrics.add_document()
+    return text_entities, text_triplets, metrics
+
+
+def iter_oie_pipeline(text: str, llm_oie: LLMOpenIE, output_language='English',
+                      batch_mentions: bool = False, stream_entities: bool = False, fuse_relations: bool = False,
+                      retry_budget: int = None, metrics: PipelineMetrics = None
+                      ) -> Iterator[list[dict] | tuple[int, list[dict]]]:
+    # Same as `oie_pipeline`, but yielding the list of entities as soon as it is known and then, entity by entity, the
+    #  ID of the entity with its triplets as soon as they are complete, without keeping them: the consumer can write
+    #  them to a sink as they arrive, and stopping the iteration (or closing the generator) sends no further request.
+    #  The calls of the document are recorded in `metrics`, if given.
+    # Each step runs in a context of its own, so that the metrics and the retry budget of the document are not set in
+    #  the code of the consumer between the steps
+    context = contextvars.copy_context()
+    steps = _iter_scoped_oie_pipeline(
+        text, llm_oie, output_language, batch_mentions, stream_entities, fuse_relations, retry_budget, metrics)
+    try:
+        while True:
+            try:
+                step = context.run(next, steps)
+            except StopIteration:
+                return
+            yield step
+    finally:
+        context.run(steps.close)
+
+
+def _iter_scoped_oie_pipeline(text: str, llm_oie: LLMOpenIE, output_language: str, batch_mentions: bool,
+                              stream_entities: bool, fuse_relations: bool, retry_budget: int | None,
+                              metrics: PipelineMetrics | None) -> Iterator[list[dict] | tuple[int, list[dict]]]:
+    with collect_metrics(metrics), retry_budget_scope(retry_budget):
+        yield from _iter_oie_pipeline(text, llm_oie, output_language, batch_mentions, stream_entities, fuse_relations)
+    if metrics is not None:
+        metrics.add_document()
+
+
+def _oie_pipeline(text: str, llm_oie: LLMOpenIE, output_language: str, batch_mentions: bool, stream_entities: bool,
+                  fuse_relations: bool) -> tuple[list[dict], list[dict]]:
+    steps = _iter_oie_pipeline(text, llm_oie, output_language, batch_mentions, stream_entities, fuse_relations)
+    text_entities = next(steps)
+    text_triplets = [r for _, sentence_relations in steps for r in sentence_relations]
+    return text_entities, text_triplets
+
+
+def _iter_oie_pipeline(text: str, llm_oie: LLMOpenIE, output_language: str, batch_mentions: bool,
+                       stream_entities: bool, fuse_relations: bool) -> Iterator[list[dict] | tuple[int, list[dict]]]:
+    if batch_mentions and stream_entities:
+        raise ValueError('`batch_mentions` and `stream_entities` cannot be both set.')
+    output_language = _normalize_language(output_language)
+
+    if stream_entities:
+        # 0), 1) and 2) overlapped: see `_streamed_entities_mentions`
+        text_entities, e_sentences, sentences_mentioned_entities_ids = _streamed_entities_mentions(
+            text, llm_oie, output_language)
+    else:
+        # 0) Entity Extraction: find all the entities in the text, with a label, description and list of types for
+        #  each one
+        text_entities = llm_oie.entity_extraction(text, output_language)
+        _log_entities(text_entities)
+    yield text_entities
+
+    if not stream_entities:
+        if batch_mentions:
+            # 1) and 2) in advance for all the entities, as the selected phrases do not depend on each other
+            e_sentences = [_select_phrase(text, e_i, text_entities, llm_oie) for e_i in range(len(text_entities))]
+            sentences_mentioned_entities_ids = llm_oie.mention_recognition_batch(e_sentences, text_entities)
+        else:
+            e_sentences, sentences_mentioned_entities_ids = None, None
+
+    # Iterative triple extraction: repeat for each one of the found entities
+    for e_i in range(len(text_entities)):
+        LOGGER.info(f'Checking entity {e_i+1}/{len(text_entities)}: "{text_entities[e_i]["label"]}"')
+        if e_sentences is not None:
+            e_sentence, sentence_mentioned_entities_ids = e_sentences[e_i], sentences_mentioned_entities_ids[e_i]
+        else:
+            # 1) Phrase Selection: get a phrase focusing on the actual entity
+            e_sentence = _select_phrase(text, e_i, text_entities, llm_oie)
+            # 2) Mention Recognition: find which other entities are mentioned in the artificial sentence
+            sentence_mentioned_entities_ids = llm_oie.mention_recognition(e_sentence, text_entities)
+
+        # Hand the triplets of the entity over
+        sentence_relations = _sentence_triplets(
+            e_sentence, sentence_mentioned_entities_ids, text_entities, llm_oie, output_language, fuse_relations)
+        yield e_i, sentence_relations
+
+
+async def async_oie_pipeline(text: str, llm_oie: LLMOpenIE, output_language='English', max_concurrency: int = 8,
+                             batch_mentions: bool = False, stream_entities: bool = False, return_metrics: bool = False,
+                             metrics_callback: Callable[[dict], None] = None, fuse_relations: bool = False,
+                             retry_budget: int = None
+                             ) -> tuple[list[dict], list[dict]] | tuple[list[dict], list[dict], PipelineMetrics]:
+    # Same as `oie_pipeline`, but the entities are checked concurrently (at most `max_concurrency` at a time); the
+    #  triplets are still collected in the entities order, so the output is the same of the sequential pipeline
+    metrics = PipelineMetrics(callback=metrics_callback) if return_metrics or metrics_callback is not None else None
+    with collect_metrics(metrics), retry_budget_scope(retry_budget):
+        text_entities, text_triplets = await _async_oie_pipeline(
+            text, llm_oie, output_language, max_concurrency, batch_mentions, stream_entities, fuse_relations)
+    if not return_metrics:
+        return text_entities, text_triplets
+    metrics.add_document()
+    return text_entities, text_triplets, metrics
+
+
+async def async_iter_oie_pipeline(text: str, llm_oie: LLMOpenIE, output_language='English', max_concurrency: int = 8,
+                                  batch_mentions: bool = False, stream_entities: bool = False,
+                                  fuse_relations: bool = False, retry_budget: int = None,
+                                  metrics: PipelineMetrics = None
+                                  ) -> AsyncIterator[list[dict] | tuple[int, list[dict]]]:
+    # Same as `iter_oie_pipeline`, but the entities are checked concurrently (at most `max_concurrency` at a time) and
+    #  their triplets are yielded as soon as each entity is complete, so not in the entities order. Closing the
+    #  generator (e.g. breaking out of the loop) or cancelling the consumer cancels the requests in flight.
+    # The pipeline runs in a task of its own, with its metrics and retry budget, handing each step over as soon as the
+    #  consumer took the previous one: the triplets of at most `max_concurrency` entities are held in the meantime
+    steps = asyncio.Queue(maxsize=1)
+    producer = asyncio.create_task(_async_produce_oie_steps(
+        steps, text, llm_oie, output_language, max_concurrency, batch_mentions, stream_entities, fuse_relations,
+        retry_budget, metrics))
+    try:
+        while True:
+            step, is_over = await steps.get()
+            if is_over:
+                # The step is then the error of the pipeline, if any
+                if step is not None:
+                    raise step
+                return
+            yield step
+    finally:
+        producer.cancel()
+        with suppress(asyncio.CancelledError):
+            await producer
+
+
+async def _async_produce_oie_steps(steps: asyncio.Queue, text: str, llm_oie: LLMOpenIE, output_language: str,
+                                   max_concurrency: int, batch_mentions: bool, stream_entities: bool,
+                                   fuse_relations: bool, retry_budget: int | None, metrics: PipelineMetrics | None):
+    try:
+        with collect_metrics(metrics), retry_budget_scope(retry_budget):
+            pipeline_steps = _async_iter_oie_pipeline(
+                text, llm_oie, output_language, max_concurrency, batch_mentions, stream_entities, fuse_relations)
+            async with aclosing(pipeline_steps):
+                async for step in pipeline_steps:
+                    await steps.put((step, False))
+        if metrics is not None:
+            metrics.add_document()
+    except Exception as e:
+        await steps.put((e, True))
+        return
+    await steps.put((None, True))
+
+
+async def _async_oie_pipeline(text: str, llm_oie: LLMOpenIE, output_language: str, max_concurrency: int,
+                              batch_mentions: bool, stream_entities: bool,
+                              fuse_relations: bool) -> tuple[list[dict], list[dict]]:
+    # The triplets are collected in the entities order, whatever the order they are complete in
+    async with aclosing(_async_iter_oie_pipeline(text, llm_oie, output_language, max_concurrency,
+                                                 batch_mentions, stream_entities, fuse_relations)) as steps:
+        text_entities = await anext(steps)
+        entities_triplets = dict([step async for step in steps])
+    text_triplets = [r for e_i in range(len(text_entities)) for r in entities_triplets[e_i]]
+    return text_entities, text_triplets
+
+
+async def _async_iter_oie_pipeline(text: str, llm_oie: LLMOpenIE, output_language: str, max_concurrency: int,
+                                   batch_mentions: bool, stream_entities: bool,
+                                   fuse_relations: bool) -> AsyncIterator[list[dict] | tuple[int, list[dict]]]:
+    if max_concurrency < 1:
+        raise ValueError(f'`max_concurrency` must be a positive integer, got {max_concurrency}.')
+    if batch_mentions and stream_entities:
+        raise ValueError('`batch_mentions` and `stream_entities` cannot be both set.')
+    output_language = _normalize_language(output_language)
+    semaphore = asyncio.Semaphore(max_concurrency)
+
+    early_tasks = None
+    if stream_entities:
+        # 0), 1) and 2) overlapped: see `_streamed_entities_mentions`
+        text_entities, early_tasks = await _async_streamed_entities_mentions(text, llm_oie, output_language, semaphore)
+    else:
+        # 0) Entity Extraction
+        text_entities = await llm_oie.async_entity_extraction(text, output_language)
+        _log_entities(text_entities)
+    pending_tasks = set()
+    try:
+        yield text_entities
+        entities_steps = _async_entities_triplets(
+            text, text_entities, early_tasks, pending_tasks, llm_oie, output_language, max_concurrency, semaphore,
+            batch_mentions, fuse_relations)
+        async with aclosing(entities_steps):
+            async for step in entities_steps:
+                yield step
+    finally:
+        await _cancel_tasks([*pending_tasks, *(early_tasks or [])])
+
+
+async def _async_entities_triplets(text: str, text_entities: list[dict], early_tasks: list[asyncio.Task] | None,
+                                   pending_tasks: set[asyncio.Task], llm_oie: LLMOpenIE, output_language: str,
+                                   max_concurrency: int, semaphore: asyncio.Semaphore, batch_mentions: bool,
+                                   fuse_relations: bool) -> AsyncIterator[tuple[int, list[dict]]]:
+    if batch_mentions:
+        # 1) and 2) in advance for all the entities
+        e_sentences = [
+            await _async_select_phrase(text, e_i, text_entities, llm_oie) for e_i in range(len(text_entities))]
+        sentences_mentioned_entities_ids = await llm_oie.async_mention_recognition_batch(e_sentences, text_entities)
+    else:
+        e_sentences, sentences_mentioned_entities_ids = None, None
+
+    # Concurrent triple extraction: one task for each one of the found entities
+    async def entity_triplets(e_i: int) -> tuple[int, list[dict]]:
+        if early_tasks is not None:
+            # Outside of the semaphore, which is needed by the early task itself
+            e_sentence, sentence_mentioned_entities_ids = await _async_complete_mentions(
+                await early_tasks[e_i], text_entities, llm_oie, semaphore)
+        async with semaphore:
+            LOGGER.info(f'Checking entity {e_i+1}/{len(text_entities)}: "{text_entities[e_i]["label"]}"')
+            if batch_mentions:
+                e_sentence, sentence_mentioned_entities_ids = e_sentences[e_i], sentences_mentioned_entities_ids[e_i]
+            elif early_tasks is None:
+                # 1) Phrase Selection
+                e_sentence = await _async_select_phrase(text, e_i, text_entities, llm_oie)
+                # 2) Mention Recognition
+                sentence_mentioned_entities_ids = await llm_oie.async_mention_recognition(e_sentence, text_entities)
+            return e_i, await _async_sentence_triplets(
+                e_sentence, sentence_mentioned_entities_ids, text_entities, llm_oie, output_language, fuse_relations)
+
+    # At most `max_concurrency` entities are checked at a time, the next one starting as soon as one is complete
+    #  (the tasks in flight are kept in `pending_tasks`, for the caller to cancel them)
+    next_e_i = 0
+    while next_e_i < len(text_entities) or pending_tasks:
+        while next_e_i < len(text_entities) and len(pending_tasks) < max_concurrency:
+            pending_tasks.add(asyncio.create_task(entity_triplets(next_e_i)))
+            next_e_i += 1
+        done_tasks, _ = await asyncio.wait(pending_tasks, return_when=asyncio.FIRST_COMPLETED)
+        pending_tasks.difference_update(done_tasks)
+        # The errors of all the tasks complete together are retrieved, even if only the first one is raised
+        errors = [task.exception() for task in done_tasks if task.exception() is not None]
+        if errors:
+            raise errors[0]
+        for done_task in done_tasks:
+            yield done_task.result()
+
+
+def _streamed_entities_mentions(text: str, llm_oie: LLMOpenIE,
+                                output_language: str) -> tuple[list[dict], list[str], list[list[int]]]:
+    # Stream the entities and, as soon as each one is extracted, select its phrase and recognize the mentions of the
+    #  entities extracted so far in the background; once the extraction is over, the phrases are only checked against
+    #  the entities extracted after their recognition started
+    text_entities = []
+    with ThreadPoolExecutor(max_workers=MAX_EARLY_ENTITIES) as executor:
+        early_futures = []
+        for e_dict in llm_oie.iter_entity_extraction(text, output_language):
+            text_entities.append(e_dict)
+            early_futures.append(executor.submit(
+                contextvars.copy_context().run, _early_mentions, text, len(text_entities) - 1, list(text_entities),
+                llm_oie))
+        _log_entities(text_entities)
+
+        late_futures = [
+            executor.submit(
+                contextvars.copy_context().run, _complete_mentions, early_future.result(), text_entities, llm_oie)
+            for early_future in early_futures
+        ]
+        e_sentences, sentences_mentioned_entities_ids = [], []
+        for late_future in late_futures:
+            e_sentence, sentence_mentioned_entities_ids = late_future.result()
+            e_sentences.append(e_sentence)
+            sentences_mentioned_entities_ids.append(sentence_mentioned_entities_ids)
+
+    return text_entities, e_sentences, sentences_mentioned_entities_ids
+
+
+async def _async_streamed_entities_mentions(text: str, llm_oie: LLMOpenIE, output_language: str,
+                                            semaphore: asyncio.Semaphore) -> tuple[list[dict], list[asyncio.Task]]:
+    text_entities = []
+    early_tasks = []
+
+    async def early_mentions(e_i: int, known_entities: list[dict]) -> tuple[str, list[int], int]:
+        async with semaphore:
+            return await _async_early_mentions(text, e_i, known_entities, llm_oie)
+
+    try:
+        async for e_dict in llm_oie.async_iter_entity_extraction(text, output_language):
+            text_entities.append(e_dict)
+            early_tasks.append(asyncio.create_task(early_mentions(len(text_entities) - 1, list(text_entities))))
+    except BaseException:
+        await _cancel_tasks(early_tasks)
+        raise
+    _log_entities(text_entities)
+
+    return text_entities, early_tasks
+
+
+def _early_mentions(text: str, e_i: int, known_entities: list[dict], llm_oie: LLMOpenIE) -> tuple[str, list[int], int]:
+    # 1) Phrase Selection and 2) Mention Recognition against the entities known so far (including the actual one).
+    #  Only the first entity is known for the first one: its mentions are all recognized later with a single request.
+    e_sentence = _select_phrase(text, e_i, known_entities, llm_oie)
+    if len(known_entities) == 1:
+        return e_sentence, [], 0
+    return e_sentence, llm_oie.mention_recognition(e_sentence, known_entities), len(known_entities)
+
+
+async def _async_early_mentions(text: str, e_i: int, known_entities: list[dict],
+                                llm_oie: LLMOpenIE) -> tuple[str, list[int], int]:
+    e_sentence = await _async_select_phrase(text, e_i, known_entities, llm_oie)
+    if len(known_entities) == 1:
+        return e_sentence, [], 0
+    return e_sentence, await llm_oie.async_mention_recognition(e_sentence, known_entities), len(known_entities)
+
+
+def _complete_mentions(early_mentions: tuple[str, list[int], int], text_entities: list[dict],
+                       llm_oie: LLMOpenIE) -> tuple[str, list[int]]:
+    # 2) Mention Recognition against the entities extracted after the early one, if any, shifting their IDs
+    e_sentence, sentence_mentioned_entities_ids, n_known_entities = early_mentions
+    if n_known_entities < len(text_entities):
+        late_mentioned_entities_ids = llm_oie.mention_recognition(e_sentence, text_entities[n_known_entities:])
+        sentence_mentioned_entities_ids = sentence_mentioned_entities_ids + [
+            n_known_entities + i for i in late_mentioned_entities_ids]
+    return e_sentence, sentence_mentioned_entities_ids
+
+
+async def _async_complete_mentions(early_mentions: tuple[str, list[int], int], text_entities: list[dict],
+                                   llm_oie: LLMOpenIE, semaphore: asyncio.Semaphore) -> tuple[str, list[int]]:
+    e_sentence, sentence_mentioned_entities_ids, n_known_entities = early_mentions
+    if n_known_entities < len(text_entities):
+        async with semaphore:
+            late_mentioned_entities_ids = await llm_oie.async_mention_recognition(
+                e_sentence, text_entities[n_known_entities:])
+        sentence_mentioned_entities_ids = sentence_mentioned_entities_ids + [
+            n_known_entities + i for i in late_mentioned_entities_ids]
+    return e_sentence, sentence_mentioned_entities_ids
+
+
+def _select_phrase(text: str, e_i: int, text_entities: list[dict], llm_oie: LLMOpenIE) -> str:
+    e_sentence = llm_oie.phrase_selection(text, e_i, text_entities)
+    LOGGER.debug(f'Searching for mentions of other entities in "{text_entities[e_i]["label"]}" sentence:'
+                 f' "{e_sentence}".')
+    return e_sentence
+
+
+async def _async_select_phrase(text: str, e_i: int, text_entities: list[dict], llm_oie: LLMOpenIE) -> str:
+    e_sentence = await llm_oie.async_phrase_selection(text, e_i, text_entities)
+    LOGGER.debug(f'Searching for mentions of other entities in "{text_entities[e_i]["label"]}" sentence:'
+                 f' "{e_sentence}".')
+    return e_sentence
+
+
+def _sentence_triplets(e_sentence: str, sentence_mentioned_entities_ids: list[int], text_entities: list[dict],
+                       llm_oie: LLMOpenIE, output_language: str, fuse_relations: bool) -> list[dict]:
+    if not _has_enough_mentions(sentence_mentioned_entities_ids, text_entities):
+        return []
+
+    if fuse_relations:
+        # 3) and 4) with a single request
+        sentence_relations = llm_oie.fused_relation_extraction(
+            e_sentence, sentence_mentioned_entities_ids, text_entities, output_language)
+        return sentence_relations if _has_relations(sentence_relations) else []
+
+    # 3) Relation Extraction: find the relations between the entities mentioned in the artificial sentence
+    sentence_relations = llm_oie.relation_extraction(
+        e_sentence, sentence_mentioned_entities_ids, text_entities, output_language)
+    if not _has_relations(sentence_relations):
+        return []
+
+    # 4) Predicate Description: get a better description of the predicates used in the extracted relations and add
+    #  it directly in the relations dictionary
+    llm_oie.predicate_description(e_sentence, sentence_relations, output_language)
+
+    return sentence_relations
+
+
+async def _async_sentence_triplets(e_sentence: str, sentence_mentioned_entities_ids: list[int],
+                                   text_entities: list[dict], llm_oie: LLMOpenIE, output_language: str,
+                                   fuse_relations: bool) -> list[dict]:
+    if not _has_enough_mentions(sentence_mentioned_entities_ids, text_entities):
+        return []
+
+    if fuse_relations:
+        # 3) and 4) with a single request
+        sentence_relations = await llm_oie.async_fused_relation_extraction(
+            e_sentence, sentence_mentioned_entities_ids, text_entities, output_language)
+        return sentence_relations if _has_relations(sentence_relations) else []
+
+    # 3) Relation Extraction
+    sentence_relations = await llm_oie.async_relation_extraction(
+        e_sentence, sentence_mentioned_entities_ids, text_entities, output_language)
+    if not _has_relations(sentence_relations):
+        return []
+
+    # 4) Predicate Description
+    await llm_oie.async_predicate_description(e_sentence, sentence_relations, output_language)
+
+    return sentence_relations
+
+
+async def _cancel_tasks(tasks: list[asyncio.Task]):
+    # Cancel the tasks and wait for them to be over, so that none is left pending (nor any of their errors unretrieved)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def _normalize_language(output_language: str) -> str:
+    return output_language[0].upper() + output_language[1:].lower()
+
+
+def _log_entities(text_entities: list[dict]):
+    LOGGER.info(f'Found {len(text_entities)} entities in text.')
+    for e_dict in text_entities:
+        LOGGER.debug(f'{e_dict["label"]} ({e_dict["types"]})\n\t{e_dict["description"]}')
+
+
+def _has_enough_mentions(sentence_mentioned_entities_ids: list[int], text_entities: list[dict]) -> bool:
+    mentions_str = ', '.join([f'"{text_entities[i]["label"]}"' for i in sentence_mentioned_entities_ids])
+    if len(sentence_mentioned_entities_ids) < 2:
+        LOGGER.debug(f'Not enough mentions to find relations: you need at least 2 entities to search for triplets.'
+                     f' Skipping!')
+        return False
+    LOGGER.debug(f'Found mentions of {mentions_str}.')
+    return True
+
+
+def _has_relations(sentence_relations: list[dict]) -> bool:
+    triplets_str = '\n'.join([
+        f'{t_dict["subj_label"]} | {t_dict["pred_label"]} | {t_dict["obj_label"]}' for t_dict in sentence_relations
+    ])
+    if len(sentence_relations) == 0:
+        LOGGER.debug(f'No triplets found. Skipping!')
+        return False
+    LOGGER.debug(f'Found triplets:\n{triplets_str}')
+    return True
@@ -0,0 +1,122 @@
+from __future__ import annotations
+
+from pathlib import Path
+import sqlite3
+import threading
+
+from llm_open_ie.matching import normalize_label
+
+REUSE_POLICIES = ['record', 'exact', 'normalized']
+
+# Leading auxiliary verbs that do not change the relation expressed by a predicate (e.g. "is located in")
+AUXILIARIES = frozenset(['is', 'are', 'was', 'were', 'be', 'been', 'being'])
+
+
+# Persistent registry of the predicates described by the LLM in any document, with their canonical label (the first
+#  one described), the labels seen as variants of it and its description, separately for each output language.
+#  The descriptions are asked to be general and reusable, so the predicates already described can be given their
+#  description locally, and only the unseen ones need to be sent to the LLM. Depending on the reuse policy:
+#   - `record` only adds the new descriptions to the registry, without reusing them (e.g. to build a registry);
+#   - `exact` reuses the description of the predicates whose label was already seen, ignoring the letter case;
+#   - `normalized` also reuses the description for the variants of a known label, such as "is located in" for
+#     "located in", or labels only differing by punctuation.
+class PredicateRegistry:
+    __path: Path
+    __reuse_policy: str
+    __hits: int
+    __misses: int
+    __skipped_requests: int
+    __connection: sqlite3.Connection
+    __lock: threading.Lock
+
+    def __init__(self, path: str | Path, reuse_policy: str = 'normalized'):
+        if reuse_policy not in REUSE_POLICIES:
+            options_str = ', '.join([f'`{v}`' for v in REUSE_POLICIES])
+            raise ValueError(f'`{reuse_policy}` is not a valid option: choose one between {options_str}')
+
+        self.__path = Path(path)
+        self.__reuse_policy = reuse_policy
+        self.__hits = 0
+        self.__misses = 0
+        self.__skipped_requests = 0
+        self.__lock = threading.Lock()
+
+        self.__path.parent.mkdir(parents=True, exist_ok=True)
+        self.__connection = sqlite3.connect(self.__path, timeout=30, check_same_thread=False)
+        self.__connection.execute('PRAGMA journal_mode=WAL')
+        self.__connection.execute(
+            'CREATE TABLE IF NOT EXISTS predicates ('
+            ' language TEXT NOT NULL, normalized_label TEXT NOT NULL, label TEXT NOT NULL, description TEXT NOT NULL,'
+            ' PRIMARY KEY (language, normalized_label))')
+        self.__connection.execute(
+            'CREATE TABLE IF NOT EXISTS variants ('
+            ' language TEXT NOT NULL, label TEXT NOT NULL, normalized_label TEXT NOT NULL,'
+            ' PRIMARY KEY (language, label))')
+        self.__connection.commit()
+
+    @property
+    def reuse_policy(self) -> str:
+        return self.__reuse_policy
+
+    def __len__(self) -> int:
+        with self.__lock:
+            return self.__connection.execute('SELECT COUNT(*) FROM predicates').fetchone()[0]
+
+    def stats(self) -> dict:
+        n_lookups = self.__hits + self.__misses
+        return {
+            'predicates': len(self),
+            'hits': self.__hits,
+            'misses': self.__misses,
+            'hit_ratio': self.__hits / n_lookups if n_lookups else 0.0,
+            'skipped_requests': self.__skipped_requests
+        }
+
+    def get(self, label: str, language: str) -> str | None:
+        # Description of a known predicate, according to the reuse policy
+        if self.__reuse_policy == 'record':
+            return None
+        with self.__lock:
+            if self.__reuse_policy == 'exact':
+                row = self.__connection.execute(
+                    'SELECT p.description FROM variants v JOIN predicates p'
+                    ' ON p.language = v.language AND p.normalized_label = v.normalized_label'
+                    ' WHERE v.language = ? AND v.label = ?', (language, label.casefold().strip())).fetchone()
+            else:
+                row = self.__connection.execute(
+                    'SELECT description FROM predicates WHERE language = ? AND normalized_label = ?',
+                    (language, normalize_predicate(label))).fetchone()
+            if row is None:
+                self.__misses += 1
+                return None
+            self.__hits += 1
+            return row[0]
+
+    def add(self, label: str, description: str, language: str):
+        # The first description of a predicate is kept: later ones only add their label as a variant
+        normalized_label = normalize_predicate(label)
+        with self.__lock:
+            self.__connection.execute(
+                'INSERT OR IGNORE INTO predicates (language, normalized_label, label, description) VALUES (?, ?, ?, ?)',
+                (language, normalized_label, label.strip(), description))
+            self.__connection.execute(
+                'INSERT OR IGNORE INTO variants (language, label, normalized_label) VALUES (?, ?, ?)',
+                (language, label.casefold().strip(), normalized_label))
+            self.__connection.commit()
+
+    def add_skipped_request(self):
+        with self.__lock:
+            self.__skipped_requests += 1
+
+    def close(self):
+        with self.__lock:
+            self.__connection.close()
+
+
+def normalize_predicate(label: str) -> str:
+    # Lower case words without punctuation nor leading auxiliary verbs (unless the label is made only of them)
+    words = normalize_label(label).split()
+    n_auxiliaries = 0
+    while n_auxiliaries < len(words) - 1 and words[n_auxiliaries] in AUXILIARIES:
+        n_auxiliaries += 1
+    return ' '.join(words[n_auxiliaries:])
@@ -0,0 +1,175 @@
+from __future__ import annotations
+
+from concurrent.futures import Future, ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from socketserver import StreamRequestHandler, ThreadingUnixStreamServer
+from typing import Callable, IO, Iterable
+import json
+import threading
+
+from llm_open_ie.llm import LLMOpenIE
+from llm_open_ie.logger import LOGGER
+from llm_open_ie.pipeline import oie_pipeline
+
+
+# Long-lived worker running the pipeline on the documents it receives, with the same LLM instance (and so the same
+#  clients, encoder, caches and rate limiter) for all of them. Up to `max_concurrency` documents are processed at the
+#  same time, whichever way they are received:
+#   - as JSONL lines on a stream, such as the standard input (`serve_jsonl`);
+#   - as JSONL lines on the connections of a Unix socket (`serve_unix`);
+#   - as JSON bodies of `POST /extract` requests to a local HTTP server (`serve_http`).
+# Each request is a document with a `text`, an optional `id` (returned as it is) and an optional `language` of the
+#  output, either as it is or as the `doc` of a dataset record. The response is a JSON object with the `id` and either
+#  the `entities` and `triples` of the document or the `error` it failed with. JSONL responses are written as soon as
+#  they are ready, which may not be the order of the requests.
+class PipelineServer:
+    __llm_oie: LLMOpenIE
+    __output_language: str
+    __pipeline_kwargs: dict
+    __executor: ThreadPoolExecutor
+    __slots: threading.BoundedSemaphore
+
+    def __init__(self, llm_oie: LLMOpenIE, max_concurrency: int = 4, output_language: str = 'English',
+                 **pipeline_kwargs):
+        if max_concurrency < 1:
+            raise ValueError(f'`max_concurrency` must be a positive integer, got {max_concurrency}.')
+        self.__llm_oie = llm_oie
+        self.__output_language = output_language
+        self.__pipeline_kwargs = pipeline_kwargs
+        self.__executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix='llm-open-ie-server')
+        # Requests read but not yet completed, so that a long input is not read all at once
+        self.__slots = threading.BoundedSemaphore(max_concurrency * 2)
+
+    def __enter__(self) -> PipelineServer:
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.__executor.shutdown(wait=True)
+
+    def process(self, request: dict) -> dict:
+        # Run the pipeline on the document of a request, in the calling thread
+        doc = request.get('doc', request) if isinstance(request, dict) else dict()
+        doc_id = doc.get('id')
+        try:
+            if not isinstance(doc.get('text'), str):
+                raise ValueError('The request has no `text` field.')
+            entities, triplets = oie_pipeline(
+                doc['text'], self.__llm_oie, doc.get('language', self.__output_language), **self.__pipeline_kwargs)
+        except Exception as e:
+            LOGGER.error(f'Request "{doc_id}" failed with `{type(e).__name__}`: {e}')
+            return {'id': doc_id, 'error': f'{type(e).__name__}: {e}'}
+        return {'id': doc_id, 'entities': entities, 'triples': triplets}
+
+    def submit(self, request: dict) -> Future:
+        return self.__executor.submit(self.process, request)
+
+    def serve_jsonl(self, input_file: IO[str], output_file: IO[str]):
+        # Serve the requests read from `input_file` until its end, writing the responses to `output_file`
+        output_lock = threading.Lock()
+
+        def write_line(line: str):
+            with output_lock:
+                output_file.write(line + '\n')
+                output_file.flush()
+
+        self.serve_lines(input_file, write_line)
+
+    def serve_unix(self, socket_path: str | Path):
+        # Serve the JSONL requests of every connection to the Unix socket, until interrupted
+        server = self
+
+        class Handler(StreamRequestHandler):
+            def handle(self):
+                output_lock = threading.Lock()
+
+                def write_line(line: str):
+                    with output_lock:
+                        self.wfile.write((line + '\n').encode('utf-8'))
+                        self.wfile.flush()
+
+                server.serve_lines((line.decode('utf-8') for line in self.rfile), write_line)
+
+        socket_path = Path(socket_path)
+        socket_path.unlink(missing_ok=True)
+        with ThreadingUnixStreamServer(str(socket_path), Handler) as unix_server:
+            LOGGER.info(f'Serving the pipeline on the Unix socket "{socket_path}".')
+            try:
+                unix_server.serve_forever()
+            finally:
+                socket_path.unlink(missing_ok=True)
+
+    def serve_http(self, host: str = '127.0.0.1', port: int = 8000):
+        # Serve `POST /extract` requests (and `GET /health` checks) until interrupted
+        with self.make_http_server(host, port) as http_server:
+            LOGGER.info(f'Serving the pipeline on http://{host}:{http_server.server_address[1]}.')
+            http_server.serve_forever()
+
+    def make_http_server(self, host: str = '127.0.0.1', port: int = 8000) -> ThreadingHTTPServer:
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path != '/health':
+                    self.__send_json(404, {'error': f'Unknown path: {self.path}'})
+                    return
+                self.__send_json(200, {'status': 'ok'})
+
+            def do_POST(self):
+                if self.path != '/extract':
+                    self.__send_json(404, {'error': f'Unknown path: {self.path}'})
+                    return
+                try:
+                    request = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                except ValueError as e:
+                    self.__send_json(400, {'error': f'Invalid JSON request: {e}'})
+                    return
+                response = server.submit(request).result()
+                self.__send_json(500 if 'error' in response else 200, response)
+
+            def log_message(self, format: str, *args):
+                LOGGER.debug(f'{self.address_string()} - {format % args}')
+
+            def __send_json(self, status: int, body: dict):
+                body_bytes = json.dumps(body, ensure_ascii=False).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body_bytes)))
+                self.end_headers()
+                self.wfile.write(body_bytes)
+
+        return ThreadingHTTPServer((host, port), Handler)
+
+    def serve_lines(self, lines: Iterable[str], write_line: Callable[[str], None]):
+        # Requests are read while the previous ones are processed, and the responses written as soon as they are ready;
+        #  it returns once every request has its response
+        n_pending = 0
+        pending_condition = threading.Condition()
+
+        def on_done(future: Future):
+            nonlocal n_pending
+            try:
+                write_line(json.dumps(future.result(), ensure_ascii=False))
+            finally:
+                self.__slots.release()
+                with pending_condition:
+                    n_pending -= 1
+                    pending_condition.notify_all()
+
+        for line in lines:
+            if not line.strip():
+                continue
+            try:
+                request = json.loads(line)
+            except ValueError as e:
+                write_line(json.dumps({'id': None, 'error': f'Invalid JSON request: {e}'}))
+                continue
+            self.__slots.acquire()
+            with pending_condition:
+                n_pending += 1
+            self.submit(request).add_done_callback(on_done)
+        with pending_condition:
+            pending_condition.wait_for(lambda: n_pending == 0)
@@ -0,0 +1,27 @@
+from __future__ import annotations
+
+import pytest
+
+from llm_open_ie.llm import gpt
+from llm_open_ie.llm.replay import Recording
+from scripted_llm import TEXTS, record_pipeline
+
+
+class _WhitespaceEncoder:
+    @staticmethod
+    def encode(text: str) -> list[str]:
+        return text.split()
+
+
+@pytest.fixture(autouse=True)
+def offline_encoder(monkeypatch):
+    # The encoding of tiktoken is downloaded on its first use: count the words instead, so the tests run offline
+    monkeypatch.setattr(gpt, '_get_encoder', _WhitespaceEncoder)
+
+
+@pytest.fixture
+def recording(tmp_path) -> Recording:
+    # Answers of the scripted LLM to the pipeline run with the default settings on the test texts
+    recording = Recording(tmp_path / 'recording.jsonl')
+    record_pipeline(recording, TEXTS)
+    return recording
@@ -0,0 +1,156 @@
+from __future__ import annotations
+
+from contextlib import contextmanager
+from types import SimpleNamespace
+from typing import AsyncIterator, Callable, Iterator
+import asyncio
+import re
+import threading
+
+from llm_open_ie import oie_pipeline
+from llm_open_ie.llm.gpt import GPTOpenIE
+from llm_open_ie.llm.replay import AsyncRecordingClient, Recording, RecordingClient, ReplayClient, make_replay_server
+
+# Entities known to the scripted LLM: the ones found in a text are extracted from it
+ENTITIES = [
+    ('Cagliari', 'capital city of Sardinia', ['city']),
+    ('Sardinia', 'italian island', ['island', 'region']),
+    ('Castello', 'historic quarter of Cagliari', ['quarter']),
+    ('Italy', 'country in Europe', ['country'])
+]
+TEXTS = [
+    'Cagliari is the capital of Sardinia, an italian island. Castello is a quarter of Cagliari, Italy.',
+    'Sardinia is an island of Italy. Cagliari is there.',
+    'Nothing here.'
+]
+
+
+# Deterministic answers to the prompts of each stage, in the formats the stages expect
+def scripted_answer(system: str, user: str) -> str:
+    if 'We call these concepts' in system:
+        return '\n'.join([f'- {label}|||{description}|||[{", ".join(types)}]'
+                          for label, description, types in ENTITIES if label in user])
+    if 'some numbered' in system:
+        entities = re.findall(r'^(\d+)\) (.+)$', user.split('Sentences:')[0], re.M)
+        answer_lines = []
+        for sentence_id, sentence in re.findall(r'Sentence (\d+):\n```\n(.*?)\n```', user, re.S):
+            answer_lines.append(f'Sentence {sentence_id}:')
+            answer_lines += [f'{i}) {label}|||{"yes" if label in sentence else "no"}' for i, label in entities]
+        return '\n'.join(answer_lines)
+    if 'identify mentions' in system:
+        entities_str, sentence = user.split('Sentence:')[:2]
+        return '\n'.join([f'{i}) {label}|||{"yes" if label in sentence else "no"}'
+                          for i, label in re.findall(r'^(\d+)\) (.+)$', entities_str, re.M)])
+    if 'find relations' in system or 'and describe them' in system:
+        entities = re.findall(r'^(\d+)\) (.+)$', user.split('Sentence:')[0], re.M)
+        description = '|||a relation related to {}' if 'and describe them' in system else ''
+        return '\n'.join([f'- {a} ({i})|||related to {b}|||{b} ({j})' + description.format(b)
+                          for (i, a), (j, b) in zip(entities, entities[1:])])
+    if 'extended description' in system:
+        predicates = sorted(set(re.findall(r'\|\|\|(.+?)\|\|\|', user)))
+        return '\n'.join([f'- {predicate}|||a relation {predicate}' for predicate in predicates])
+    return ''
+
+
+# Stand-in of `client.chat.completions` of the OpenAI client, answering with `answer` (from the system and the user
+#  prompts), one line per chunk when streaming, and keeping the parameters of every request in `calls`
+class ScriptedClient:
+    __answer: Callable[[str, str], str]
+    calls: list[dict]
+    chat: SimpleNamespace
+
+    def __init__(self, answer: Callable[[str, str], str] = scripted_answer):
+        self.__answer = answer
+        self.calls = []
+        self.chat = SimpleNamespace(completions=self)
+
+    def create(self, *, model: str, messages: list[dict], stream: bool = False, **params):
+        self.calls.append({'model': model, 'messages': messages, **params})
+        response = _response(model, messages, self.__answer)
+        return _Stream(response) if stream else response
+
+
+# Same as `ScriptedClient`, answering each request after `latency` seconds
+class AsyncScriptedClient:
+    __answer: Callable[[str, str], str]
+    __latency: float
+    calls: list[dict]
+    chat: SimpleNamespace
+
+    def __init__(self, answer: Callable[[str, str], str] = scripted_answer, latency: float = 0):
+        self.__answer = answer
+        self.__latency = latency
+        self.calls = []
+        self.chat = SimpleNamespace(completions=self)
+
+    async def create(self, *, model: str, messages: list[dict], stream: bool = False, **params):
+        self.calls.append({'model': model, 'messages': messages, **params})
+        await asyncio.sleep(self.__latency)
+        response = _response(model, messages, self.__answer)
+        return _Stream(response) if stream else response
+
+
+def _response(model: str, messages: list[dict], answer_function: Callable[[str, str], str]) -> SimpleNamespace:
+    system = next((m['content'] for m in messages if m['role'] == 'system'), '')
+    answer = answer_function(system, messages[-1]['content'])
+    usage = SimpleNamespace(
+        prompt_tokens=sum([len(m['content'].split()) for m in messages]), completion_tokens=len(answer.split()))
+    usage.total_tokens = usage.prompt_tokens + usage.completion_tokens
+    message = SimpleNamespace(role='assistant', content=answer)
+    return SimpleNamespace(model=model, choices=[SimpleNamespace(message=message, finish_reason='stop')], usage=usage)
+
+
+# Streamed response, usable both by the synchronous and the asynchronous client
+class _Stream:
+    __chunks: list[SimpleNamespace]
+
+    def __init__(self, response: SimpleNamespace):
+        lines = response.choices[0].message.content.split('\n')
+        self.__chunks = [
+            SimpleNamespace(choices=[SimpleNamespace(delta=SimpleNamespace(content=line + '\n'), finish_reason=None)])
+            for line in lines[:-1]
+        ]
+        self.__chunks.append(SimpleNamespace(choices=[SimpleNamespace(
+            delta=SimpleNamespace(content=lines[-1]), finish_reason='stop')], usage=response.usage))
+
+    def __enter__(self) -> _Stream:
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+    def __iter__(self) -> Iterator[SimpleNamespace]:
+        return iter(self.__chunks)
+
+    async def __aenter__(self) -> _Stream:
+        return self
+
+    async def __aexit__(self, *exc_info):
+        pass
+
+    async def __aiter__(self) -> AsyncIterator[SimpleNamespace]:
+        for chunk in self.__chunks:
+            yield chunk
+
+
+# Run the pipeline on `texts` with the scripted LLM, adding all its answers to `recording`
+def record_pipeline(recording: Recording, texts: list[str], pipeline_kwargs: dict = None,
+                    answer: Callable[[str, str], str] = scripted_answer, **gpt_kwargs) -> list[tuple]:
+    gpt = GPTOpenIE(client=RecordingClient(ScriptedClient(answer), recording),
+                    async_client=AsyncRecordingClient(AsyncScriptedClient(answer), recording), rate_limit_sleep=0,
+                    **gpt_kwargs)
+    return [oie_pipeline(text, gpt, **(pipeline_kwargs or dict())) for text in texts]
+
+
+@contextmanager
+def serve_replay(replay_client: ReplayClient) -> Iterator[str]:
+    # Replay server on a free port, in a background thread; its base URL is yielded
+    server = make_replay_server(replay_client, port=0)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield f'http://127.0.0.1:{server.server_address[1]}/v1'
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
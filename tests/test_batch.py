@@ -0,0 +1,112 @@
+from __future__ import annotations
+
+import json
+
+import pytest
+
+from llm_open_ie.corpus import iter_records, to_dataset_record
+from llm_open_ie.llm.gpt.batch import STATE_FILE_NAME, BatchScheduler
+from llm_open_ie.llm.replay import Recording, ReplayBatchClient, ReplayClient, ReplayOpenIE
+from scripted_llm import TEXTS, record_pipeline, scripted_answer
+
+
+def _write_documents(path, texts: list[str]):
+    path.write_text(''.join([json.dumps({'id': f'd{i}', 'text': text}) + '\n' for i, text in enumerate(texts)]),
+                    encoding='utf-8')
+
+
+def _expected_records(recording: Recording, texts: list[str], pipeline_kwargs: dict = None,
+                      answer=scripted_answer) -> list[dict]:
+    # Records of the same documents processed one by one with `oie_pipeline`, recording the answers
+    return [
+        to_dataset_record({'id': f'd{i}', 'text': text}, entities, triplets)
+        for i, (text, (entities, triplets)) in enumerate(
+            zip(texts, record_pipeline(recording, texts, pipeline_kwargs, answer=answer)))
+    ]
+
+
+def _rejected_fused_answer(system: str, user: str) -> str:
+    # The described relations of the sentences of Castello are not parsed: they are asked again with two requests
+    if 'and describe them' in system and 'Castello' in user:
+        return 'Sure! Here are the relations.'
+    return scripted_answer(system, user)
+
+
+@pytest.mark.parametrize('fuse_relations, answer', [
+    (False, scripted_answer),
+    (True, scripted_answer),
+    (True, _rejected_fused_answer)
+])
+def test_batch_matches_pipeline(tmp_path, fuse_relations, answer):
+    recording = Recording(tmp_path / 'recording.jsonl')
+    expected = _expected_records(recording, TEXTS, {'fuse_relations': fuse_relations}, answer)
+    documents_path, output_path = tmp_path / 'documents.jsonl', tmp_path / 'results.jsonl'
+    _write_documents(documents_path, TEXTS)
+
+    scheduler = BatchScheduler(ReplayOpenIE(recording), tmp_path / 'work', client=ReplayBatchClient(
+        ReplayClient(recording)), poll_interval=0.01, fuse_relations=fuse_relations)
+    stats = scheduler.run(documents_path, output_path)
+
+    assert list(iter_records(output_path)) == expected
+    assert stats['completed'] == len(TEXTS)
+    assert stats['failed'] == 0
+    assert (stats['requests']['fused_relation_extraction'] > 0) == fuse_relations
+    assert (stats['requests']['relation_extraction'] > 0) == (not fuse_relations or answer is _rejected_fused_answer)
+
+
+def test_batch_resumes_in_flight_batch(tmp_path, monkeypatch):
+    recording = Recording(tmp_path / 'recording.jsonl')
+    expected = _expected_records(recording, TEXTS)
+    documents_path, output_path = tmp_path / 'documents.jsonl', tmp_path / 'results.jsonl'
+    _write_documents(documents_path, TEXTS)
+    client = ReplayBatchClient(ReplayClient(recording))
+    retrieve = client.batches.retrieve
+
+    def interrupted_retrieve(batch_id: str):
+        # The job is killed while polling the batch of the second stage
+        if batch_id == 'batch-1':
+            raise KeyboardInterrupt
+        return retrieve(batch_id)
+
+    monkeypatch.setattr(client.batches, 'retrieve', interrupted_retrieve)
+    with pytest.raises(KeyboardInterrupt):
+        BatchScheduler(ReplayOpenIE(recording), tmp_path / 'work', client=client, poll_interval=0.01).run(
+            documents_path, output_path)
+    state = json.loads((tmp_path / 'work' / STATE_FILE_NAME).read_text(encoding='utf-8'))
+    assert state['stage'] == 1
+    assert state['batch_ids'] == ['batch-1']
+    assert not output_path.exists()
+
+    monkeypatch.undo()
+    stats = BatchScheduler(ReplayOpenIE(recording), tmp_path / 'work', client=client, poll_interval=0.01).run(
+        documents_path, output_path)
+
+    # The batch in flight is collected rather than submitted again
+    assert list(iter_records(output_path)) == expected
+    assert stats['completed'] == len(TEXTS)
+    assert stats['batches'] == 4
+
+    # A job already over is not written again
+    BatchScheduler(ReplayOpenIE(recording), tmp_path / 'work', client=client, poll_interval=0.01).run(
+        documents_path, output_path)
+    assert len(list(iter_records(output_path))) == len(TEXTS)
+
+
+def test_batch_fails_documents_after_max_rounds(tmp_path):
+    # The answers of the last document are not recorded: its requests fail in every batch
+    recording = Recording(tmp_path / 'recording.jsonl')
+    expected = _expected_records(recording, TEXTS[:-1])
+    documents_path, output_path = tmp_path / 'documents.jsonl', tmp_path / 'results.jsonl'
+    _write_documents(documents_path, TEXTS)
+
+    scheduler = BatchScheduler(ReplayOpenIE(recording), tmp_path / 'work', client=ReplayBatchClient(
+        ReplayClient(recording)), poll_interval=0.01, max_rounds=2)
+    stats = scheduler.run(documents_path, output_path)
+
+    assert list(iter_records(output_path)) == expected
+    assert stats['completed'] == len(TEXTS) - 1
+    assert stats['failed'] == 1
+    # Two rounds of the entity extraction, then a round of each of the other stages
+    assert stats['batches'] == 2 + 3
+    state = json.loads((tmp_path / 'work' / STATE_FILE_NAME).read_text(encoding='utf-8'))
+    assert state['documents'][-1]['error'] == '1 requests of the `entity_extraction` stage were not answered.'
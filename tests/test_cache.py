@@ -0,0 +1,37 @@
+from __future__ import annotations
+
+import sqlite3
+
+import pytest
+
+from llm_open_ie.llm.cache import CompletionCache
+
+
+def test_read_only_cache(tmp_path):
+    path = tmp_path / 'completions.sqlite'
+    key = CompletionCache.make_key('model', 'system', 'user', temperature=0)
+    CompletionCache(path).put(key, 'answer')
+
+    cache = CompletionCache(path, mode='read_only')
+    assert cache.get(key) == 'answer'
+    assert cache.get(CompletionCache.make_key('model', 'system', 'other user', temperature=0)) is None
+    cache.put(key, 'other answer')
+    assert cache.get(key) == 'answer'
+    assert cache.stats()['hits'] == 2
+
+
+def test_read_only_cache_needs_existing_cache(tmp_path):
+    with pytest.raises(ValueError, match='does not exist'):
+        CompletionCache(tmp_path / 'missing.sqlite', mode='read_only')
+    assert not (tmp_path / 'missing.sqlite').exists()
+
+    other_path = tmp_path / 'other.sqlite'
+    with sqlite3.connect(other_path) as connection:
+        connection.execute('CREATE TABLE other (key TEXT)')
+    with pytest.raises(ValueError, match='not a completion cache'):
+        CompletionCache(other_path, mode='read_only')
+
+    text_path = tmp_path / 'text.sqlite'
+    text_path.write_text('not a database', encoding='utf-8')
+    with pytest.raises(ValueError, match='not a completion cache'):
+        CompletionCache(text_path, mode='read_only')
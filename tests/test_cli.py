@@ -0,0 +1,139 @@
+from __future__ import annotations
+
+from pathlib import Path
+import io
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+from llm_open_ie.cli import main
+from llm_open_ie.corpus import iter_records
+from llm_open_ie.llm.replay import ReplayClient
+from scripted_llm import TEXTS, serve_replay
+
+
+# Smoke tests of every subcommand, with the LLM answers replayed from a recording of the scripted LLM
+
+@pytest.fixture
+def documents_path(tmp_path) -> Path:
+    documents_path = tmp_path / 'documents.jsonl'
+    documents_path.write_text(
+        ''.join([json.dumps({'id': f'd{i}', 'text': text}) + '\n' for i, text in enumerate(TEXTS)]), encoding='utf-8')
+    return documents_path
+
+
+@pytest.fixture
+def endpoints_path(tmp_path, recording) -> Path:
+    # Endpoints file pointing the real OpenAI clients to a replay server
+    with serve_replay(ReplayClient(recording)) as base_url:
+        endpoints_path = tmp_path / 'endpoints.json'
+        endpoints_path.write_text(
+            json.dumps([{'name': 'replay', 'base_url': base_url, 'api_key': 'replay'}]), encoding='utf-8')
+        yield endpoints_path
+
+
+def test_run(tmp_path, documents_path, endpoints_path):
+    output_path = tmp_path / 'results.jsonl'
+    main(['run', str(documents_path), str(output_path), '--endpoints', str(endpoints_path), '--workers', '2'])
+
+    records = list(iter_records(output_path))
+    assert sorted([record['doc']['id'] for record in records]) == ['d0', 'd1', 'd2']
+    assert any([record['triples']['gpt'] for record in records])
+
+
+def test_run_resumes_from_checkpoint(tmp_path, documents_path, endpoints_path):
+    output_path = tmp_path / 'results.jsonl'
+    main(['run', str(documents_path), str(output_path), '--endpoints', str(endpoints_path)])
+    main(['run', str(documents_path), str(output_path), '--endpoints', str(endpoints_path)])
+
+    assert len(list(iter_records(output_path))) == len(TEXTS)
+
+
+def test_batch(tmp_path, capsys, documents_path, recording):
+    output_path = tmp_path / 'results.jsonl'
+    main(['batch', str(documents_path), str(output_path), '--replay', str(recording.path), '--poll-interval', '0.01'])
+
+    stats = json.loads(capsys.readouterr().out)
+    assert stats['completed'] == len(TEXTS)
+    assert len(list(iter_records(output_path))) == len(TEXTS)
+
+
+def test_benchmark(tmp_path, recording):
+    dataset_path = tmp_path / 'dataset' / 'ST' / 'ST.json'
+    dataset_path.parent.mkdir(parents=True)
+    dataset_path.write_text(json.dumps([
+        {'doc': {'id': i, 'uri': None, 'title': None, 'text': text}} for i, text in enumerate(TEXTS)
+    ]), encoding='utf-8')
+    report_path = tmp_path / 'report.json'
+    main(['benchmark', str(recording.path), '--datasets', 'ST', '--dataset-dir', str(dataset_path.parents[1]),
+          '--output', str(report_path), '--call-deadline', '30'])
+
+    report = json.loads(report_path.read_text(encoding='utf-8'))
+    assert report['datasets']['ST']['documents'] == len(TEXTS)
+    assert report['datasets']['ST']['failed_documents'] == 0
+    assert report['settings']['mode'] == 'replay'
+    assert report['settings']['call_deadline'] == 30
+
+
+def test_kg_and_evaluate(tmp_path, capsys, documents_path, recording):
+    pytest.importorskip('numpy')
+    results_path = tmp_path / 'results.jsonl'
+    main(['batch', str(documents_path), str(results_path), '--replay', str(recording.path), '--poll-interval', '0.01'])
+    capsys.readouterr()
+
+    store_path = tmp_path / 'kg.bin'
+    main(['kg', str(results_path), str(store_path)])
+    kg_stats = json.loads(capsys.readouterr().out)
+    assert kg_stats['documents'] == len(TEXTS)
+    assert kg_stats['triples'] > 0
+
+    # The results are their own gold annotations, in the format of REBEL
+    gold_path = tmp_path / 'gold.json'
+    gold_path.write_text(json.dumps([
+        {
+            'doc': record['doc'],
+            'entities': {'gold': [{'surfaceform': e['label']} for e in record['entities']['gpt']]},
+            'triples': {'gold': [
+                {role: {'surfaceform': t[f'{role} label']} for role in ['subject', 'predicate', 'object']}
+                for t in record['triples']['gpt']
+            ]}
+        }
+        for record in iter_records(results_path)
+    ]), encoding='utf-8')
+    metrics_path = tmp_path / 'metrics.json'
+    main(['evaluate', str(results_path), '--gold', str(gold_path), '--output', str(metrics_path)])
+    metrics = json.loads(metrics_path.read_text(encoding='utf-8'))
+    assert metrics['entities']['gold_match_recall'] == 1.0
+
+
+def test_serve(monkeypatch, capsys, endpoints_path):
+    requests = [{'id': 'd0', 'text': TEXTS[0]}, {'id': 'bad'}]
+    monkeypatch.setattr(sys, 'stdin', io.StringIO(''.join([json.dumps(request) + '\n' for request in requests])))
+    main(['serve', '--endpoints', str(endpoints_path), '--workers', '2'])
+
+    responses = {response['id']: response for response in map(json.loads, capsys.readouterr().out.splitlines())}
+    assert responses['d0']['triples']
+    assert 'error' in responses['bad']
+
+
+def test_replay_server(recording):
+    from openai import OpenAI
+
+    # Run in its own process, as it serves until interrupted
+    env = {**os.environ, 'PYTHONPATH': os.pathsep.join([str(Path(__file__).parents[1] / 'src'), *sys.path])}
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'llm_open_ie.cli', 'replay-server', str(recording.path), '--port', '0'],
+        stdout=subprocess.PIPE, text=True, env=env)
+    try:
+        base_url = process.stdout.readline().split(' on ')[-1].strip()
+        exchange = json.loads(recording.path.read_text(encoding='utf-8').splitlines()[0])
+        messages = [{'role': 'system', 'content': exchange['system']}, {'role': 'user', 'content': exchange['user']}]
+        response = OpenAI(api_key='replay', base_url=base_url, max_retries=0).chat.completions.create(
+            model=exchange['model'], messages=messages, **exchange['params'])
+        assert response.choices[0].message.content == exchange['answer']
+    finally:
+        process.terminate()
+        process.wait()
@@ -0,0 +1,129 @@
+from __future__ import annotations
+
+import asyncio
+import time
+
+from openai import APITimeoutError, InternalServerError
+import pytest
+
+from llm_open_ie.llm.deadlines import retry_budget_scope
+from llm_open_ie.llm.endpoints import Endpoint, EndpointPool
+from llm_open_ie.llm.gpt import DEFAULT_MODEL, GPTOpenIE
+from llm_open_ie.llm.rate_limiter import RateLimiter
+from llm_open_ie.llm.replay import Recording, ReplayClient
+from llm_open_ie.metrics import PipelineMetrics, collect_metrics
+from scripted_llm import serve_replay
+
+# Time limits of the requests and of the calls, against the slow and failing requests of a replay server
+
+SYSTEM = 'Answer the question.'
+USER = 'What is the capital of Sardinia?'
+ANSWER = 'Cagliari'
+MESSAGES = [{'role': 'system', 'content': SYSTEM}, {'role': 'user', 'content': USER}]
+SLOW_LATENCY = 0.6
+
+
+@pytest.fixture
+def recording(tmp_path) -> Recording:
+    recording = Recording(tmp_path / 'recording.jsonl')
+    recording.add(DEFAULT_MODEL, MESSAGES, ANSWER, None, temperature=0, top_p=0)
+    return recording
+
+
+def _replay_gpt(base_url: str, **kwargs) -> GPTOpenIE:
+    # Short backoffs, since the errors are injected on purpose
+    endpoint = Endpoint(api_key='replay', base_url=base_url, name='replay', rate_limiter=RateLimiter(backoff_base=0.05))
+    return GPTOpenIE(endpoints=EndpointPool([endpoint]), **kwargs)
+
+
+def _requests(gpt: GPTOpenIE) -> int:
+    return gpt.endpoints.stats()['replay']['requests']
+
+
+def test_request_timeout_expires(recording):
+    with serve_replay(ReplayClient(recording, slow_rate=1.0, slow_latency=SLOW_LATENCY)) as base_url:
+        gpt = _replay_gpt(base_url, request_timeout=0.1)
+        start = time.monotonic()
+        with retry_budget_scope(0), pytest.raises(APITimeoutError):
+            gpt.chat_completion(USER, SYSTEM)
+        assert time.monotonic() - start < SLOW_LATENCY
+        assert _requests(gpt) == 1
+
+
+def test_request_timeout_leaves_time_for_fast_requests(recording):
+    with serve_replay(ReplayClient(recording, latency=0.05)) as base_url:
+        gpt = _replay_gpt(base_url, request_timeout=0.5)
+        assert gpt.chat_completion(USER, SYSTEM) == ANSWER
+
+
+def test_call_deadline_gives_up(recording):
+    with serve_replay(ReplayClient(recording, slow_rate=1.0, slow_latency=SLOW_LATENCY)) as base_url:
+        gpt = _replay_gpt(base_url, request_timeout=0.1, call_deadline=0.4)
+        start = time.monotonic()
+        with pytest.raises(APITimeoutError):
+            gpt.chat_completion(USER, SYSTEM)
+        elapsed = time.monotonic() - start
+        # The timed out requests are retried until no retry can start before the deadline, and none lasts past it
+        assert _requests(gpt) > 1
+        assert 0.2 <= elapsed < 0.5
+
+
+def test_call_deadline_caps_the_request_timeout(recording):
+    with serve_replay(ReplayClient(recording, slow_rate=1.0, slow_latency=SLOW_LATENCY)) as base_url:
+        gpt = _replay_gpt(base_url, call_deadline=0.2)
+        start = time.monotonic()
+        with pytest.raises(APITimeoutError):
+            gpt.chat_completion(USER, SYSTEM)
+        assert time.monotonic() - start < SLOW_LATENCY
+        assert _requests(gpt) == 1
+
+
+def test_retry_budget_is_exhausted(recording):
+    with serve_replay(ReplayClient(recording, error_rate=0.99, seed=0)) as base_url:
+        gpt = _replay_gpt(base_url)
+        with retry_budget_scope(2) as budget:
+            with pytest.raises(InternalServerError):
+                gpt.chat_completion(USER, SYSTEM)
+            # Spent by the failed call, nothing is left for the next ones of the same document
+            with pytest.raises(InternalServerError):
+                gpt.chat_completion(USER, SYSTEM)
+        assert budget.retries == 2
+        assert _requests(gpt) == 4
+
+
+def _seed_with_slow_requests(slow_requests: list[bool], recording: Recording) -> int:
+    # Seed of a replay client whose consecutive requests are slow as in `slow_requests`
+    for seed in range(1_000):
+        probe = ReplayClient(recording, slow_rate=0.5, slow_latency=SLOW_LATENCY, seed=seed)
+        delays = [probe.replay(DEFAULT_MODEL, MESSAGES, temperature=0, top_p=0)[0] for _ in slow_requests]
+        if [delay > 0 for delay in delays] == slow_requests:
+            return seed
+    raise LookupError(f'No seed found for the slow requests {slow_requests}.')
+
+
+@pytest.mark.parametrize('is_async', [False, True])
+@pytest.mark.parametrize('slow_requests, hedged_requests, hedge_wins', [
+    ([False], 0, 0),
+    ([True, False], 1, 1),
+    ([True, True], 1, 0)
+])
+def test_hedged_request(recording, is_async, slow_requests, hedged_requests, hedge_wins):
+    # The first request is duplicated once it lasts more than `hedge_after`, and the first one answered wins
+    seed = _seed_with_slow_requests(slow_requests, recording)
+    replay_client = ReplayClient(recording, slow_rate=0.5, slow_latency=SLOW_LATENCY, seed=seed)
+    with serve_replay(replay_client) as base_url:
+        gpt = _replay_gpt(base_url, hedge_after=0.2)
+        metrics = PipelineMetrics()
+        start = time.monotonic()
+        with collect_metrics(metrics):
+            if is_async:
+                answer = asyncio.run(gpt.async_chat_completion(USER, SYSTEM))
+            else:
+                answer = gpt.chat_completion(USER, SYSTEM)
+        elapsed = time.monotonic() - start
+
+    assert answer == ANSWER
+    totals = metrics.as_dict()['totals']
+    assert totals['hedged_requests'] == hedged_requests
+    assert totals['hedge_wins'] == hedge_wins
+    assert (elapsed >= SLOW_LATENCY) == all(slow_requests)
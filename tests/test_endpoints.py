@@ -0,0 +1,48 @@
+from __future__ import annotations
+
+import asyncio
+
+from openai import APIConnectionError
+import httpx
+
+from llm_open_ie.llm.endpoints import Endpoint, EndpointPool
+from llm_open_ie.llm.gpt import GPTOpenIE
+from scripted_llm import AsyncScriptedClient, ScriptedClient, scripted_answer
+
+
+def _failing_answer(system: str, user: str) -> str:
+    raise APIConnectionError(request=httpx.Request('POST', 'https://failing.invalid/v1/chat/completions'))
+
+
+def _endpoint(name: str, answer=scripted_answer) -> Endpoint:
+    return Endpoint(name=name, client=ScriptedClient(answer), async_client=AsyncScriptedClient(answer))
+
+
+def test_select_leaves_out_excluded_endpoint():
+    first, second = _endpoint('first'), _endpoint('second')
+    pool = EndpointPool([first, second])
+    # A request in flight makes the second endpoint the busiest one
+    assert pool.acquire(exclude=first)[0] is second
+    assert pool.select() is first
+    assert pool.select(exclude=first) is second
+
+    # Unless it is the only healthy one
+    pool.report_failure(second, disable=True)
+    assert pool.select(exclude=first) is first
+
+
+def test_retry_avoids_failed_endpoint():
+    failing, working = _endpoint('failing', _failing_answer), _endpoint('working')
+    pool = EndpointPool([failing, working])
+    # The failing endpoint is the least busy one, as the working one has a request in flight
+    pool.acquire(exclude=failing)
+    gpt = GPTOpenIE(endpoints=pool)
+
+    system = 'We call these concepts'
+    for user in ['Cagliari is a city.', 'Sardinia is an island.']:
+        assert gpt.chat_completion(user, system) == scripted_answer(system, user)
+    user = 'Italy is a country.'
+    assert asyncio.run(gpt.async_chat_completion(user, system)) == scripted_answer(system, user)
+    # Each call failed once, and was sent again right away to the other endpoint
+    assert pool.stats()['failing']['failures'] == 3
+    assert pool.stats()['failing']['requests'] == 3
@@ -0,0 +1,19 @@
+from __future__ import annotations
+
+import pytest
+
+from llm_open_ie.llm.gpt import GPTOpenIE
+from llm_open_ie.llm.rate_limiter import RateLimiter
+
+
+def test_positional_arguments(monkeypatch):
+    # As before the rate limiters: the API key input, then the sleep between the requests
+    monkeypatch.setenv('OPENAI_API_KEY', 'test')
+    gpt = GPTOpenIE('environ', 10.0)
+    assert gpt.rate_limiter.estimate_wait() == 0
+
+    # The other settings are keyword-only
+    with pytest.raises(TypeError):
+        GPTOpenIE('environ', 10.0, RateLimiter())
+    with pytest.raises(ValueError):
+        GPTOpenIE('environ', 10.0, rate_limiter=RateLimiter())
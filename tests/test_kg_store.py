@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+from llm_open_ie.kg_store import KGStore
+
+ENTITIES = [
+    {'label': 'Cagliari', 'description': 'capital city of Sardinia', 'types': ['city']},
+    {'label': 'Sardinia island', 'description': 'italian island', 'types': ['island']},
+    {'label': 'Castello', 'description': 'historic quarter of Cagliari', 'types': ['quarter']}
+]
+TRIPLETS = [
+    {'subj_label': 'Cagliari', 'subj_id': 0, 'pred_label': 'capital of', 'pred_description': 'capital of a region',
+     'obj_label': 'Sardinian island', 'obj_id': 1},
+    {'subj_label': 'Castello', 'subj_id': 2, 'pred_label': 'quarter of', 'obj_label': 'Cagliari', 'obj_id': 0}
+]
+
+
+def test_add_document_uses_triplet_ids():
+    # The object label was accepted by the relation parser, though it is not the one of the entity
+    store = KGStore()
+    entity_ids = store.add_document(ENTITIES, TRIPLETS)
+
+    assert store.num_entities == len(ENTITIES)
+    assert [(t['subj_id'], t['obj_id']) for t in store.triples()] == [(entity_ids[0], entity_ids[1]),
+                                                                      (entity_ids[2], entity_ids[0])]
+
+
+def test_add_document_tells_apart_entities_with_the_same_label():
+    # Two entities of the document with the same normalized label and disjoint types
+    entities = [{'label': 'Mercury', 'description': 'planet', 'types': ['planet']},
+                {'label': 'mercury', 'description': 'chemical element', 'types': ['element']},
+                {'label': 'Sun', 'description': 'star', 'types': ['star']}]
+    triplets = [{'subj_label': 'Mercury', 'subj_id': 0, 'pred_label': 'orbits', 'obj_label': 'Sun', 'obj_id': 2},
+                {'subj_label': 'mercury', 'subj_id': 1, 'pred_label': 'is a', 'obj_label': 'Sun', 'obj_id': 2}]
+    store = KGStore()
+    entity_ids = store.add_document(entities, triplets)
+
+    assert entity_ids[0] != entity_ids[1]
+    assert [t['subj_id'] for t in store.triples()] == entity_ids[:2]
+
+    # Without the ids, the entity with the very same label is chosen
+    store = KGStore()
+    entity_ids = store.add_record({
+        'entities': {'gpt': entities},
+        'triples': {'gpt': [{'subject label': t['subj_label'], 'predicate label': t['pred_label'],
+                             'object label': t['obj_label']} for t in triplets]}
+    })
+    assert [t['subj_id'] for t in store.triples()] == entity_ids[:2]
+
+
+def _snapshot(store: KGStore) -> tuple:
+    return (store.documents, [store.entity(e_id) for e_id in range(store.num_entities)], list(store.triples()))
+
+
+def test_save_and_load(tmp_path):
+    store = KGStore()
+    store.add_document(ENTITIES, TRIPLETS)
+    store.add_document(ENTITIES[:1] + ENTITIES[2:], [{**TRIPLETS[1], 'subj_id': 1}])
+    store.save(tmp_path / 'kg.bin')
+    loaded = KGStore.load(tmp_path / 'kg.bin')
+
+    assert _snapshot(loaded) == _snapshot(store)
+    assert loaded.find_entities('cagliari') == [0]
+    assert loaded.find_entities('Rome') == []
+    assert [t['count'] for t in loaded.triples(subj='Castello')] == [2]
+    assert [t['obj_label'] for t in loaded.triples(pred='Capital of')] == ['Sardinia island']
+    assert [t['subj_label'] for t in loaded.triples(obj=0)] == ['Castello']
+    assert list(loaded.triples(subj='Cagliari', obj='Castello')) == []
+    assert list(loaded.triples(pred='part of')) == []
+
+    # New documents are added to a copy of the mapped store, which is saved again over its own file
+    store.add_document(ENTITIES[1:], [{'subj_label': 'Castello', 'subj_id': 1, 'pred_label': 'on',
+                                       'obj_label': 'Sardinia island', 'obj_id': 0}])
+    loaded.add_document(ENTITIES[1:], [{'subj_label': 'Castello', 'subj_id': 1, 'pred_label': 'on',
+                                        'obj_label': 'Sardinia island', 'obj_id': 0}])
+    assert _snapshot(loaded) == _snapshot(store)
+    loaded.save(tmp_path / 'kg.bin')
+    reloaded = KGStore.load(tmp_path / 'kg.bin')
+    assert _snapshot(reloaded) == _snapshot(store)
+    assert [t['pred_label'] for t in reloaded.triples(subj='castello')] == ['quarter of', 'on']
+
+
+def test_save_and_load_empty_store(tmp_path):
+    KGStore().save(tmp_path / 'kg.bin')
+    loaded = KGStore.load(tmp_path / 'kg.bin')
+
+    assert _snapshot(loaded) == (0, [], [])
+    assert loaded.find_entities('Cagliari') == []
+    assert list(loaded.triples(subj='Cagliari', pred='capital of')) == []
+
+    loaded.add_document(ENTITIES, TRIPLETS)
+    assert loaded.num_triples == len(TRIPLETS)
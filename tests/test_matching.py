@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+from difflib import SequenceMatcher, get_close_matches
+import random
+
+import pytest
+
+from llm_open_ie.matching import CloseMatcher, ratio_at_least
+
+# The fast matchers must accept and reject exactly what `difflib` does
+
+THRESHOLDS = [0.0, 0.5, 0.6, 0.8, 0.9, 1.0]
+
+
+def _random_strings(seed: int, n: int) -> list[str]:
+    # Short strings of few characters, with many shared characters, duplicates and empty strings
+    rng = random.Random(seed)
+    return [''.join(rng.choices('abcde ', k=rng.randint(0, 8))) for _ in range(n)]
+
+
+@pytest.mark.parametrize('a, b', [
+    ('', ''),
+    ('', 'a'),
+    ('abc', ''),
+    ('Cagliari', 'Cagliari'),
+    ('cagliari', 'Cagliari'),
+    ('sardinia island', 'sardinian island'),
+    ('ab', 'ba'),
+    ('abcd', 'dcba')
+])
+@pytest.mark.parametrize('threshold', THRESHOLDS)
+def test_ratio_at_least(a, b, threshold):
+    assert ratio_at_least(a, b, threshold) == (SequenceMatcher(None, a, b).ratio() >= threshold)
+
+
+def test_ratio_at_least_random():
+    strings = _random_strings(0, 60)
+    for a in strings:
+        for b in strings:
+            for threshold in THRESHOLDS:
+                assert ratio_at_least(a, b, threshold) == (SequenceMatcher(None, a, b).ratio() >= threshold), \
+                    (a, b, threshold)
+
+
+@pytest.mark.parametrize('word, possibilities', [
+    ('', ['', 'a', '']),
+    ('a', ['', 'a', 'a', 'b']),
+    # Ties on the score are broken by the possibility, as in `difflib`
+    ('ab', ['ac', 'bb', 'ad', 'ab ', 'ba']),
+    ('located in', ['located in', 'is located in', 'located in', 'location of', 'part of']),
+    ('word', [])
+])
+@pytest.mark.parametrize('n', [1, 2, 3, 10])
+@pytest.mark.parametrize('cutoff', THRESHOLDS)
+def test_get_close_matches(word, possibilities, n, cutoff):
+    assert CloseMatcher(possibilities).get_close_matches(word, n, cutoff) == \
+           get_close_matches(word, possibilities, n, cutoff)
+
+
+def test_get_close_matches_random():
+    for seed in range(20):
+        possibilities = _random_strings(seed, 30)
+        matcher = CloseMatcher(possibilities)
+        # Each word is looked up twice, the second time from the cached results
+        for word in _random_strings(seed + 1_000, 15) * 2:
+            for n in [1, 3]:
+                for cutoff in THRESHOLDS:
+                    assert matcher.get_close_matches(word, n, cutoff) == \
+                           get_close_matches(word, possibilities, n, cutoff), (word, possibilities, n, cutoff)
+
+
+@pytest.mark.parametrize('n, cutoff', [(0, 0.6), (3, -0.1), (3, 1.1)])
+def test_get_close_matches_rejects_wrong_arguments(n, cutoff):
+    with pytest.raises(ValueError):
+        get_close_matches('a', ['a'], n, cutoff)
+    with pytest.raises(ValueError):
+        CloseMatcher(['a']).get_close_matches('a', n, cutoff)
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from llm_open_ie.llm.gpt import GPTOpenIE
+from llm_open_ie.llm.gpt.stages.mention_recognition import (
+    _batch_answer_parser, async_recognize_mentions_batch, recognize_mentions_batch)
+from scripted_llm import AsyncScriptedClient, ScriptedClient, scripted_answer
+
+ENTITIES = [{'label': label, 'description': '', 'types': []} for label in ['Alice', 'Bob']]
+SENTENCES = ['Alice met Bob.', 'Bob left.']
+
+
+@pytest.mark.parametrize('answer, expected', [
+    ('Sentence 1:\n1) Alice|||yes\n2) Bob|||yes\nSentence 2:\n1) Alice|||no\n2) Bob|||yes', [[0, 1], [1]]),
+    ('**Sentence 1:**\n1) Alice|||yes\n2) Bob|||yes\n\n**Sentence 2:**\n1)Alice|||NO\n2) Bob ||| yes', [[0, 1], [1]]),
+    # Only malformed lines
+    ('Sentence 1:\n1) Alice|||yes\n2) Bob|||yes\nSentence 2:\nAlice - yes\nBob - yes', [[0, 1], None]),
+    # Truncated answer
+    ('Sentence 1:\n1) Alice|||yes\n2) Bob|||yes\nSentence 2:\n1) Alice|||y', [[0, 1], None]),
+    # Some malformed lines
+    ('Sentence 1:\n1) Alice|||yes\n2) Bob - yes\nSentence 2:\n1) Alice|||no\n2) Bob|||yes', [None, [1]]),
+    # Missing entity
+    ('Sentence 1:\n1) Alice|||yes\nSentence 2:\n1) Alice|||no\n2) Bob|||yes', [None, [1]]),
+    # Inconsistent label
+    ('Sentence 1:\n1) Alice|||yes\n2) Carol|||yes\nSentence 2:\n1) Alice|||no\n2) Bob|||yes', [None, [1]]),
+    # Missing section
+    ('Sentence 1:\n1) Alice|||yes\n2) Bob|||yes', [[0, 1], None])
+])
+def test_batch_answer_parser(answer, expected):
+    assert _batch_answer_parser(answer, ENTITIES, len(SENTENCES)) == expected
+
+
+def _truncated_batch_answer(system: str, user: str) -> str:
+    # The batched answer stops in the middle of the second sentence, while the single ones are complete
+    if 'some numbered' in system:
+        return 'Sentence 1:\n1) Alice|||yes\n2) Bob|||yes\nSentence 2:\n1) Alice|||y'
+    return scripted_answer(system, user)
+
+
+def test_recognize_mentions_batch_checks_incomplete_sections_again():
+    client = ScriptedClient(answer=_truncated_batch_answer)
+    gpt = GPTOpenIE(client=client, async_client=AsyncScriptedClient(), rate_limit_sleep=0)
+
+    assert recognize_mentions_batch(gpt, SENTENCES, ENTITIES) == [[0, 1], [1]]
+    assert len(client.calls) == 2
+
+
+def test_async_recognize_mentions_batch_checks_incomplete_sections_again():
+    async_client = AsyncScriptedClient(answer=_truncated_batch_answer)
+    gpt = GPTOpenIE(client=ScriptedClient(), async_client=async_client, rate_limit_sleep=0)
+
+    assert asyncio.run(async_recognize_mentions_batch(gpt, SENTENCES, ENTITIES)) == [[0, 1], [1]]
+    assert len(async_client.calls) == 2
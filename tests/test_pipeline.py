@@ -0,0 +1,68 @@
+from __future__ import annotations
+
+import asyncio
+
+import pytest
+
+from llm_open_ie import async_iter_oie_pipeline, async_oie_pipeline, iter_oie_pipeline, oie_pipeline
+from llm_open_ie.llm.gpt import GPTOpenIE
+from scripted_llm import TEXTS, AsyncScriptedClient, ScriptedClient
+
+
+def _mention_requests(client: ScriptedClient | AsyncScriptedClient) -> int:
+    return len([call for call in client.calls if 'identify mentions' in call['messages'][0]['content']])
+
+
+@pytest.mark.parametrize('is_async', [False, True])
+def test_streamed_entities_mentions(is_async):
+    # The first entity is checked against all the others at once; each of the next ones against the entities known
+    #  so far, then against the later ones
+    client, async_client = ScriptedClient(), AsyncScriptedClient()
+    gpt = GPTOpenIE(client=client, async_client=async_client, rate_limit_sleep=0)
+    expected = oie_pipeline(TEXTS[0], GPTOpenIE(client=ScriptedClient(), async_client=AsyncScriptedClient(),
+                                                rate_limit_sleep=0))
+
+    if is_async:
+        result = asyncio.run(async_oie_pipeline(TEXTS[0], gpt, stream_entities=True))
+    else:
+        result = oie_pipeline(TEXTS[0], gpt, stream_entities=True)
+
+    assert result == expected
+    n_entities = len(expected[0])
+    assert _mention_requests(async_client if is_async else client) == 2 * n_entities - 2
+
+
+@pytest.mark.parametrize('stream_entities', [False, True])
+def test_iter_pipeline_close_sends_no_more_requests(stream_entities):
+    client = ScriptedClient()
+    gpt = GPTOpenIE(client=client, async_client=AsyncScriptedClient(), rate_limit_sleep=0)
+    steps = iter_oie_pipeline(TEXTS[0], gpt, stream_entities=stream_entities)
+    text_entities = next(steps)
+    e_i, _ = next(steps)
+    n_calls = len(client.calls)
+    steps.close()
+
+    assert len(text_entities) > 2 and e_i == 0
+    with pytest.raises(StopIteration):
+        next(steps)
+    assert len(client.calls) == n_calls
+
+
+@pytest.mark.parametrize('stream_entities', [False, True])
+def test_async_iter_pipeline_aclose_leaves_no_pending_tasks(stream_entities):
+    async_client = AsyncScriptedClient(latency=0.01)
+    gpt = GPTOpenIE(client=ScriptedClient(), async_client=async_client, rate_limit_sleep=0)
+
+    async def consume_first_entity() -> int:
+        steps = async_iter_oie_pipeline(TEXTS[0], gpt, max_concurrency=2, stream_entities=stream_entities)
+        await anext(steps)
+        await anext(steps)
+        # The other entities are still being checked
+        await steps.aclose()
+        n_pending_tasks = len([task for task in asyncio.all_tasks() if task is not asyncio.current_task()])
+        n_calls = len(async_client.calls)
+        await asyncio.sleep(0.05)
+        assert len(async_client.calls) == n_calls
+        return n_pending_tasks
+
+    assert asyncio.run(consume_first_entity()) == 0
@@ -0,0 +1,56 @@
+from __future__ import annotations
+
+from typing import Iterator
+
+import pytest
+
+from llm_open_ie import oie_pipeline
+from llm_open_ie.llm.gpt import GPTOpenIE
+from llm_open_ie.llm.stage_memo import MemoizedOpenIE, StageMemo, collect_reuse
+from scripted_llm import TEXTS, AsyncScriptedClient, ScriptedClient
+
+
+@pytest.fixture
+def memoized(tmp_path) -> Iterator[tuple[MemoizedOpenIE, ScriptedClient]]:
+    client = ScriptedClient()
+    gpt = GPTOpenIE(client=client, async_client=AsyncScriptedClient(), rate_limit_sleep=0)
+    memo = StageMemo(tmp_path / 'memo.sqlite')
+    yield MemoizedOpenIE(gpt, memo), client
+    memo.close()
+
+
+@pytest.mark.parametrize('fuse_relations', [False, True])
+def test_unchanged_document_is_reused(memoized, fuse_relations):
+    memoized_oie, client = memoized
+    expected = oie_pipeline(TEXTS[0], memoized_oie, fuse_relations=fuse_relations)
+    n_calls = len(client.calls)
+
+    with collect_reuse() as report:
+        entities, triplets = oie_pipeline(TEXTS[0], memoized_oie, fuse_relations=fuse_relations)
+
+    assert (entities, triplets) == expected
+    assert len(client.calls) == n_calls
+    reuse = report.as_dict(entities, triplets)
+    assert all([counts['regenerated'] == 0 for counts in reuse['stages'].values()])
+    assert reuse['stages']['entity_extraction']['reused'] == 1
+    assert len(reuse['entities']['reused']) == len(entities) and not reuse['entities']['regenerated']
+    assert len(reuse['triplets']['reused']) == len(triplets) > 0 and not reuse['triplets']['regenerated']
+
+
+def test_edited_document_reuses_its_triplets(memoized):
+    # The edit does not change the entities nor their sentences
+    memoized_oie, client = memoized
+    _, expected_triplets = oie_pipeline(TEXTS[0], memoized_oie)
+    n_calls = len(client.calls)
+
+    with collect_reuse() as report:
+        entities, triplets = oie_pipeline(TEXTS[0] + ' Nothing here.', memoized_oie)
+
+    assert triplets == expected_triplets
+    assert len(client.calls) == n_calls + 1
+    reuse = report.as_dict(entities, triplets)
+    assert reuse['stages']['entity_extraction'] == {'reused': 0, 'regenerated': 1}
+    assert all([
+        counts['regenerated'] == 0 for stage, counts in reuse['stages'].items() if stage != 'entity_extraction'])
+    assert len(reuse['entities']['regenerated']) == len(entities)
+    assert len(reuse['triplets']['reused']) == len(triplets) > 0 and not reuse['triplets']['regenerated']